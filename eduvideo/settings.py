@@ -72,6 +72,32 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'eduvideo.wsgi.application'
+ASGI_APPLICATION = 'eduvideo.asgi.application'
+
+# Pub/sub backend for real-time Q&A push (SSE, served by the ASGI application).
+# For several worker processes use 'main.realtime.RedisBroker' with REALTIME_REDIS_URL.
+REALTIME_BROKER = 'main.realtime.InProcessBroker'
+REALTIME_REDIS_URL = os.environ.get('REALTIME_REDIS_URL', 'redis://localhost:6379/0')
+
+# Profile and signed URL cache (main.gcs_storage). LocMemCache is per process;
+# with several workers use a shared backend (Redis/Memcached) so that profile
+# updates are visible to all of them.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'kronik-default',
+    }
+}
+
+# Direct-to-storage uploads (main.resumable_uploads). Bytes of original videos
+# one author may store. Set STORAGE_EMULATOR_HOST to use a local GCS emulator.
+VIDEO_STORAGE_QUOTA = int(os.environ.get('VIDEO_STORAGE_QUOTA', 50 * 1024 ** 3))
+
+# Cores one `manage.py transcode_worker` host may use for ffmpeg (0 = all available)
+TRANSCODE_CPU_BUDGET = int(os.environ.get('TRANSCODE_CPU_BUDGET', 0))
+
+# Transcoding always packages HLS; also write a DASH manifest over the same segments
+STREAMING_DASH = os.environ.get('STREAMING_DASH', 'False') == 'True'
 
 
 # Database
@@ -1,6 +1,6 @@
 # В main/admin.py
 from django.contrib import admin
-from .models import Category, Channel, Video, UserProfile, ExpertiseArea, Subscription
+from .models import Category, Channel, Video, UserProfile, ExpertiseArea, Subscription, PlayerEvent, ChannelStats, TranscodeJob
 
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'is_author', 'author_application_pending', 'date_joined')
@@ -32,9 +32,37 @@ class SubscriptionAdmin(admin.ModelAdmin):
     search_fields = ('subscriber__username', 'channel_id')
     date_hierarchy = 'subscribed_at'
 
+class ChannelStatsAdmin(admin.ModelAdmin):
+    list_display = ('channel_id', 'subscriber_count', 'updated_at')
+    search_fields = ('channel_id',)
+    readonly_fields = ('subscriber_count',)
+
+class PlayerEventAdmin(admin.ModelAdmin):
+    list_display = ('event_type', 'video_owner', 'video_id', 'user', 'position', 'received_at', 'processed')
+    list_filter = ('event_type', 'processed')
+    search_fields = ('video_id', 'video_owner', 'session_id')
+
+class TranscodeJobAdmin(admin.ModelAdmin):
+    list_display = ('video_id', 'user_id', 'status', 'progress', 'attempts', 'priority', 'lease_owner', 'created_at')
+    list_filter = ('status',)
+    search_fields = ('video_id', 'user_id')
+    readonly_fields = ('lease_owner', 'lease_expires_at', 'progress', 'current_step', 'result', 'started_at', 'finished_at')
+    
+    actions = ['requeue_jobs']
+    
+    def requeue_jobs(self, request, queryset):
+        count = queryset.filter(status=TranscodeJob.STATUS_FAILED).update(
+            status=TranscodeJob.STATUS_QUEUED, attempts=0, run_after=None, error=''
+        )
+        self.message_user(request, f"{count} задач поставлено в очередь повторно")
+    requeue_jobs.short_description = "Повторить выбранные задачи"
+
 admin.site.register(UserProfile, UserProfileAdmin)
 admin.site.register(ExpertiseArea)
 admin.site.register(Category)
 admin.site.register(Channel)
 admin.site.register(Video)
-admin.site.register(Subscription, SubscriptionAdmin)
\ No newline at end of file
+admin.site.register(Subscription, SubscriptionAdmin)
+admin.site.register(PlayerEvent, PlayerEventAdmin)
+admin.site.register(ChannelStats, ChannelStatsAdmin)
+admin.site.register(TranscodeJob, TranscodeJobAdmin)
\ No newline at end of file
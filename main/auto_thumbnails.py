@@ -0,0 +1,145 @@
+"""
+Automatic thumbnails for videos uploaded without one
+
+Candidate frames are taken at THUMBNAIL_POSITIONS of the duration in a
+single ffmpeg run. Every candidate is a separate input with a fast seek, so
+only the frames around those positions are decoded, never the whole video
+(over a signed URL only those byte ranges are fetched). The duration and
+frame size come from the probe fields stored at ingest, so nothing is
+probed twice.
+
+The same run writes each candidate as a JPEG (the thumbnail original) and
+as a small grayscale frame to stdout. The grayscale frames are scored with
+NumPy for exposure, contrast and sharpness (variance of the Laplacian), so
+fades to black, flat title cards and motion-blurred frames lose.
+
+Requires NumPy for scoring. Without it the middle candidate is used.
+"""
+import logging
+import os
+import subprocess
+
+from .video_quality import get_ffmpeg_path
+
+logger = logging.getLogger(__name__)
+
+# Fractions of the duration; the very start and end are usually titles or black
+THUMBNAIL_POSITIONS = (0.1, 0.25, 0.4, 0.55, 0.7, 0.85)
+# The largest thumbnail derivative (image_derivatives.THUMBNAIL_WIDTHS)
+THUMBNAIL_MAX_WIDTH = 1280
+
+# Candidates are scored on tiny frames: enough for the statistics, cheap to transfer
+SCORE_WIDTH = 160
+# Scores saturate at these values (grayscale std / Laplacian variance at SCORE_WIDTH)
+TARGET_CONTRAST = 60.0
+TARGET_SHARPNESS = 500.0
+EXPOSURE_WEIGHT = 0.3
+CONTRAST_WEIGHT = 0.3
+SHARPNESS_WEIGHT = 0.4
+
+
+def _score_size(width, height):
+    if not width or not height:
+        return SCORE_WIDTH, SCORE_WIDTH * 9 // 16
+    return SCORE_WIDTH, max(2, round(SCORE_WIDTH * height / width / 2) * 2)
+
+
+def build_candidates_command(ffmpeg_path, source, positions, output_dir, score_size, threads=None):
+    """One input per position (fast seek, one second read); JPEGs to output_dir, grayscale frames to stdout"""
+    width, height = score_size
+    cmd = [ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-y']
+    if threads:
+        cmd += ['-threads', str(threads)]
+    for position in positions:
+        cmd += ['-ss', f"{position:.3f}", '-t', '1', '-i', source]
+
+    filters = []
+    for index in range(len(positions)):
+        filters.append(f"[{index}:v]trim=end_frame=1,split=2[frame{index}][small{index}]")
+        filters.append(f"[frame{index}]scale=w=min({THUMBNAIL_MAX_WIDTH}\\,iw):h=-2[full{index}]")
+        filters.append(f"[small{index}]scale={width}:{height},format=gray[gray{index}]")
+    filters.append(''.join(f"[gray{index}]" for index in range(len(positions))) + f"concat=n={len(positions)}:v=1:a=0[gray]")
+
+    cmd += ['-filter_complex', ';'.join(filters)]
+    for index in range(len(positions)):
+        cmd += [
+            '-map', f"[full{index}]", '-frames:v', '1', '-q:v', '2', os.path.join(output_dir, f"candidate_{index}.jpg")
+        ]
+    # passthrough: the concatenated candidates are one frame each, a constant frame rate would drop some
+    return cmd + ['-map', '[gray]', '-fps_mode', 'passthrough', '-f', 'rawvideo', '-pix_fmt', 'gray', 'pipe:1']
+
+
+def score_frames(frames):
+    """
+    Scores grayscale frames (numpy uint8 array of shape (count, height, width))
+
+    Returns:
+        list: score in 0..1 per frame, higher is better
+    """
+    import numpy
+
+    frames = frames.astype(numpy.float32)
+    scores = []
+    for frame in frames:
+        # Середина диапазона яркости лучше затемнения и пересвета
+        exposure = 1 - abs(float(frame.mean()) - 128) / 128
+        contrast = min(1.0, float(frame.std()) / TARGET_CONTRAST)
+        laplacian = (
+            4 * frame[1:-1, 1:-1]
+            - frame[:-2, 1:-1] - frame[2:, 1:-1] - frame[1:-1, :-2] - frame[1:-1, 2:]
+        )
+        sharpness = min(1.0, float(laplacian.var()) / TARGET_SHARPNESS)
+        scores.append(EXPOSURE_WEIGHT * exposure + CONTRAST_WEIGHT * contrast + SHARPNESS_WEIGHT * sharpness)
+    return scores
+
+
+def extract_thumbnail(source, output_dir, duration, width=None, height=None, threads=None):
+    """
+    Picks the best looking of a few frames of a video
+
+    Args:
+        source: local path or signed URL of the video
+        output_dir: directory for the candidate JPEGs
+        duration: seconds of the video (from the stored probe fields)
+        width, height: display size of the video, for the aspect ratio of the scored frames
+
+    Returns:
+        str: path of the chosen JPEG in output_dir, None if no frame could be extracted
+    """
+    if not duration or duration <= 0:
+        return None
+
+    positions = [duration * fraction for fraction in THUMBNAIL_POSITIONS]
+    score_size = _score_size(width, height)
+    cmd = build_candidates_command(get_ffmpeg_path(), source, positions, output_dir, score_size, threads)
+    process = subprocess.run(cmd, capture_output=True, check=False)
+
+    candidates = [
+        (index, os.path.join(output_dir, f"candidate_{index}.jpg")) for index in range(len(positions))
+    ]
+    candidates = [(index, path) for index, path in candidates if os.path.exists(path) and os.path.getsize(path)]
+    if not candidates:
+        logger.error(f"Could not extract thumbnail candidates: {process.stderr.decode(errors='replace')}")
+        return None
+
+    frame_size = score_size[0] * score_size[1]
+    if process.returncode == 0 and len(process.stdout) == frame_size * len(positions):
+        try:
+            import numpy
+        except ImportError:
+            logger.warning("NumPy is not installed, thumbnail candidates are not scored")
+        else:
+            frames = numpy.frombuffer(process.stdout, dtype=numpy.uint8).reshape(
+                len(positions), score_size[1], score_size[0]
+            )
+            scores = score_frames(frames)
+            index, path = max(candidates, key=lambda candidate: scores[candidate[0]])
+            logger.info(
+                f"Thumbnail at {positions[index]:.1f}s, score {scores[index]:.2f} "
+                f"(candidates: {', '.join(f'{score:.2f}' for score in scores)})"
+            )
+            return path
+
+    index, path = candidates[len(candidates) // 2]
+    logger.info(f"Thumbnail at {positions[index]:.1f}s (not scored)")
+    return path
@@ -0,0 +1,139 @@
+"""
+Cursor pagination for video comments (Q&A)
+
+Comments are ordered by a key (date or likes plus id as a tie-breaker) and the
+cursor is the key of the last returned item, so new comments posted between
+page loads do not shift or duplicate entries. Replies are not inlined in
+comment pages - only their count - and are fetched per thread on demand.
+
+Author display names and avatar URLs are resolved for a whole page at once
+from the shared profile cache, so the client needs no per-author requests.
+"""
+import base64
+import json
+
+COMMENTS_PAGE_SIZE = 20
+COMMENTS_INITIAL_PAGE_SIZE = 10  # Страница, которая рендерится прямо в HTML
+MAX_COMMENTS_PAGE_SIZE = 50
+COMMENT_ORDERS = ('newest', 'top')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(order, key):
+    raw = json.dumps({'o': order, 'k': list(key)}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(order, cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(raw)
+        key = tuple(data['k'])
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor('Некорректный курсор')
+
+    if data.get('o') != order:
+        raise InvalidCursor('Курсор относится к другой сортировке')
+    return key
+
+
+def _comment_key(comment, order):
+    date = comment.get('date') or ''
+    comment_id = comment.get('id') or ''
+    if order == 'top':
+        return (int(comment.get('likes') or 0), date, comment_id)
+    return (date, comment_id)
+
+
+def _paginate(items, order, key_func, descending, cursor, limit):
+    ordered = sorted(items, key=key_func, reverse=descending)
+
+    if cursor:
+        after = decode_cursor(order, cursor)
+        try:
+            if descending:
+                ordered = [item for item in ordered if key_func(item) < after]
+            else:
+                ordered = [item for item in ordered if key_func(item) > after]
+        except TypeError:
+            raise InvalidCursor('Некорректный курсор')
+
+    page = ordered[:limit]
+    next_cursor = encode_cursor(order, key_func(page[-1])) if len(ordered) > limit else None
+    return page, next_cursor
+
+
+def serialize_comment(comment):
+    """Comment without inlined replies, only their count"""
+    data = {key: value for key, value in comment.items() if key != 'replies'}
+    data['reply_count'] = len(comment.get('replies') or [])
+    return data
+
+
+def embed_author_profiles(items):
+    """
+    Fills display_name and avatar_url of comments/replies from current profiles
+    with one batched lookup. Avatar URLs stored with a comment are signed and
+    expire, so they are replaced (or dropped) rather than trusted.
+    """
+    from .gcs_storage import get_user_profiles_from_gcs
+
+    profiles = get_user_profiles_from_gcs([item.get('user_id') for item in items])
+    for item in items:
+        profile = profiles.get(item.get('user_id'))
+        if not profile:
+            item.pop('avatar_url', None)
+            continue
+        if profile.get('display_name'):
+            item['display_name'] = profile['display_name']
+        if profile.get('avatar_url'):
+            item['avatar_url'] = profile['avatar_url']
+        else:
+            item.pop('avatar_url', None)
+    return items
+
+
+def get_comments_page(comments_data, order='newest', cursor=None, limit=COMMENTS_PAGE_SIZE):
+    """
+    Returns one page of top-level comments
+
+    Returns:
+        dict: {'comments': [...], 'next_cursor': str or None, 'total': int}
+    """
+    comments = comments_data.get('comments', [])
+    page, next_cursor = _paginate(
+        comments, order, lambda comment: _comment_key(comment, order), True, cursor, limit
+    )
+    return {
+        'comments': embed_author_profiles([serialize_comment(comment) for comment in page]),
+        'next_cursor': next_cursor,
+        'total': len(comments),
+    }
+
+
+def get_replies_page(comments_data, comment_id, cursor=None, limit=COMMENTS_PAGE_SIZE):
+    """
+    Returns one page of replies to a comment, oldest first
+
+    Returns:
+        dict or None if the comment does not exist
+    """
+    for comment in comments_data.get('comments', []):
+        if comment.get('id') == comment_id:
+            break
+    else:
+        return None
+
+    replies = comment.get('replies') or []
+    page, next_cursor = _paginate(
+        replies, 'replies', lambda reply: _comment_key(reply, 'newest'), False, cursor, limit
+    )
+    return {
+        'comment_id': comment_id,
+        'replies': embed_author_profiles([dict(reply) for reply in page]),
+        'next_cursor': next_cursor,
+        'total': len(replies),
+    }
@@ -0,0 +1,214 @@
+"""
+Content-hash deduplication of uploaded videos
+
+Every upload is hashed (SHA-256) and recorded in StoredContent, a
+content-addressed index of originals. An upload whose hash is already
+indexed becomes a ContentReference of the stored content instead of a new
+copy:
+
+- its own object is deleted and its metadata points at the shared
+  original, renditions, HLS package and seek bar previews, copied from the
+  video that was uploaded first. An upload is indexed only once its object
+  is stored, so a concurrent identical upload never finds the indexed
+  original missing
+- nothing is probed or transcoded again (enqueue_transcode_once); if the
+  first upload is still being transcoded, propagate_renditions copies the
+  result to every reference when it is done
+- delete_video removes shared objects only with the last reference
+  (release_content)
+
+The hash comes from the upload stream where the bytes pass through Django
+(GCSStreamingUploadHandler, local files); resumable uploads, whose chunks
+may land on different workers or go straight to GCS, are hashed by reading
+the stored object once in transcode_worker (resumable_uploads.process_upload),
+never in a request: deduplication of those uploads waits for the worker.
+"""
+import hashlib
+import json
+import logging
+
+from django.db import transaction
+
+from .models import ContentReference, StoredContent, TranscodeJob
+from .video_quality import MEDIA_FIELDS
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Metadata fields produced by transcoding, shared by all references
+RENDITION_FIELDS = (
+    'quality_variants', 'available_qualities', 'highest_quality', 'streaming', 'scrub_previews', 'encoding_ladder'
+)
+# Metadata fields describing the shared original
+SOURCE_FIELDS = ('file_path', 'file_size', 'mime_type', 'duration') + MEDIA_FIELDS
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_sha256(blob):
+    """SHA-256 of a stored object, read with ranged requests (one chunk in memory)"""
+    digest = hashlib.sha256()
+    with blob.open('rb', chunk_size=HASH_CHUNK_SIZE) as reader:
+        for chunk in iter(lambda: reader.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def claim_content(sha256, user_id, video_id, source_path, size, source_available=None):
+    """
+    Adds the video as a reference of the content with this hash, indexing
+    the content with the video's own original if it is new
+
+    source_available(path) checks that an indexed original still exists;
+    if it does not, the content is re-indexed with this video's original.
+
+    Returns:
+        StoredContent: the video is a duplicate if is_duplicate() is True
+    """
+    with transaction.atomic():
+        content, created = StoredContent.objects.select_for_update().get_or_create(
+            sha256=sha256,
+            defaults={'source_path': source_path, 'size': size or 0, 'user_id': user_id, 'video_id': video_id}
+        )
+        if not created and source_available and not source_available(content.source_path):
+            logger.warning(f"Indexed original {content.source_path} is missing, re-indexing with {source_path}")
+            content.source_path, content.size = source_path, size or 0
+            content.user_id, content.video_id = user_id, video_id
+            content.save()
+        ContentReference.objects.update_or_create(user_id=user_id, video_id=video_id, defaults={'content': content})
+    return content
+
+
+def is_duplicate(content, user_id, video_id):
+    return (content.user_id, content.video_id) != (user_id, video_id)
+
+
+def shared_metadata(metadata):
+    """Fields a duplicate copies from the metadata of the video that owns the content"""
+    return {field: metadata[field] for field in SOURCE_FIELDS + RENDITION_FIELDS if field in metadata}
+
+
+def release_content(user_id, video_id, bucket=None):
+    """
+    Removes the reference of a deleted video
+
+    If the video owned the content, the oldest remaining reference becomes
+    the owner; with a bucket, shared_from of the remaining videos is
+    updated to match. If the old owner was still waiting for renditions,
+    transcoding is queued again for the new owner: the old job's result
+    would no longer reach the other references.
+
+    Returns:
+        bool: True if no other video uses the video's original and renditions,
+        so they may be deleted (also for videos that were never indexed)
+    """
+    with transaction.atomic():
+        reference = ContentReference.objects.select_for_update().select_related('content').filter(
+            user_id=user_id, video_id=video_id
+        ).first()
+        if reference is None:
+            return True
+
+        content = reference.content
+        reference.delete()
+        remaining = content.references.order_by('created_at').first()
+        if remaining is None:
+            content.delete()
+            return True
+
+        promoted = not is_duplicate(content, user_id, video_id)
+        transcoding = False
+        if promoted:
+            # Объекты остаются на прежних путях, новые версии кодируются для следующей ссылки
+            content.user_id, content.video_id = remaining.user_id, remaining.video_id
+            content.save(update_fields=['user_id', 'video_id', 'updated_at'])
+            transcoding = TranscodeJob.objects.filter(
+                user_id=user_id, video_id=video_id, status__in=(TranscodeJob.STATUS_QUEUED, TranscodeJob.STATUS_RUNNING)
+            ).exists()
+        logger.info(f"Video {video_id} released content {content.sha256[:12]}, {content.references.count()} references left")
+
+    if promoted and bucket is not None:
+        _update_shared_from(content, bucket)
+        if transcoding:
+            _requeue_for_owner(content, bucket)
+    return False
+
+
+def _update_shared_from(content, bucket):
+    owner = f"{content.user_id}__{content.video_id}"
+    for reference in content.references.all():
+        metadata_blob = bucket.blob(f"{reference.user_id}/metadata/{reference.video_id}.json")
+        try:
+            metadata = json.loads(metadata_blob.download_as_text())
+            if not is_duplicate(content, reference.user_id, reference.video_id):
+                metadata.pop('shared_from', None)
+            else:
+                metadata['shared_from'] = owner
+            metadata_blob.upload_from_string(json.dumps(metadata, indent=2), content_type='application/json')
+        except Exception as e:
+            logger.error(f"Could not update shared_from of {reference.user_id}/{reference.video_id}: {e}")
+
+
+def _requeue_for_owner(content, bucket):
+    from .gcs_storage import get_video_metadata
+
+    metadata = get_video_metadata(content.user_id, content.video_id, bucket=bucket)
+    if metadata and not metadata.get('quality_variants'):
+        logger.info(f"Transcoding of deleted video moves to {content.user_id}/{content.video_id}")
+        enqueue_transcode_once(content.user_id, content.video_id, content.source_path)
+
+
+def enqueue_transcode_once(user_id, video_id, source_path, source_size=None):
+    """
+    Queues transcoding of a newly registered video, once per content
+
+    A duplicate whose content already has renditions queues nothing. Otherwise
+    the video owning the content is transcoded (an active job is reused) and
+    the renditions reach the duplicates through propagate_renditions.
+
+    Returns:
+        TranscodeJob or None if nothing had to be queued
+    """
+    from .gcs_storage import get_video_metadata
+    from .transcode_queue import enqueue_transcode
+
+    reference = ContentReference.objects.select_related('content').filter(user_id=user_id, video_id=video_id).first()
+    if reference is None:
+        return enqueue_transcode(user_id, video_id, source_path, source_size=source_size)
+
+    content = reference.content
+    if is_duplicate(content, user_id, video_id):
+        metadata = get_video_metadata(user_id, video_id)
+        if metadata and metadata.get('quality_variants'):
+            logger.info(f"Video {video_id} shares the renditions of {content.video_id}, transcoding skipped")
+            return None
+    return enqueue_transcode(content.user_id, content.video_id, content.source_path, source_size=content.size)
+
+
+def propagate_renditions(user_id, video_id, metadata, bucket):
+    """Copies the renditions of a transcoded video to the other videos with the same content"""
+    reference = ContentReference.objects.filter(user_id=user_id, video_id=video_id).first()
+    if reference is None:
+        return 0
+
+    fields = {field: metadata[field] for field in RENDITION_FIELDS if field in metadata}
+    updated = 0
+    for other in reference.content.references.exclude(pk=reference.pk):
+        metadata_blob = bucket.blob(f"{other.user_id}/metadata/{other.video_id}.json")
+        try:
+            other_metadata = json.loads(metadata_blob.download_as_text())
+            other_metadata.update(fields)
+            metadata_blob.upload_from_string(json.dumps(other_metadata, indent=2), content_type='application/json')
+            updated += 1
+        except Exception as e:
+            logger.error(f"Could not copy renditions of {video_id} to {other.user_id}/{other.video_id}: {e}")
+    if updated:
+        logger.info(f"Copied renditions of {video_id} to {updated} videos with the same content")
+    return updated
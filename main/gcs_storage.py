@@ -3,9 +3,13 @@ import os
 import json
 from datetime import datetime
 from django.conf import settings
+from django.core.cache import cache
 import logging
 import mimetypes
+import posixpath
+import re
 import uuid
+from xml.sax.saxutils import escape as xml_escape
 import ffmpeg
 
 # Set up logging
@@ -43,6 +47,11 @@ def find_json_file(start_dir=None, filename_part="kronik-26102005-0ec8103ffcf3.j
 
 def init_gcs_client():
     try:
+        if os.environ.get("STORAGE_EMULATOR_HOST"):
+            # Локальный эмулятор GCS (например, fake-gcs-server) - ключ сервисного аккаунта не нужен
+            from google.auth.credentials import AnonymousCredentials
+            return storage.Client(project="local-emulator", credentials=AnonymousCredentials())
+        
         credentials_path = find_json_file()
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
         
@@ -200,6 +209,7 @@ def init_user_files(user_id, bucket):
         # Сохраняем метаданные пользователя
         meta_blob = bucket.blob(f"{user_id}/bio/user_meta.json")
         meta_blob.upload_from_string(json.dumps(user_meta, indent=2), content_type='application/json')
+        invalidate_user_profile_cache(user_id)
         
         # Создаем приветственный файл
         welcome_blob = bucket.blob(f"{user_id}/bio/welcome.txt")
@@ -247,64 +257,61 @@ def upload_video(user_id, video_file_path, title=None, description=None):
     
     # Генерируем ID видео на основе даты и имени файла
     now = datetime.now()
-    date_prefix = now.strftime("%Y-%m-%d")
-    
-    # Получаем имя файла из пути
     file_name = os.path.basename(video_file_path)
     base_name = os.path.splitext(file_name)[0]
     file_extension = os.path.splitext(file_name)[1]
+    video_id = new_video_id(file_name, now)
     
-    # Формируем ID видео
-    video_id = f"{date_prefix}_{base_name}"
-    
-    # Формируем пути для хранения
+    # Формируем путь для хранения
     video_path = f"{user_id}/videos/{video_id}{file_extension}"
-    metadata_path = f"{user_id}/metadata/{video_id}.json"
-    comments_path = f"{user_id}/comments/{video_id}_comments.json"
     
     try:
+        from .content_index import file_sha256, release_content
+        from .models import StoredContent
+        
         # Получаем размер файла и MIME-тип
         file_size = os.path.getsize(video_file_path)
         mime_type = mimetypes.guess_type(video_file_path)[0] or 'video/mp4'
+        sha256 = file_sha256(video_file_path)
         
-        # Извлекаем длительность видео если возможно
-        duration = get_video_duration(video_file_path)
-        
-        # Загружаем видео
+        # Хэш известен до загрузки: сохраненный оригинал с тем же содержимым не загружается второй раз
+        stored = StoredContent.objects.filter(sha256=sha256).first()
         video_blob = bucket.blob(video_path)
-        video_blob.upload_from_filename(video_file_path, content_type=mime_type)
-        
-        # Создаем метаданные
-        metadata = {
-            "video_id": video_id,
-            "user_id": user_id,
-            "title": title or base_name,
-            "description": description or "",
-            "upload_date": now.isoformat(),
-            "file_path": video_path,
-            "file_size": file_size,
-            "mime_type": mime_type,
-            "views": 0,
-            "likes": 0,
-            "dislikes": 0,
-            "duration": duration,  # Используем извлеченную длительность
-            "status": "published"
-        }
-        
-        # Сохраняем метаданные
-        metadata_blob = bucket.blob(metadata_path)
-        metadata_blob.upload_from_string(json.dumps(metadata, indent=2), content_type='application/json')
-        
-        # Создаем пустой файл комментариев
-        comments = {
-            "video_id": video_id,
-            "comments": []
-        }
-        comments_blob = bucket.blob(comments_path)
-        comments_blob.upload_from_string(json.dumps(comments, indent=2), content_type='application/json')
+        uploaded = False
+        if stored is None or bucket.get_blob(stored.source_path) is None:
+            # Содержимое индексируется только после загрузки: до нее
+            # параллельная загрузка того же файла сочла бы оригинал пропавшим
+            video_blob.upload_from_filename(video_file_path, content_type=mime_type)
+            uploaded = True
+        
+        # Повторная загрузка того же файла ссылается на уже сохраненный оригинал
+        fields = _link_stored_content(bucket, user_id, video_id, sha256, video_path, file_size)
+        if fields is None:
+            if not uploaded:
+                # Оригинал удалили между проверкой и индексацией - теперь он наш
+                video_blob.upload_from_filename(video_file_path, content_type=mime_type)
+            fields = {
+                "file_path": video_path,
+                "file_size": file_size,
+                "mime_type": mime_type,
+                # Свойства видео (длительность, размеры, кодеки) определяются один раз
+                **probe_video(video_file_path),
+            }
+        elif uploaded:
+            # Дубликат проиндексирован одновременно с загрузкой: второй экземпляр не хранится
+            video_blob.delete()
         
-        # Обновляем статистику пользователя
-        update_user_stats(user_id, bucket)
+        try:
+            _create_video_records(bucket, user_id, video_id, {
+                "title": title or base_name,
+                "description": description or "",
+                "upload_date": now.isoformat(),
+                "sha256": sha256,
+                **fields,
+            })
+        except Exception:
+            release_content(user_id, video_id)
+            raise
         
         logger.info(f"Video {video_id} successfully uploaded")
         return video_id
@@ -313,62 +320,158 @@ def upload_video(user_id, video_file_path, title=None, description=None):
         logger.error(f"Error uploading video: {e}")
         return None
 
-def get_video_duration(video_file_path):
+def new_video_id(file_name, now=None):
+    """ID видео: дата загрузки и имя файла без расширения"""
+    now = now or datetime.now()
+    base_name = os.path.splitext(os.path.basename(file_name))[0]
+    return f"{now.strftime('%Y-%m-%d')}_{base_name}"
+
+def _create_video_records(bucket, user_id, video_id, fields):
+    """Создает метаданные и пустые комментарии для загруженного видео и обновляет статистику"""
+    metadata = {
+        "video_id": video_id,
+        "user_id": user_id,
+        "views": 0,
+        "likes": 0,
+        "dislikes": 0,
+        "status": "published"
+    }
+    metadata.update(fields)
+    
+    # Сохраняем метаданные
+    metadata_blob = bucket.blob(f"{user_id}/metadata/{video_id}.json")
+    metadata_blob.upload_from_string(json.dumps(metadata, indent=2), content_type='application/json')
+    
+    # Создаем пустой файл комментариев
+    comments = {
+        "video_id": video_id,
+        "comments": []
+    }
+    comments_blob = bucket.blob(_comments_path(user_id, video_id))
+    comments_blob.upload_from_string(json.dumps(comments, indent=2), content_type='application/json')
+    
+    # Обновляем статистику пользователя
+    update_user_stats(user_id, bucket)
+    return metadata
+
+def register_uploaded_video(user_id, video_path, title=None, description=None, sha256=None):
     """
-    Extracts duration from video file using locally installed ffmpeg binary
+    Создает метаданные для видео, которое уже лежит в хранилище
+    (загружено потоком через GCSStreamingUploadHandler)
+    
+    Свойства видео определяются ffprobe по подписанному URL: ffprobe читает
+    только заголовок файла, локальная копия для этого не нужна.
+    
+    Returns:
+    - video_id или None
     """
+    bucket = get_bucket()
+    if not bucket:
+        logger.error(f"Could not get bucket for registering uploaded video")
+        return None
+    
     try:
-        import subprocess
-        import os
-        import json
-        from django.conf import settings
-        
-        ffmpeg_dir = os.path.join(settings.BASE_DIR, 'ffmpeg')
-        
-        if os.name == 'nt':
-            ffprobe_path = os.path.join(ffmpeg_dir, 'bin', 'ffprobe.exe')
-        else:
-            ffprobe_path = os.path.join(ffmpeg_dir, 'bin', 'ffprobe')
-        
-        if not os.path.exists(ffprobe_path):
-            logger.error(f"ffprobe not found at {ffprobe_path}")
-            raise FileNotFoundError(f"ffprobe not found at {ffprobe_path}")
-        
-        cmd = [
-            ffprobe_path,
-            '-v', 'error',
-            '-show_entries', 'format=duration',
-            '-of', 'json',
-            video_file_path
-        ]
+        video_blob = bucket.get_blob(video_path)
+        if video_blob is None:
+            logger.error(f"Uploaded video not found at {video_path}")
+            return None
         
-        logger.info(f"Executing ffprobe: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        file_name = os.path.basename(video_path)
+        video_id = os.path.splitext(file_name)[0]
         
-        if result.returncode != 0:
-            logger.error(f"ffprobe error: {result.stderr}")
-            raise Exception(f"ffprobe exited with code {result.returncode}: {result.stderr}")
+        shared_fields = None
+        if sha256:
+            shared_fields = _link_stored_content(bucket, user_id, video_id, sha256, video_path, video_blob.size)
         
-        output_data = json.loads(result.stdout)
-        duration_seconds = float(output_data['format']['duration'])
+        if shared_fields:
+            # Дубликат: второй экземпляр тех же байтов не хранится
+            video_blob.delete()
+            fields = shared_fields
+        else:
+            probe_url = video_blob.generate_signed_url(version="v4", expiration=900, method="GET")
+            fields = {
+                "file_path": video_path,
+                "file_size": video_blob.size,
+                "mime_type": video_blob.content_type or mimetypes.guess_type(file_name)[0] or 'video/mp4',
+                **probe_video(probe_url),
+            }
         
-        minutes = int(duration_seconds // 60)
-        seconds = int(duration_seconds % 60)
-        formatted_duration = f"{minutes:02d}:{seconds:02d}"
+        fields.update({
+            "title": title or video_id,
+            "description": description or "",
+            "upload_date": datetime.now().isoformat(),
+        })
+        if sha256:
+            fields["sha256"] = sha256
         
-        logger.info(f"Extracted video duration: {formatted_duration}")
-        return formatted_duration
+        _create_video_records(bucket, user_id, video_id, fields)
         
+        logger.info(f"Video {video_id} registered from {video_path}")
+        return video_id
+    
     except Exception as e:
-        logger.error(f"Could not extract video duration with ffmpeg: {e}")
-        
-        # Fallback to random duration
-        import random
-        minutes = random.randint(3, 15)
-        seconds = random.randint(0, 59)
-        random_duration = f"{minutes:02d}:{seconds:02d}"
-        logger.info(f"Using random duration as fallback: {random_duration}")
-        return random_duration
+        logger.error(f"Error registering uploaded video {video_path}: {e}")
+        return None
+
+def _link_stored_content(bucket, user_id, video_id, sha256, video_path, size):
+    """
+    Записывает загрузку в индекс содержимого (см. main.content_index)
+    
+    Returns:
+    - для дубликата - поля метаданных с общим оригиналом и его вариантами
+      качества (ничего не проверяется и не кодируется заново),
+    - None для нового содержимого
+    """
+    from .content_index import claim_content, is_duplicate, shared_metadata
+    
+    content = claim_content(
+        sha256, user_id, video_id, video_path, size,
+        source_available=lambda path: bucket.get_blob(path) is not None
+    )
+    if not is_duplicate(content, user_id, video_id):
+        return None
+    
+    fields = shared_metadata(get_video_metadata(content.user_id, content.video_id, bucket=bucket) or {})
+    if fields.get("file_path") != content.source_path:
+        # Метаданные первой загрузки еще не записаны (загрузки идут одновременно)
+        probe_url = bucket.blob(content.source_path).generate_signed_url(version="v4", expiration=900, method="GET")
+        fields = {"file_path": content.source_path, "file_size": content.size, **probe_video(probe_url)}
+    fields["shared_from"] = f"{content.user_id}__{content.video_id}"
+    
+    logger.info(f"Video {video_id} has the same content as {content.video_id}, linked to {content.source_path}")
+    return fields
+
+def format_duration(seconds):
+    """Длительность для отображения в формате MM:SS"""
+    if not seconds:
+        return "00:00"
+    minutes = int(seconds // 60)
+    return f"{minutes:02d}:{int(seconds % 60):02d}"
+
+def probe_video(source):
+    """
+    Свойства видео для метаданных, определяются один раз при загрузке
+    
+    source - локальный файл или подписанный URL. Числовые поля
+    (duration_seconds, width, height, fps, bitrate, rotation, кодеки) берут
+    из метаданных все следующие этапы, в том числе транскодирование;
+    duration остается строкой MM:SS для отображения.
+    
+    Returns:
+    - dict полей метаданных (только duration, если файл не удалось проверить)
+    """
+    from .video_quality import probe_media
+    
+    media = probe_media(source) or {}
+    fields = dict(media)
+    fields["duration"] = format_duration(media.get("duration_seconds"))
+    return fields
+
+def get_video_duration(video_file_path):
+    """
+    Extracts duration (MM:SS) from a video file or URL
+    """
+    return probe_video(video_file_path)["duration"]
 
 def update_user_stats(user_id, bucket=None):
     """Обновляет статистику пользователя в метаданных"""
@@ -409,6 +512,7 @@ def update_user_stats(user_id, bucket=None):
         # Сохраняем обновленные метаданные, но сохраняем существующий аватар
         # Это важно для предотвращения потери аватара при загрузке видео
         user_meta_blob.upload_from_string(json.dumps(user_meta, indent=2), content_type='application/json')
+        invalidate_user_profile_cache(user_id)
         return True
         
     except Exception as e:
@@ -432,17 +536,36 @@ def upload_thumbnail(user_id, video_id, thumbnail_file_path):
         thumbnail_blob = bucket.blob(thumbnail_path)
         thumbnail_blob.upload_from_filename(thumbnail_file_path, content_type=mime_type)
         
+        # Уменьшенные копии для карточек и плеера - оригинал страницам не отдается
+        from .image_derivatives import THUMBNAIL_WIDTHS, THUMBNAIL_SIZE_BUDGET, render_lqip
+        derivatives = _store_image_derivatives(
+            bucket, thumbnail_file_path, f"{user_id}/previews/{video_id}", THUMBNAIL_WIDTHS, THUMBNAIL_SIZE_BUDGET
+        )
+        # Крошечное превью встраивается в страницы списков как data URI
+        lqip = render_lqip(thumbnail_file_path)
+        
         # Обновляем метаданные с информацией о миниатюре
         metadata_path = f"{user_id}/metadata/{video_id}.json"
         metadata_blob = bucket.blob(metadata_path)
         
         if metadata_blob.exists():
             metadata_content = json.loads(metadata_blob.download_as_text())
+            previous_derivatives = metadata_content.get("thumbnail_derivatives")
             metadata_content["thumbnail_path"] = thumbnail_path
             metadata_content["thumbnail_mime_type"] = mime_type
+            if derivatives:
+                metadata_content["thumbnail_derivatives"] = derivatives
+            else:
+                metadata_content.pop("thumbnail_derivatives", None)
+            if lqip:
+                metadata_content["thumbnail_lqip"] = lqip
+            else:
+                metadata_content.pop("thumbnail_lqip", None)
             metadata_blob.upload_from_string(json.dumps(metadata_content, indent=2), content_type='application/json')
-            logger.info(f"Updated metadata with thumbnail path: {thumbnail_path}")
+            _delete_image_derivatives(bucket, previous_derivatives)
+            logger.info(f"Updated metadata with thumbnail path: {thumbnail_path} ({len(derivatives)} derivatives)")
         else:
+            _delete_image_derivatives(bucket, derivatives)
             logger.error(f"Metadata not found for video {video_id}")
         
         logger.info(f"Thumbnail for video {video_id} successfully uploaded")
@@ -452,23 +575,181 @@ def upload_thumbnail(user_id, video_id, thumbnail_file_path):
         logger.error(f"Error uploading thumbnail: {e}")
         return False
 
+def create_auto_thumbnail(user_id, video_id, source=None, metadata=None):
+    """
+    Выбирает кадр видео, загруженного без миниатюры, и сохраняет его как
+    миниатюру с производными (см. main.auto_thumbnails)
+    
+    source - локальный файл видео; без него кадры читаются из оригинала
+    по подписанному URL. Длительность и размеры берутся из полей probe в
+    метаданных, повторно видео не проверяется.
+    
+    Returns:
+    - True если миниатюра сохранена
+    """
+    import shutil
+    import tempfile
+    from .auto_thumbnails import extract_thumbnail
+    
+    metadata = metadata or get_video_metadata(user_id, video_id)
+    if not metadata:
+        logger.error(f"Metadata not found for automatic thumbnail of {video_id}")
+        return False
+    
+    work_dir = tempfile.mkdtemp(prefix='thumbnail-')
+    try:
+        if not source:
+            bucket = get_bucket()
+            if not bucket:
+                logger.error(f"Could not get bucket for automatic thumbnail of {video_id}")
+                return False
+            source = bucket.blob(metadata['file_path']).generate_signed_url(version="v4", expiration=900, method="GET")
+        
+        thumbnail_path = extract_thumbnail(
+            source, work_dir, metadata.get('duration_seconds'), metadata.get('width'), metadata.get('height')
+        )
+        if not thumbnail_path:
+            logger.warning(f"No automatic thumbnail for video {video_id}")
+            return False
+        return upload_thumbnail(user_id, video_id, thumbnail_path)
+    
+    except Exception as e:
+        logger.error(f"Error creating automatic thumbnail for {video_id}: {e}")
+        return False
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# Комментарии хранятся как снапшот {video_id}_comments.json и append-only хвост
+# сегментов в {video_id}_segments/ - по одному объекту на комментарий или ответ.
+# Запись создает новый объект и никогда не перезаписывает существующие,
+# compact_video_comments периодически сливает хвост в снапшот.
+COMMENT_SEGMENT_WORKERS = 8
+
+def _comments_path(user_id, video_id):
+    return f"{user_id}/comments/{video_id}_comments.json"
+
+def _comment_segments_prefix(user_id, video_id):
+    return f"{user_id}/comments/{video_id}_segments/"
+
+def _append_comment_segment(bucket, user_id, video_id, entry):
+    """
+    Записывает один сегмент комментария.
+    Имя начинается с времени в миллисекундах, поэтому листинг возвращает сегменты
+    в порядке добавления; if_generation_match=0 не дает перезаписать чужой объект.
+    """
+    segment_name = f"{_comment_segments_prefix(user_id, video_id)}{int(datetime.now().timestamp() * 1000):013d}_{uuid.uuid4().hex}.json"
+    bucket.blob(segment_name).upload_from_string(
+        json.dumps(entry),
+        content_type='application/json',
+        if_generation_match=0
+    )
+
+def _list_comment_segments(bucket, user_id, video_id):
+    """Объекты хвоста сегментов в порядке добавления (без чтения содержимого)"""
+    return sorted(
+        bucket.list_blobs(prefix=_comment_segments_prefix(user_id, video_id)),
+        key=lambda blob: blob.name
+    )
+
+def _load_comment_segments(bucket, user_id, video_id):
+    """Возвращает список (blob, entry) хвоста сегментов в порядке добавления"""
+    return _read_comment_segments(_list_comment_segments(bucket, user_id, video_id))
+
+def _read_comment_segments(blobs):
+    """Скачивает сегменты параллельно; удаленные к этому моменту пропускаются"""
+    if not blobs:
+        return []
+    
+    def load(blob):
+        try:
+            return json.loads(blob.download_as_text())
+        except Exception as e:
+            # Сегмент мог быть удален параллельной компакцией - он уже в снапшоте
+            logger.warning(f"Could not read comment segment {blob.name}: {e}")
+            return None
+    
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(COMMENT_SEGMENT_WORKERS, len(blobs))) as executor:
+        entries = list(executor.map(load, blobs))
+    
+    return [(blob, entry) for blob, entry in zip(blobs, entries) if entry]
+
+def _merge_comment_segments(comments_data, entries):
+    """
+    Применяет сегменты к снапшоту. Записи с уже известными ID пропускаются,
+    так что повторное применение сегмента (например, во время компакции) безопасно.
+    
+    Сначала применяются все комментарии, затем ответы: имена сегментов содержат
+    время часов разных воркеров, и ответ может оказаться в листинге раньше
+    своего комментария.
+    
+    Returns:
+        list: для каждой записи True, если она применена (или уже была в снапшоте);
+        False для ответа на комментарий, которого нет ни в снапшоте, ни в хвосте
+    """
+    comments = comments_data.setdefault("comments", [])
+    comments_by_id = {comment.get("id"): comment for comment in comments}
+    applied = [True] * len(entries)
+    
+    for entry in entries:
+        if entry.get("type") == "comment":
+            comment = entry.get("comment") or {}
+            if comment.get("id") and comment["id"] not in comments_by_id:
+                comment.setdefault("replies", [])
+                comments.append(comment)
+                comments_by_id[comment["id"]] = comment
+    
+    for index, entry in enumerate(entries):
+        if entry.get("type") == "reply":
+            reply = entry.get("reply") or {}
+            parent = comments_by_id.get(entry.get("comment_id"))
+            if parent is None:
+                applied[index] = False
+                continue
+            replies = parent.setdefault("replies", [])
+            if reply.get("id") and all(existing.get("id") != reply["id"] for existing in replies):
+                replies.append(reply)
+    
+    return applied
+
+def _load_merged_comments(bucket, user_id, video_id):
+    """
+    Снапшот с примененным хвостом сегментов.
+    
+    Сегменты читаются до снапшота: компакция сначала записывает новый снапшот
+    и только потом удаляет слитые сегменты, поэтому сегмент, удаленный после
+    листинга, уже есть в прочитанном затем снапшоте. При обратном порядке
+    компакция между двумя чтениями скрыла бы его из обоих.
+    
+    Returns:
+        tuple: (данные комментариев, generation снапшота или None,
+        множество имен примененных сегментов)
+    """
+    segments = _load_comment_segments(bucket, user_id, video_id)
+    comments_data, generation = _load_comments_snapshot(bucket, user_id, video_id)
+    applied = _merge_comment_segments(comments_data, [entry for _, entry in segments])
+    return comments_data, generation, {blob.name for (blob, _), done in zip(segments, applied) if done}
+
+def _load_comments_snapshot(bucket, user_id, video_id):
+    """Возвращает (данные снапшота, generation) или ({"comments": []}, None)"""
+    snapshot_blob = bucket.get_blob(_comments_path(user_id, video_id))
+    if snapshot_blob is None:
+        return {"comments": []}, None
+    
+    comments_data = json.loads(snapshot_blob.download_as_text())
+    return comments_data, snapshot_blob.generation
+
 def add_comment(user_id, video_id, comment_user_id, comment_text, display_name=None, avatar_url=None):
-    """Добавляет комментарий к видео с поддержкой URL аватара"""
+    """
+    Добавляет комментарий к видео с поддержкой URL аватара.
+    Возвращает созданный комментарий или None при ошибке.
+    """
     bucket = get_bucket()
     if not bucket:
         logger.error(f"Could not get bucket for adding comment")
-        return False
-        
-    comments_path = f"{user_id}/comments/{video_id}_comments.json"
+        return None
     
     try:
-        comments_blob = bucket.blob(comments_path)
-        
-        if comments_blob.exists():
-            comments_data = json.loads(comments_blob.download_as_text())
-        else:
-            comments_data = {"comments": []}
-        
         # Генерируем уникальный ID комментария
         comment_id = str(uuid.uuid4())
         
@@ -487,86 +768,129 @@ def add_comment(user_id, video_id, comment_user_id, comment_text, display_name=N
         if avatar_url:
             new_comment["avatar_url"] = avatar_url
         
-        comments_data["comments"].append(new_comment)
-        
-        # Сохраняем обновленные комментарии
-        comments_blob.upload_from_string(json.dumps(comments_data, indent=2), content_type='application/json')
+        # Пишем отдельный сегмент вместо перезаписи всего файла комментариев
+        _append_comment_segment(bucket, user_id, video_id, {"type": "comment", "comment": new_comment})
         
         logger.info(f"Comment added to video {video_id}")
-        return True
+        return new_comment
     
     except Exception as e:
         logger.error(f"Error adding comment: {e}")
-        return False
+        return None
 
 # Исправление функции добавления ответа, чтобы включать URL аватара
 def add_reply(user_id, video_id, comment_id, reply_user_id, reply_text, display_name=None, avatar_url=None):
-    """Добавляет ответ на комментарий с поддержкой URL аватара"""
+    """
+    Добавляет ответ на комментарий с поддержкой URL аватара.
+    Возвращает созданный ответ или None при ошибке.
+    Ответ привязывается к комментарию при чтении/компакции.
+    """
     bucket = get_bucket()
     if not bucket:
         logger.error(f"Could not get bucket for adding reply")
-        return False
-        
-    comments_path = f"{user_id}/comments/{video_id}_comments.json"
+        return None
+    
+    if not comment_id:
+        logger.error(f"Comment ID is required to add a reply to video {video_id}")
+        return None
     
     try:
-        comments_blob = bucket.blob(comments_path)
-        
-        if not comments_blob.exists():
-            logger.error(f"Comments file not found for video {video_id}")
-            return False
-            
-        comments_data = json.loads(comments_blob.download_as_text())
-        
-        # Находим комментарий, на который нужно ответить
-        found = False
-        for comment in comments_data.get("comments", []):
-            if comment.get("id") == comment_id:
-                # Генерируем уникальный ID ответа
-                reply_id = str(uuid.uuid4())
-                
-                # Создаем объект ответа с URL аватара
-                reply = {
-                    "id": reply_id,
-                    "user_id": reply_user_id,
-                    "display_name": display_name or reply_user_id,
-                    "text": reply_text,
-                    "date": datetime.now().isoformat(),
-                    "likes": 0
-                }
-                
-                # Добавляем URL аватара, если он предоставлен
-                if avatar_url:
-                    reply["avatar_url"] = avatar_url
-                
-                # Добавляем ответ к комментарию
-                if "replies" not in comment:
-                    comment["replies"] = []
-                    
-                comment["replies"].append(reply)
-                found = True
-                break
-        
-        if not found:
+        # Комментарий может быть еще в хвосте сегментов, а не в снапшоте
+        comments_data, _, _ = _load_merged_comments(bucket, user_id, video_id)
+        if all(comment.get("id") != comment_id for comment in comments_data["comments"]):
             logger.error(f"Comment {comment_id} not found in video {video_id}")
-            return False
-            
-        # Сохраняем обновленные комментарии
-        comments_blob.upload_from_string(json.dumps(comments_data, indent=2), content_type='application/json')
+            return None
+        
+        # Генерируем уникальный ID ответа
+        reply_id = str(uuid.uuid4())
+        
+        # Создаем объект ответа с URL аватара
+        reply = {
+            "id": reply_id,
+            "user_id": reply_user_id,
+            "display_name": display_name or reply_user_id,
+            "text": reply_text,
+            "date": datetime.now().isoformat(),
+            "likes": 0
+        }
+        
+        # Добавляем URL аватара, если он предоставлен
+        if avatar_url:
+            reply["avatar_url"] = avatar_url
+        
+        _append_comment_segment(bucket, user_id, video_id, {"type": "reply", "comment_id": comment_id, "reply": reply})
         
         logger.info(f"Reply added to comment {comment_id} in video {video_id}")
-        return True
+        return reply
     
     except Exception as e:
         logger.error(f"Error adding reply: {e}")
-        return False
+        return None
 
-def get_video_metadata(user_id, video_id):
+def compact_video_comments(user_id, video_id, bucket=None):
+    """
+    Сливает хвост сегментов в снапшот комментариев.
+    
+    Снапшот перезаписывается с условием на generation, поэтому параллельная
+    компакция не потеряет данные; удаляются только слитые сегменты,
+    новые сегменты, появившиеся во время компакции, остаются в хвосте.
+    
+    Returns:
+        int: число слитых сегментов или -1 при ошибке
+    """
+    if not bucket:
+        bucket = get_bucket()
+    if not bucket:
+        logger.error(f"Could not get bucket for compacting comments")
+        return -1
+    
+    try:
+        segments = _load_comment_segments(bucket, user_id, video_id)
+        if not segments:
+            return 0
+        
+        comments_data, generation = _load_comments_snapshot(bucket, user_id, video_id)
+        applied = _merge_comment_segments(comments_data, [entry for _, entry in segments])
+        
+        # Ответы без комментария остаются в хвосте, а не удаляются вместе со слитыми сегментами
+        orphans = applied.count(False)
+        if orphans:
+            logger.warning(f"Keeping {orphans} replies to unknown comments of video {video_id} in the tail")
+        segments = [segment for segment, done in zip(segments, applied) if done]
+        if not segments:
+            return 0
+        
+        from google.api_core.exceptions import PreconditionFailed
+        try:
+            bucket.blob(_comments_path(user_id, video_id)).upload_from_string(
+                json.dumps(comments_data),
+                content_type='application/json',
+                if_generation_match=generation or 0
+            )
+        except PreconditionFailed:
+            logger.warning(f"Comments snapshot for video {video_id} changed during compaction, skipping")
+            return 0
+        
+        for blob, _ in segments:
+            try:
+                blob.delete()
+            except Exception as e:
+                logger.warning(f"Could not delete comment segment {blob.name}: {e}")
+        
+        logger.info(f"Compacted {len(segments)} comment segments for video {video_id}")
+        return len(segments)
+    
+    except Exception as e:
+        logger.error(f"Error compacting comments for video {video_id}: {e}")
+        return -1
+
+def get_video_metadata(user_id, video_id, bucket=None):
     """Получает метаданные видео"""
-    bucket = get_bucket()
     if not bucket:
-        logger.error(f"Could not get bucket for retrieving metadata")
-        return None
+        bucket = get_bucket()
+        if not bucket:
+            logger.error(f"Could not get bucket for retrieving metadata")
+            return None
         
     metadata_path = f"{user_id}/metadata/{video_id}.json"
     
@@ -583,23 +907,53 @@ def get_video_metadata(user_id, video_id):
         logger.error(f"Error retrieving metadata: {e}")
         return None
 
+# Слитый набор комментариев видео в кэше (см. get_video_comments)
+COMMENTS_CACHE_TTL = 10 * 60
+
+def _comments_cache_key(user_id, video_id):
+    return f"video_comments:{user_id}:{video_id}"
+
 def get_video_comments(user_id, video_id):
-    """Получает комментарии к видео"""
+    """
+    Получает комментарии к видео: снапшот плюс еще не слитый хвост сегментов.
+    
+    Слитый набор кэшируется вместе с generation снапшота и именами примененных
+    сегментов. Пока снапшот не перезаписан, скачиваются только новые сегменты,
+    а если их нет - только листинг и метаданные снапшота, так что страница
+    видео и каждая страница /api/comments/ не читают весь набор заново.
+    """
     bucket = get_bucket()
     if not bucket:
         logger.error(f"Could not get bucket for retrieving comments")
         return {"comments": []}
-        
-    comments_path = f"{user_id}/comments/{video_id}_comments.json"
     
     try:
-        comments_blob = bucket.blob(comments_path)
-        
-        if comments_blob.exists():
-            return json.loads(comments_blob.download_as_text())
-        else:
-            logger.warning(f"Comments for video {video_id} not found")
-            return {"comments": []}
+        key = _comments_cache_key(user_id, video_id)
+        cached = cache.get(key)
+        comments_data = None
+        
+        # Порядок как в _load_merged_comments: сегменты до снапшота
+        blobs = _list_comment_segments(bucket, user_id, video_id)
+        snapshot_blob = bucket.get_blob(_comments_path(user_id, video_id))
+        generation = snapshot_blob.generation if snapshot_blob else None
+        
+        if cached and cached["generation"] == generation and cached["segments"] <= {blob.name for blob in blobs}:
+            new_blobs = [blob for blob in blobs if blob.name not in cached["segments"]]
+            segments = _read_comment_segments(new_blobs)
+            # Сегмент, удаленный после проверки generation, уже в новом снапшоте - читаем все заново
+            if len(segments) == len(new_blobs):
+                comments_data = cached["data"]
+                applied = _merge_comment_segments(comments_data, [entry for _, entry in segments])
+                names = cached["segments"] | {blob.name for (blob, _), done in zip(segments, applied) if done}
+        
+        if comments_data is None:
+            comments_data, generation, names = _load_merged_comments(bucket, user_id, video_id)
+            if generation is None and not blobs and not names:
+                logger.warning(f"Comments for video {video_id} not found")
+                return {"comments": []}
+        
+        cache.set(key, {"generation": generation, "segments": names, "data": comments_data}, COMMENTS_CACHE_TTL)
+        return comments_data
     
     except Exception as e:
         logger.error(f"Error retrieving comments: {e}")
@@ -649,12 +1003,21 @@ def delete_video(user_id, video_id):
         return False
     
     try:
-        # Удаляем файл видео
-        if "file_path" in metadata:
+        from .content_index import release_content
+        
+        # Оригинал и варианты качества, общие с другими видео, удаляются с последней ссылкой
+        shared = not release_content(user_id, video_id, bucket)
+        
+        # Удаляем файл видео и варианты качества
+        if "file_path" in metadata and not shared:
             video_blob = bucket.blob(metadata["file_path"])
             if video_blob.exists():
                 video_blob.delete()
                 logger.info(f"Video file {video_id} deleted")
+            for variant in (metadata.get("quality_variants") or {}).values():
+                variant_blob = bucket.blob(variant.get("path", ""))
+                if variant.get("path") and variant_blob.exists():
+                    variant_blob.delete()
         
         # Удаляем миниатюру
         if "thumbnail_path" in metadata:
@@ -662,6 +1025,7 @@ def delete_video(user_id, video_id):
             if thumbnail_blob.exists():
                 thumbnail_blob.delete()
                 logger.info(f"Thumbnail for video {video_id} deleted")
+        _delete_image_derivatives(bucket, metadata.get("thumbnail_derivatives"))
         
         # Удаляем метаданные
         metadata_path = f"{user_id}/metadata/{video_id}.json"
@@ -676,6 +1040,15 @@ def delete_video(user_id, video_id):
         if comments_blob.exists():
             comments_blob.delete()
             logger.info(f"Comments for video {video_id} deleted")
+        for segment_blob in bucket.list_blobs(prefix=_comment_segments_prefix(user_id, video_id)):
+            segment_blob.delete()
+        
+        # Удаляем пакет HLS/DASH и превью для перемотки
+        for package in ("streaming", "scrub_previews"):
+            package_prefix = (metadata.get(package) or {}).get("prefix")
+            if package_prefix and not shared:
+                for package_blob in bucket.list_blobs(prefix=package_prefix):
+                    package_blob.delete()
         
         # Обновляем статистику пользователя после удаления
         update_user_stats(user_id, bucket)
@@ -765,6 +1138,7 @@ def update_user_profile_in_gcs(user_id, display_name=None, bio=None, profile_pic
         
         # Обработка изображения профиля
         is_default_image = False
+        stale_derivatives = None
         
         # Проверяем, нужно ли удалить аватар
         if profile_picture_path and 'default.png' in profile_picture_path.lower():
@@ -792,6 +1166,7 @@ def update_user_profile_in_gcs(user_id, display_name=None, bio=None, profile_pic
                 # Обновляем метаданные с путем к аватару
                 user_meta["avatar_path"] = avatar_path
                 user_meta["is_default_avatar"] = True
+                stale_derivatives = _replace_avatar_derivatives(bucket, user_id, user_meta, profile_picture_path)
         elif profile_picture_path and os.path.exists(profile_picture_path):
             # Если загружен новый аватар, удаляем старый (если есть)
             if "avatar_path" in user_meta:
@@ -814,12 +1189,15 @@ def update_user_profile_in_gcs(user_id, display_name=None, bio=None, profile_pic
             # Обновляем метаданные с путем к аватару
             user_meta["avatar_path"] = avatar_path
             user_meta["is_default_avatar"] = False
+            stale_derivatives = _replace_avatar_derivatives(bucket, user_id, user_meta, profile_picture_path)
         
         # Обновляем временную метку
         user_meta["last_updated"] = datetime.now().isoformat()
         
         # Сохраняем обновленные метаданные
         user_meta_blob.upload_from_string(json.dumps(user_meta, indent=2), content_type='application/json')
+        _write_through_profile(bucket, user_id, user_meta, user_meta_blob.generation, bio, avatar_changed=bool(profile_picture_path))
+        _delete_image_derivatives(bucket, stale_derivatives)
         
         logger.info(f"User profile for {user_id} successfully updated in GCS")
         return True
@@ -828,47 +1206,290 @@ def update_user_profile_in_gcs(user_id, display_name=None, bio=None, profile_pic
         logger.error(f"Error updating user profile in GCS: {e}")
         return False
 
-def get_user_profile_from_gcs(user_id):
-    """Получает информацию профиля пользователя из GCS"""
-    bucket = get_bucket()
-    if not bucket:
-        logger.error(f"Could not get bucket for retrieving user profile")
+def _replace_avatar_derivatives(bucket, user_id, user_meta, profile_picture_path):
+    """
+    Создает производные нового аватара и записывает их в user_meta.
+    Возвращает производные предыдущего аватара - их удаляют после сохранения метаданных.
+    """
+    from .image_derivatives import AVATAR_WIDTHS, AVATAR_SIZE_BUDGET
+    
+    previous_derivatives = user_meta.pop("avatar_derivatives", None)
+    derivatives = _store_image_derivatives(
+        bucket, profile_picture_path, f"{user_id}/bio/avatar", AVATAR_WIDTHS, AVATAR_SIZE_BUDGET, square=True
+    )
+    if derivatives:
+        user_meta["avatar_derivatives"] = derivatives
+    return previous_derivatives
+
+# Кэш профилей пользователей.
+# Записи хранят generation объекта user_meta.json: загрузка при промахе кэша
+# не перетирает более новую запись, записанную update_user_profile_in_gcs.
+# Для нескольких воркеров в settings.CACHES должен быть общий бэкенд.
+PROFILE_CACHE_TTL = 600
+PROFILE_CACHE_PREFIX = "user_profile:"
+
+# Подписанные URL изображений (аватары, миниатюры) переиспользуются, пока до
+# истечения не останется IMAGE_URL_REFRESH_MARGIN секунд - так URL стабилен
+# и кэшируется браузером
+IMAGE_URL_TTL = 3600 * 24
+IMAGE_URL_REFRESH_MARGIN = 3600
+IMAGE_URL_CACHE_PREFIX = "image_url:"
+
+def _profile_cache_key(user_id):
+    return f"{PROFILE_CACHE_PREFIX}{user_id}"
+
+def invalidate_user_profile_cache(user_id):
+    cache.delete(_profile_cache_key(user_id))
+
+def _cache_profile(user_id, generation, profile, write_through=False):
+    """Сохраняет профиль в кэш; отсутствующий профиль хранится как {}"""
+    key = _profile_cache_key(user_id)
+    entry = {"generation": generation or 0, "profile": profile or {}}
+    
+    if write_through:
+        cache.set(key, entry, PROFILE_CACHE_TTL)
+        return
+    
+    if not cache.add(key, entry, PROFILE_CACHE_TTL):
+        current = cache.get(key)
+        if current is None or entry["generation"] > current.get("generation", 0):
+            cache.set(key, entry, PROFILE_CACHE_TTL)
+
+def _signed_image_url(bucket, image_path, refresh=False, check_exists=True):
+    """
+    Возвращает подписанный URL изображения, переиспользуя ранее подписанный.
+    Для производных изображений check_exists=False: их пути берутся из
+    метаданных и не меняются, проверка существования - лишний запрос.
+    """
+    key = f"{IMAGE_URL_CACHE_PREFIX}{image_path}"
+    if not refresh:
+        url = cache.get(key)
+        if url:
+            return url
+    
+    image_blob = bucket.blob(image_path)
+    if check_exists and not image_blob.exists():
         return None
     
+    url = image_blob.generate_signed_url(
+        version="v4",
+        expiration=IMAGE_URL_TTL,
+        method="GET"
+    )
+    cache.set(key, url, IMAGE_URL_TTL - IMAGE_URL_REFRESH_MARGIN)
+    return url
+
+def _store_image_derivatives(bucket, source_path, path_prefix, widths, size_budget, square=False):
+    """
+    Создает и загружает производные изображения (см. main.image_derivatives)
+    
+    Файлы называются {path_prefix}_{token}_{ширина}.{расширение}: токен
+    меняется при каждой загрузке, поэтому файлы можно кэшировать навсегда.
+    
+    Returns:
+        list: [{width, height, format, path, size}] или [] если производные не созданы
+    """
+    from .image_derivatives import render_derivatives, IMMUTABLE_CACHE_CONTROL
+    
+    token = uuid.uuid4().hex[:8]
+    stored = []
     try:
-        # Получаем метаданные пользователя
-        user_meta_path = f"{user_id}/bio/user_meta.json"
-        user_meta_blob = bucket.blob(user_meta_path)
-        
-        if not user_meta_blob.exists():
-            logger.warning(f"User metadata not found for {user_id}")
-            return None
-        
-        # Загружаем метаданные пользователя
-        user_meta = json.loads(user_meta_blob.download_as_text())
+        for derivative in render_derivatives(source_path, widths, size_budget, square=square):
+            path = f"{path_prefix}_{token}_{derivative['width']}.{derivative['extension']}"
+            blob = bucket.blob(path)
+            blob.cache_control = IMMUTABLE_CACHE_CONTROL
+            blob.upload_from_string(derivative['data'], content_type=derivative['content_type'])
+            stored.append({
+                "width": derivative['width'],
+                "height": derivative['height'],
+                "format": derivative['format'],
+                "path": path,
+                "size": len(derivative['data'])
+            })
+    except Exception as e:
+        logger.error(f"Error storing image derivatives for {path_prefix}: {e}")
+        _delete_image_derivatives(bucket, stored)
+        return []
+    
+    return stored
+
+def _delete_image_derivatives(bucket, derivatives):
+    from google.api_core.exceptions import NotFound
+    
+    for derivative in derivatives or []:
+        try:
+            bucket.blob(derivative["path"]).delete()
+        except NotFound:
+            pass
+        except Exception as e:
+            logger.error(f"Error deleting image derivative {derivative.get('path')}: {e}")
+
+def get_image_urls(bucket, derivatives, default_width):
+    """
+    Returns:
+        dict: {'url': JPEG шириной не меньше default_width, 'srcset': WebP srcset}
+    """
+    from .image_derivatives import pick_derivative
+    
+    fallback = pick_derivative(derivatives, 'jpeg', default_width)
+    srcset = ", ".join(
+        f"{_signed_image_url(bucket, derivative['path'], check_exists=False)} {derivative['width']}w"
+        for derivative in sorted(derivatives, key=lambda d: d['width'])
+        if derivative['format'] == 'webp'
+    )
+    return {
+        'url': _signed_image_url(bucket, fallback['path'], check_exists=False) if fallback else None,
+        'srcset': srcset
+    }
+
+def get_thumbnail_urls(user_id, video_id, metadata, bucket=None, width=None):
+    """
+    URL миниатюры видео для шаблонов и API
+    
+    Args:
+        width: ширина JPEG для thumbnail_url (по умолчанию THUMBNAIL_DEFAULT_WIDTH)
+    
+    Returns:
+        dict: {'thumbnail_url', 'thumbnail_srcset'}; без производных - подписанный
+        URL оригинала и пустой srcset, без миниатюры - пустой словарь
+    """
+    from .image_derivatives import THUMBNAIL_DEFAULT_WIDTH
+    
+    if metadata.get("thumbnail_derivatives"):
+        if bucket is None:
+            bucket = get_bucket()
+        if bucket:
+            urls = get_image_urls(bucket, metadata["thumbnail_derivatives"], width or THUMBNAIL_DEFAULT_WIDTH)
+            return {'thumbnail_url': urls['url'], 'thumbnail_srcset': urls['srcset']}
+    
+    if metadata.get("thumbnail_path"):
+        return {
+            'thumbnail_url': generate_video_url(user_id, video_id, file_path=metadata["thumbnail_path"], expiration_time=3600),
+            'thumbnail_srcset': ''
+        }
+    
+    return {}
+
+def _attach_avatar_urls(bucket, profile, refresh=False):
+    """Добавляет в профиль avatar_url (и avatar_srcset, если есть производные)"""
+    from .image_derivatives import AVATAR_DEFAULT_WIDTH
+    
+    if profile.get("avatar_derivatives"):
+        urls = get_image_urls(bucket, profile["avatar_derivatives"], AVATAR_DEFAULT_WIDTH)
+        profile["avatar_url"] = urls['url']
+        profile["avatar_srcset"] = urls['srcset']
+    elif profile.get("avatar_path"):
+        # Новый аватар пишется по тому же пути - выдаем новый URL, чтобы сбросить кэш браузера
+        avatar_url = _signed_image_url(bucket, profile["avatar_path"], refresh=refresh)
+        if avatar_url:
+            profile["avatar_url"] = avatar_url
+
+def _write_through_profile(bucket, user_id, user_meta, generation, bio=None, avatar_changed=False):
+    """Записывает в кэш профиль, только что сохраненный в GCS"""
+    profile = dict(user_meta)
+    
+    if bio:
+        profile["bio"] = bio
+    else:
+        # Биография не менялась - берем ее из кэша, иначе просто сбрасываем запись
+        current = cache.get(_profile_cache_key(user_id))
+        if not current or not current["profile"]:
+            invalidate_user_profile_cache(user_id)
+            return
+        profile["bio"] = current["profile"].get("bio", "")
+    
+    _attach_avatar_urls(bucket, profile, refresh=avatar_changed)
+    
+    _cache_profile(user_id, generation, profile, write_through=True)
+
+def _load_user_profile(bucket, user_id):
+    """
+    Загружает профиль пользователя из уже полученного бакета
+    
+    Returns:
+        tuple: (профиль или None, generation объекта user_meta.json)
+    """
+    from google.api_core.exceptions import NotFound
+    
+    # Получаем метаданные пользователя
+    user_meta_blob = bucket.get_blob(f"{user_id}/bio/user_meta.json")
+    
+    if user_meta_blob is None:
+        logger.warning(f"User metadata not found for {user_id}")
+        return None, 0
+    
+    # Загружаем метаданные пользователя
+    user_meta = json.loads(user_meta_blob.download_as_text())
+    
+    # Получаем биографию, если существует
+    try:
+        user_meta["bio"] = bucket.blob(f"{user_id}/bio/bio.txt").download_as_text()
+    except NotFound:
+        user_meta["bio"] = ""
+    
+    # URL аватара, если он существует
+    _attach_avatar_urls(bucket, user_meta)
+    
+    return user_meta, user_meta_blob.generation
+
+def get_user_profile_from_gcs(user_id):
+    """Получает информацию профиля пользователя (через кэш профилей)"""
+    if not user_id:
+        return None
+    return get_user_profiles_from_gcs([user_id]).get(user_id)
+
+def get_user_profiles_from_gcs(user_ids, max_workers=8):
+    """
+    Получает профили нескольких пользователей за один проход.
+    Профили берутся из кэша, недостающие загружаются параллельно
+    через один бакет и кэшируются на PROFILE_CACHE_TTL секунд.
+    
+    Args:
+        user_ids: список ID пользователей (с префиксом @)
+        max_workers: максимальное число параллельных загрузок
         
-        # Получаем биографию, если существует
-        bio_blob = bucket.blob(f"{user_id}/bio/bio.txt")
-        if bio_blob.exists():
-            user_meta["bio"] = bio_blob.download_as_text()
+    Returns:
+        dict: {user_id: profile или None}
+    """
+    unique_ids = list(dict.fromkeys(user_id for user_id in user_ids if user_id))
+    profiles = {user_id: None for user_id in unique_ids}
+    if not unique_ids:
+        return profiles
+    
+    # Сначала берем то, что уже есть в кэше
+    cached = cache.get_many([_profile_cache_key(user_id) for user_id in unique_ids])
+    missing_ids = []
+    for user_id in unique_ids:
+        entry = cached.get(_profile_cache_key(user_id))
+        if entry is None:
+            missing_ids.append(user_id)
         else:
-            user_meta["bio"] = ""
-        
-        # Генерируем URL для аватара, если существует
-        if "avatar_path" in user_meta and user_meta["avatar_path"]:
-            avatar_blob = bucket.blob(user_meta["avatar_path"])
-            if avatar_blob.exists():
-                user_meta["avatar_url"] = avatar_blob.generate_signed_url(
-                    version="v4",
-                    expiration=3600*24,
-                    method="GET"
-                )
-        
-        return user_meta
+            profiles[user_id] = entry["profile"] or None
     
-    except Exception as e:
-        logger.error(f"Error retrieving user profile from GCS: {e}")
-        return None
+    if not missing_ids:
+        return profiles
+    
+    bucket = get_bucket()
+    if not bucket:
+        logger.error(f"Could not get bucket for retrieving user profiles")
+        return profiles
+    
+    def load(user_id):
+        try:
+            profile, generation = _load_user_profile(bucket, user_id)
+            # Ошибки загрузки не кэшируем, чтобы не закрепить временный сбой
+            _cache_profile(user_id, generation, profile)
+            return profile
+        except Exception as e:
+            logger.error(f"Error retrieving user profile {user_id} from GCS: {e}")
+            return None
+    
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(missing_ids))) as executor:
+        for user_id, profile in zip(missing_ids, executor.map(load, missing_ids)):
+            profiles[user_id] = profile
+    
+    return profiles
     
 def cache_video_metadata():
     """
@@ -1067,7 +1688,133 @@ def get_cached_metadata(limit=None, offset=0, shuffle=False):
         logger.error(f"Error getting cached metadata: {e}")
         return [], 0
     
-def get_video_url_with_quality(user_id, video_id, quality=None, expiration_time=3600):
+# Сегменты HLS/DASH лежат в приватном бакете, поэтому манифесты отдаются
+# через /api/stream/ с подписанными URL сегментов вместо относительных путей.
+# Подпись живет дольше кэша манифеста, чтобы хватило на длинную лекцию.
+STREAM_URL_TTL = 12 * 3600
+STREAM_MANIFEST_CACHE_TTL = 3600
+STREAM_MANIFEST_CACHE_PREFIX = "stream_manifest:"
+
+def _sign_media_playlist(text, sign):
+    lines = []
+    for line in text.splitlines():
+        if line.startswith('#EXT-X-MAP:'):
+            line = re.sub(r'URI="([^"]+)"', lambda match: f'URI="{sign(match.group(1))}"', line)
+        elif line and not line.startswith('#'):
+            line = sign(line)
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+def get_stream_manifest(user_id, video_id, name):
+    """
+    Returns a streaming manifest of the video with signed segment URLs
+    
+    Args:
+        name (str): path inside the package, e.g. 'master.m3u8',
+                    '720p/index.m3u8' or 'manifest.mpd'
+    
+    Returns:
+        tuple: (manifest text, content type), None if there is no such manifest
+    """
+    metadata = get_video_metadata(user_id, video_id)
+    streaming = (metadata or {}).get('streaming')
+    if not streaming:
+        return None
+    
+    media_playlists = {variant['playlist'] for variant in streaming.get('variants', {}).values()}
+    if streaming.get('audio'):
+        media_playlists.add(streaming['audio'])
+    if name not in media_playlists and name not in (streaming.get('hls'), streaming.get('dash')):
+        return None
+    
+    # packaged_at в ключе: после перекодирования старые подписи не отдаются
+    key = f"{STREAM_MANIFEST_CACHE_PREFIX}{user_id}/{video_id}/{streaming.get('packaged_at')}/{name}"
+    manifest = cache.get(key)
+    if manifest:
+        return manifest
+    
+    bucket = get_bucket()
+    if not bucket:
+        logger.error(f"Could not get bucket for streaming manifest of {video_id}")
+        return None
+    
+    blob = bucket.get_blob(streaming['prefix'] + name)
+    if blob is None:
+        logger.error(f"Streaming manifest {name} not found for video {video_id}")
+        return None
+    text = blob.download_as_text()
+    base_path = posixpath.dirname(streaming['prefix'] + name)
+    
+    def sign(uri):
+        return bucket.blob(posixpath.normpath(posixpath.join(base_path, uri))).generate_signed_url(
+            version="v4",
+            expiration=STREAM_URL_TTL,
+            method="GET"
+        )
+    
+    if name == streaming.get('hls'):
+        # Относительные пути плейлистов качеств ведут обратно в /api/stream/
+        manifest = (text, 'application/vnd.apple.mpegurl')
+    elif name == streaming.get('dash'):
+        text = re.sub(
+            r'(media|sourceURL)="([^"]+)"',
+            lambda match: f'{match.group(1)}="{xml_escape(sign(match.group(2)))}"',
+            text
+        )
+        manifest = (text, 'application/dash+xml')
+    else:
+        manifest = (_sign_media_playlist(text, sign), 'application/vnd.apple.mpegurl')
+    
+    cache.set(key, manifest, STREAM_MANIFEST_CACHE_TTL)
+    return manifest
+
+def get_scrub_previews(user_id, video_id):
+    """
+    Returns the WebVTT thumbnails track of the video with signed sprite sheet URLs
+    
+    Returns:
+        str: the track, None if the video has no previews
+    """
+    metadata = get_video_metadata(user_id, video_id)
+    previews = (metadata or {}).get('scrub_previews')
+    if not previews:
+        return None
+    
+    # URL листов одинаковы, пока трек в кэше, - браузер берет листы из своего кэша
+    key = f"{STREAM_MANIFEST_CACHE_PREFIX}{user_id}/{video_id}/{previews.get('generated_at')}/{previews['vtt']}"
+    track = cache.get(key)
+    if track:
+        return track
+    
+    bucket = get_bucket()
+    if not bucket:
+        logger.error(f"Could not get bucket for scrub previews of {video_id}")
+        return None
+    
+    blob = bucket.get_blob(previews['prefix'] + previews['vtt'])
+    if blob is None:
+        logger.error(f"Scrub previews track not found for video {video_id}")
+        return None
+    
+    signed = {
+        sheet: bucket.blob(previews['prefix'] + sheet).generate_signed_url(
+            version="v4",
+            expiration=STREAM_URL_TTL,
+            method="GET"
+        )
+        for sheet in previews.get('sheets', [])
+    }
+    track = re.sub(
+        r'^([^#\s]+)(#xywh=)',
+        lambda match: f"{signed.get(match.group(1), match.group(1))}{match.group(2)}",
+        blob.download_as_text(),
+        flags=re.MULTILINE
+    )
+    
+    cache.set(key, track, STREAM_MANIFEST_CACHE_TTL)
+    return track
+
+def get_video_url_with_quality(user_id, video_id, quality=None, expiration_time=3600, manifest=None):
     """
     Generates a temporary URL for a video with specified quality
     
@@ -1077,6 +1824,9 @@ def get_video_url_with_quality(user_id, video_id, quality=None, expiration_time=
         quality (str, optional): Video quality (e.g., '480p', '720p', '1080p')
                                  If None, return highest available quality
         expiration_time (int): URL expiration time in seconds
+        manifest (str, optional): 'hls' or 'dash' - return the adaptive
+                                  streaming manifest URL instead of a single
+                                  quality, if the video has been packaged
     
     Returns:
         dict: Information about the URL and available qualities
@@ -1091,6 +1841,17 @@ def get_video_url_with_quality(user_id, video_id, quality=None, expiration_time=
     quality_variants = metadata.get('quality_variants', {})
     available_qualities = metadata.get('available_qualities', [])
     
+    # Manifest mode: the player picks the quality itself (see get_stream_manifest)
+    streaming = metadata.get('streaming') or {}
+    if manifest in ('hls', 'dash') and streaming.get(manifest):
+        from django.urls import reverse
+        return {
+            'url': reverse('stream_manifest', args=[f"{user_id}__{video_id}", streaming[manifest]]),
+            'quality': 'auto',
+            'available_qualities': list(streaming.get('variants', {})),
+            'manifest': manifest
+        }
+    
     # If no quality variants, return the original URL
     if not quality_variants:
         original_url = generate_video_url(user_id, video_id, expiration_time=expiration_time)
@@ -1172,6 +1933,52 @@ def get_video_url_with_quality(user_id, video_id, quality=None, expiration_time=
             'available_qualities': ['original'] + available_qualities
         }
 
+def process_stored_video_qualities(user_id, video_id, video_path, progress_callback=None, threads=None, media_info=None,
+                                   bucket=None):
+    """
+    Создает варианты качества для видео, которое уже лежит в хранилище.
+    ffmpeg работает с локальным файлом, поэтому оригинал скачивается один
+    раз во временный файл, который удаляется после обработки.
+    media_info - метаданные видео с полями probe_media (повторно не проверяются).
+    bucket - уже открытый бакет (пакетная обработка не создает клиент на каждое видео).
+    
+    Returns:
+        dict: созданные варианты качества (пустой, если ни один пресет не подходит),
+        None если оригинал недоступен
+    
+    Ошибки кодирования и загрузки (QualityProcessingError) передаются вызывающему:
+    задача очереди повторяется, а не завершается без вариантов.
+    """
+    import tempfile
+    from .video_quality import create_quality_variants
+    
+    if not bucket:
+        bucket = get_bucket()
+        if not bucket:
+            logger.error(f"Could not get bucket for quality processing of {video_id}")
+            return None
+    
+    fd, local_path = tempfile.mkstemp(suffix=os.path.splitext(video_path)[1])
+    os.close(fd)
+    try:
+        bucket.blob(video_path).download_to_filename(local_path)
+    except Exception as e:
+        logger.error(f"Error downloading {video_path} for quality processing: {e}")
+        return None
+    try:
+        quality_variants = create_quality_variants(
+            local_path, user_id, video_id, progress_callback=progress_callback, threads=threads,
+            media_info=media_info, bucket=bucket
+        ) or {}
+        if quality_variants:
+            # Видео с тем же содержимым получают те же варианты без повторного кодирования
+            from .content_index import propagate_renditions
+            propagate_renditions(user_id, video_id, get_video_metadata(user_id, video_id, bucket=bucket) or {}, bucket)
+        return quality_variants
+    finally:
+        if os.path.exists(local_path):
+            os.remove(local_path)
+
 def upload_video_with_quality_processing(user_id, video_file_path, title=None, description=None, process_qualities=True):
     """
     Uploads video to storage and creates quality variants
@@ -1193,24 +2000,19 @@ def upload_video_with_quality_processing(user_id, video_file_path, title=None, d
         logger.error(f"Failed to upload original video, canceling quality processing")
         return video_id
     
-    # Now process different quality variants if requested
+    # Now queue different quality variants if requested (see main.transcode_queue)
     if process_qualities:
         try:
-            # Import video quality processing functionality
-            from .video_quality import create_quality_variants
-            
-            logger.info(f"Starting quality variant creation for video {video_id}")
-            
-            # Create quality variants synchronously
-            quality_variants = create_quality_variants(video_file_path, user_id, video_id)
+            from .content_index import enqueue_transcode_once
             
-            if quality_variants:
-                logger.info(f"Successfully created {len(quality_variants)} quality variants for video {video_id}")
+            metadata = get_video_metadata(user_id, video_id)
+            if metadata and metadata.get('file_path'):
+                enqueue_transcode_once(user_id, video_id, metadata['file_path'])
             else:
-                logger.warning(f"No quality variants created for video {video_id}")
+                logger.error(f"No stored file path for video {video_id}, quality processing not queued")
         
         except Exception as e:
-            logger.error(f"Error processing quality variants: {str(e)}")
+            logger.error(f"Error queueing quality variants: {str(e)}")
             # Continue since the original video was uploaded successfully
     else:
         logger.info(f"Quality processing skipped for video {video_id} as requested")
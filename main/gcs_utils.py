@@ -1,7 +1,7 @@
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from .gcs_storage import init_gcs_client, get_bucket, BUCKET_NAME, update_user_profile_in_gcs
+from .gcs_storage import init_gcs_client, get_bucket, BUCKET_NAME, update_user_profile_in_gcs, invalidate_user_profile_cache
 import logging
 import os
 from django.conf import settings
@@ -74,6 +74,9 @@ def create_user_folder_structure(username):
         else:
             logger.warning(f"Default avatar file not found at {default_avatar_path}")
         
+        # Профиль мог быть закэширован как отсутствующий
+        invalidate_user_profile_cache(username)
+        
         logger.info(f"Successfully created folder structure for user {username}")
         return True
         
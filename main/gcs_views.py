@@ -1,14 +1,20 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
+from django.urls import reverse
 from django.contrib import messages
-from .models import Category, Video, VideoView
+from .models import Category, Video, VideoView, UploadSession
 from django.db import transaction
 from django.views.decorators.http import require_http_methods
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.conf import settings
 import os
+from .realtime import publish_video_event
+from .upload_handlers import GCSStreamingUploadHandler, GCSUploadedFile
+from . import resumable_uploads
 from .gcs_storage import update_video_metadata, upload_video_with_quality_processing, get_video_metadata, upload_thumbnail, generate_video_url, get_video_url_with_quality, BUCKET_NAME
 import uuid
+import json
 import logging
 logger = logging.getLogger(__name__)
 
@@ -21,15 +27,56 @@ from .gcs_storage import (
     delete_video,
     get_bucket,
     BUCKET_NAME,
-    get_user_profile_from_gcs
+    get_user_profile_from_gcs,
+    get_thumbnail_urls,
+    register_uploaded_video,
+    create_auto_thumbnail
 )
+from .transcode_queue import get_latest_job, job_status
+from .content_index import enqueue_transcode_once
 
-@login_required
+def _user_storage_id(user):
+    """GCS user ID (with @ prefix) of a Django user"""
+    return user.username if user.username.startswith('@') else f"@{user.username}"
+
+def _discard_streamed_upload(video_file):
+    """Deletes an object streamed by GCSStreamingUploadHandler for a rejected upload"""
+    if not isinstance(video_file, GCSUploadedFile):
+        return
+    try:
+        bucket = get_bucket()
+        if bucket:
+            bucket.blob(video_file.gcs_path).delete()
+    except Exception as e:
+        logger.error(f"Error deleting streamed upload {video_file.gcs_path}: {e}")
+
+@csrf_exempt
 @require_http_methods(["POST"])
 def upload_video_to_gcs(request):
     """
     Handler for uploading videos to Google Cloud Storage with quality processing
+    
+    The video body is streamed into GCS while the request is read (see
+    main.upload_handlers), so the handler has to be installed before
+    request.POST is touched - CSRF is therefore checked in the inner view.
+    A streamed object that does not end up registered as a video (CSRF
+    failure, invalid form, any error) is deleted.
     """
+    # Anonymous requests are rejected before anything is streamed into storage
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+    
+    handler = GCSStreamingUploadHandler(request, _user_storage_id(request.user))
+    request.upload_handlers.insert(0, handler)
+    try:
+        return _upload_video_to_gcs(request)
+    finally:
+        if handler.uploaded_file is not None and not handler.uploaded_file.video_id:
+            _discard_streamed_upload(handler.uploaded_file)
+
+@csrf_protect
+def _upload_video_to_gcs(request):
+    temp_video_path = None
     try:
         # Get files and data from request
         video_file = request.FILES.get('video_file')
@@ -42,44 +89,49 @@ def upload_video_to_gcs(request):
         if not video_file or not title:
             return JsonResponse({'error': 'Video and title are required'}, status=400)
         
-        # Create temp directory if it doesn't exist
+        # Temp directory for files spooled locally (thumbnail, video fallback)
         temp_dir = os.path.join(settings.MEDIA_ROOT, 'temp')
         os.makedirs(temp_dir, exist_ok=True)
         
         # Get username for GCS storage (preserve @ prefix)
-        username = request.user.username
-        user_id = f"@{username}" if not username.startswith('@') else username
-        
-        # Temporarily save video file on server
-        temp_video_path = os.path.join(temp_dir, f"{uuid.uuid4()}_{video_file.name}")
-        with open(temp_video_path, 'wb+') as destination:
-            for chunk in video_file.chunks():
-                destination.write(chunk)
-        
-        # Upload video to GCS with quality processing directly
-        video_id = upload_video_with_quality_processing(
-            user_id=user_id,
-            video_file_path=temp_video_path,
-            title=title,
-            description=description,
-            process_qualities=process_qualities  # This will handle quality processing synchronously
-        )
+        user_id = _user_storage_id(request.user)
+        
+        if isinstance(video_file, GCSUploadedFile):
+            # Video is already in storage: create metadata, transcoding is queued for transcode_worker
+            # (a re-upload of stored content shares its original and renditions instead)
+            video_id = register_uploaded_video(
+                user_id, video_file.gcs_path, title=title, description=description, sha256=video_file.sha256
+            )
+            video_file.video_id = video_id
+            if video_id and process_qualities:
+                enqueue_transcode_once(user_id, video_id, video_file.gcs_path, source_size=video_file.size)
+        else:
+            # Storage was unavailable when the upload started - the file was spooled locally
+            temp_video_path = os.path.join(temp_dir, f"{uuid.uuid4()}_{video_file.name}")
+            with open(temp_video_path, 'wb+') as destination:
+                for chunk in video_file.chunks():
+                    destination.write(chunk)
+            
+            # Upload video to GCS with quality processing directly
+            video_id = upload_video_with_quality_processing(
+                user_id=user_id,
+                video_file_path=temp_video_path,
+                title=title,
+                description=description,
+                process_qualities=process_qualities  # Quality variants are queued, not encoded here
+            )
         
         # If video upload failed
         if not video_id:
-            if os.path.exists(temp_video_path):
-                os.remove(temp_video_path)
             return JsonResponse({'error': 'Failed to upload video to Google Cloud Storage'}, status=500)
         
         # Get the GCS path of the uploaded video
         metadata = get_video_metadata(user_id, video_id)
         if not metadata or 'file_path' not in metadata:
-            if os.path.exists(temp_video_path):
-                os.remove(temp_video_path)
             return JsonResponse({'error': 'Failed to retrieve video metadata'}, status=500)
         
         # Handle thumbnail if present
-        thumbnail_url = None
+        thumbnail_urls = {}
         if thumbnail:
             temp_thumbnail_path = os.path.join(temp_dir, f"{uuid.uuid4()}_{thumbnail.name}")
             with open(temp_thumbnail_path, 'wb+') as destination:
@@ -90,20 +142,14 @@ def upload_video_to_gcs(request):
             
             if os.path.exists(temp_thumbnail_path):
                 os.remove(temp_thumbnail_path)
-                
-            if thumbnail_success:
-                metadata = get_video_metadata(user_id, video_id)
-                if metadata and "thumbnail_path" in metadata:
-                    thumbnail_url = generate_video_url(
-                        user_id, 
-                        video_id, 
-                        file_path=metadata["thumbnail_path"], 
-                        expiration_time=3600
-                    )
+        else:
+            # Без загруженной миниатюры берется лучший кадр самого видео
+            thumbnail_success = create_auto_thumbnail(user_id, video_id, temp_video_path, metadata)
         
-        # Delete temp video file
-        if os.path.exists(temp_video_path):
-            os.remove(temp_video_path)
+        if thumbnail_success:
+            metadata = get_video_metadata(user_id, video_id)
+            if metadata:
+                thumbnail_urls = get_thumbnail_urls(user_id, video_id, metadata)
         
         # Get updated metadata for uploaded video
         video_metadata = get_video_metadata(user_id, video_id)
@@ -118,8 +164,8 @@ def upload_video_to_gcs(request):
                 video_metadata['quality'] = video_url_info['quality']
                 video_metadata['available_qualities'] = video_url_info['available_qualities']
             
-            if thumbnail_url:
-                video_metadata['thumbnail_url'] = thumbnail_url
+            if thumbnail_urls.get('thumbnail_url'):
+                video_metadata.update(thumbnail_urls)
                 
             # Create or update Video object in database
             try:
@@ -149,12 +195,159 @@ def upload_video_to_gcs(request):
             'success': True,
             'video_id': video_id,
             'metadata': video_metadata,
-            'processing_qualities': process_qualities
+            'processing_qualities': process_qualities,
+            'processing_status_url': f"/api/processing-status/{user_id}__{video_id}/" if process_qualities else None
         })
         
     except Exception as e:
         logger.error(f"Error uploading video: {str(e)}")
         return JsonResponse({'error': str(e)}, status=500)
+    finally:
+        # Delete temp video file
+        if temp_video_path and os.path.exists(temp_video_path):
+            os.remove(temp_video_path)
+
+def _upload_session_response(session, status=200, extra=None):
+    """JSON + tus headers describing an upload session"""
+    response = JsonResponse({
+        **(extra or {}),
+        'success': True,
+        'upload_id': str(session.id),
+        'upload_url': f"/api/uploads/{session.id}/",
+        'offset': session.upload_offset,
+        'length': session.upload_length,
+        'chunk_size': resumable_uploads.CHUNK_SIZE,
+        'status': session.status,
+        # Составной ID, как в остальных API
+        'video_id': f"{session.gcs_path.split('/', 1)[0]}__{session.video_id}" if session.video_id else None,
+        'error': session.error or None,
+    }, status=status)
+    response['Tus-Resumable'] = '1.0.0'
+    response['Upload-Offset'] = str(session.upload_offset)
+    response['Upload-Length'] = str(session.upload_length)
+    response['Cache-Control'] = 'no-store'
+    return response
+
+@login_required
+@require_http_methods(["POST"])
+def create_upload_session(request, direct=False):
+    """
+    Starts a resumable upload: {file_name, size, content_type} -> upload URL
+    
+    The file is then sent in PATCH requests to the upload URL
+    (see main.resumable_uploads for the protocol). With direct=True
+    (/api/uploads/direct/) the response also has session_url - the GCS
+    session the client uploads to without going through Django.
+    """
+    try:
+        data = json.loads(request.body)
+        session = resumable_uploads.create_session(
+            request.user,
+            _user_storage_id(request.user),
+            data.get('file_name'),
+            int(data.get('size') or 0),
+            data.get('content_type'),
+            origin=(request.headers.get('Origin') or f"{request.scheme}://{request.get_host()}") if direct else None
+        )
+        # Сам session URI работает как подписанная ссылка: выдается только владельцу после проверок
+        extra = {'session_url': session.session_url} if direct else None
+        response = _upload_session_response(session, status=201, extra=extra)
+        response['Location'] = f"/api/uploads/{session.id}/"
+        return response
+    except resumable_uploads.UploadError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=e.status)
+    except (ValueError, TypeError):
+        return JsonResponse({'success': False, 'error': 'Invalid request data'}, status=400)
+    except Exception as e:
+        logger.error(f"Error creating upload session: {str(e)}")
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+@login_required
+@require_http_methods(["HEAD", "GET", "PATCH", "DELETE"])
+def upload_session(request, upload_id):
+    """
+    HEAD/GET - committed offset and processing status (used to resume and poll)
+    PATCH - appends the request body at the Upload-Offset header
+    DELETE - cancels the upload
+    """
+    try:
+        session = UploadSession.objects.get(id=upload_id, user=request.user)
+    except UploadSession.DoesNotExist:
+        return JsonResponse({'success': False, 'error': 'Upload not found'}, status=404)
+    
+    try:
+        if request.method in ('HEAD', 'GET'):
+            resumable_uploads.sync_offset(session)
+            return _upload_session_response(session)
+        
+        if request.method == 'DELETE':
+            resumable_uploads.abort_session(session)
+            return JsonResponse({'success': True})
+        
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+            length = int(request.headers.get('Content-Length', ''))
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Upload-Offset and Content-Length are required'}, status=400)
+        
+        # Тело читается потоком: request.body загрузил бы весь фрагмент в память
+        resumable_uploads.write_chunk(session, offset, request, length)
+        return _upload_session_response(session)
+    except resumable_uploads.UploadError as e:
+        response = JsonResponse({'success': False, 'error': str(e)}, status=e.status)
+        response['Upload-Offset'] = str(session.upload_offset)
+        return response
+    except Exception as e:
+        logger.error(f"Error handling upload {upload_id}: {str(e)}")
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+@login_required
+@require_http_methods(["POST"])
+def finalize_upload_session(request, upload_id):
+    """
+    Completes a resumable upload: stores the form fields (title,
+    description, category, process_qualities, thumbnail) and queues the
+    video for registration by transcode_worker. Answers 202; poll the
+    upload URL until the status is complete, then /api/processing-status/
+    for transcoding.
+    """
+    try:
+        session = UploadSession.objects.get(id=upload_id, user=request.user)
+    except UploadSession.DoesNotExist:
+        return JsonResponse({'success': False, 'error': 'Upload not found'}, status=404)
+    
+    temp_thumbnail_path = None
+    try:
+        title = request.POST.get('title')
+        description = request.POST.get('description', '')
+        process_qualities = request.POST.get('process_qualities', 'true').lower() == 'true'
+        thumbnail = request.FILES.get('thumbnail')
+        
+        if not title:
+            return JsonResponse({'success': False, 'error': 'Title is required'}, status=400)
+        
+        if thumbnail:
+            temp_dir = os.path.join(settings.MEDIA_ROOT, 'temp')
+            os.makedirs(temp_dir, exist_ok=True)
+            temp_thumbnail_path = os.path.join(temp_dir, f"{uuid.uuid4()}_{os.path.basename(thumbnail.name)}")
+            with open(temp_thumbnail_path, 'wb+') as destination:
+                for chunk in thumbnail.chunks():
+                    destination.write(chunk)
+        
+        resumable_uploads.finalize_session(
+            session, title, description,
+            process_qualities=process_qualities,
+            thumbnail_path=temp_thumbnail_path
+        )
+        return _upload_session_response(session, status=202)
+    except resumable_uploads.UploadError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=e.status)
+    except Exception as e:
+        logger.error(f"Error finalizing upload {upload_id}: {str(e)}")
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+    finally:
+        if temp_thumbnail_path and os.path.exists(temp_thumbnail_path):
+            os.remove(temp_thumbnail_path)
 
 
 def list_all_videos(request):
@@ -210,14 +403,8 @@ def list_all_videos(request):
                 metadata_prefix = f"{user_id}/metadata/"
                 metadata_blobs = list(bucket.list_blobs(prefix=metadata_prefix))
                 
-                # Get user profile for display name
-                user_profile = None
-                try:
-                    user_meta_blob = bucket.blob(f"{user_id}/bio/user_meta.json")
-                    if user_meta_blob.exists():
-                        user_profile = json.loads(user_meta_blob.download_as_text())
-                except Exception as profile_error:
-                    logger.error(f"Error loading profile for {user_id}: {profile_error}")
+                # Get user profile for display name (served from the profile cache)
+                user_profile = get_user_profile_from_gcs(user_id)
                 
                 # Process all metadata JSON files for videos
                 for blob in metadata_blobs:
@@ -297,10 +484,7 @@ def list_all_videos(request):
                         video['url'] = generate_video_url(user_id, video_id, expiration_time=3600)
                         
                         # URL for thumbnail
-                        if 'thumbnail_path' in video:
-                            video['thumbnail_url'] = generate_video_url(
-                                user_id, video_id, file_path=video['thumbnail_path'], expiration_time=3600
-                            )
+                        video.update(get_thumbnail_urls(user_id, video_id, video))
                 except Exception as url_error:
                     logger.error(f"Error generating URL for video {video.get('video_id')}: {url_error}")
         
@@ -445,10 +629,7 @@ def list_user_videos(request, username=None):
                         video['url'] = generate_video_url(username, video_id, expiration_time=3600)
                         
                         # URL for thumbnail
-                        if 'thumbnail_path' in video:
-                            video['thumbnail_url'] = generate_video_url(
-                                username, video_id, file_path=video['thumbnail_path'], expiration_time=3600
-                            )
+                        video.update(get_thumbnail_urls(username, video_id, video))
                 except Exception as url_error:
                     logger.error(f"Error generating URL for video {video.get('video_id')}: {url_error}")
         
@@ -585,6 +766,10 @@ def get_video_url(request, video_id):
     - thumbnail: if 'true', returns thumbnail URL instead of video
     - user_id: ID of the user who owns the video (optional)
     - quality: Video quality to retrieve (e.g., '480p', '720p', '1080p')
+    - manifest: 'hls' or 'dash' to get the adaptive streaming manifest URL
+    
+    Video responses include previews_url, the WebVTT thumbnails track for
+    seek bar previews, when the video has one.
     """
     try:
         # Check if specific user_id is provided in query parameters
@@ -600,6 +785,7 @@ def get_video_url(request, video_id):
             
         is_thumbnail = request.GET.get('thumbnail', 'false').lower() == 'true'
         quality = request.GET.get('quality')  # New parameter for quality selection
+        manifest = request.GET.get('manifest')
         
         # Get video metadata
         from .gcs_storage import get_video_metadata, generate_video_url, get_video_url_with_quality
@@ -609,27 +795,32 @@ def get_video_url(request, video_id):
             return JsonResponse({'error': 'Video metadata not found'}, status=404)
         
         if is_thumbnail:
-            thumbnail_path = metadata.get('thumbnail_path')
-            if not thumbnail_path:
+            thumbnail_urls = get_thumbnail_urls(user_id, video_id, metadata)
+            if not thumbnail_urls:
                 return JsonResponse({'error': 'Video has no thumbnail'}, status=404)
                 
-            url = generate_video_url(user_id, video_id, file_path=thumbnail_path, expiration_time=3600)
-            if url:
+            if thumbnail_urls['thumbnail_url']:
                 return JsonResponse({
                     'success': True,
-                    'url': url,
+                    'url': thumbnail_urls['thumbnail_url'],
+                    'srcset': thumbnail_urls['thumbnail_srcset'],
                     'is_thumbnail': True
                 })
         else:
             # Generate URL for video with quality selection
-            video_url_info = get_video_url_with_quality(user_id, video_id, quality, expiration_time=3600)
+            video_url_info = get_video_url_with_quality(user_id, video_id, quality, expiration_time=3600, manifest=manifest)
             
             if video_url_info and video_url_info['url']:
+                previews_url = None
+                if metadata.get('scrub_previews'):
+                    previews_url = reverse('scrub_previews', args=[f"{user_id}__{video_id}"])
                 return JsonResponse({
                     'success': True,
                     'url': video_url_info['url'],
                     'quality': video_url_info['quality'],
                     'available_qualities': video_url_info['available_qualities'],
+                    'manifest': video_url_info.get('manifest'),
+                    'previews_url': previews_url,
                     'is_thumbnail': False
                 })
         
@@ -639,6 +830,61 @@ def get_video_url(request, video_id):
         logger.error(f"Error generating URL: {str(e)}")
         return JsonResponse({'error': str(e)}, status=500)
 
+@require_http_methods(["GET"])
+def stream_manifest(request, video_id, name):
+    """
+    HLS/DASH manifest of a video with signed segment URLs
+    
+    Args:
+        video_id: составной ID пользователь__видео
+        name: путь манифеста в пакете (master.m3u8, 720p/index.m3u8, manifest.mpd)
+    """
+    try:
+        if '__' not in video_id:
+            return JsonResponse({'error': 'Expected a user__video ID'}, status=400)
+        user_id, gcs_video_id = video_id.split('__', 1)
+        
+        from .gcs_storage import get_stream_manifest, STREAM_MANIFEST_CACHE_TTL
+        manifest = get_stream_manifest(user_id, gcs_video_id, name)
+        if not manifest:
+            return JsonResponse({'error': 'Manifest not found'}, status=404)
+        
+        text, content_type = manifest
+        response = HttpResponse(text, content_type=content_type)
+        # Подписи в манифесте действуют дольше, чем его можно кэшировать
+        response['Cache-Control'] = f'private, max-age={STREAM_MANIFEST_CACHE_TTL}'
+        return response
+    
+    except Exception as e:
+        logger.error(f"Error serving streaming manifest {name} for {video_id}: {str(e)}")
+        return JsonResponse({'error': str(e)}, status=500)
+
+@require_http_methods(["GET"])
+def scrub_previews(request, video_id):
+    """
+    WebVTT thumbnails track for seek bar previews, with signed sprite sheet URLs
+    
+    Args:
+        video_id: составной ID пользователь__видео
+    """
+    try:
+        if '__' not in video_id:
+            return JsonResponse({'error': 'Expected a user__video ID'}, status=400)
+        user_id, gcs_video_id = video_id.split('__', 1)
+        
+        from .gcs_storage import get_scrub_previews, STREAM_MANIFEST_CACHE_TTL
+        track = get_scrub_previews(user_id, gcs_video_id)
+        if not track:
+            return JsonResponse({'error': 'Previews not found'}, status=404)
+        
+        response = HttpResponse(track, content_type='text/vtt')
+        response['Cache-Control'] = f'private, max-age={STREAM_MANIFEST_CACHE_TTL}'
+        return response
+    
+    except Exception as e:
+        logger.error(f"Error serving scrub previews for {video_id}: {str(e)}")
+        return JsonResponse({'error': str(e)}, status=500)
+
 @require_http_methods(["GET"])
 def get_thumbnail_url(request, video_id):
     """
@@ -667,17 +913,16 @@ def get_thumbnail_url(request, video_id):
         if not metadata:
             return JsonResponse({'error': 'Метаданные видео не найдены'}, status=404)
         
-        # Генерируем URL для миниатюры
-        thumbnail_path = metadata.get('thumbnail_path')
-        if not thumbnail_path:
+        # Генерируем URL для миниатюры: JPEG для src и WebP srcset, если есть производные
+        thumbnail_urls = get_thumbnail_urls(user_id, gcs_video_id, metadata)
+        if not thumbnail_urls:
             return JsonResponse({'error': 'У видео нет миниатюры'}, status=404)
-            
-        url = generate_video_url(user_id, gcs_video_id, file_path=thumbnail_path, expiration_time=3600)
         
-        if url:
+        if thumbnail_urls['thumbnail_url']:
             return JsonResponse({
                 'success': True,
-                'url': url
+                'url': thumbnail_urls['thumbnail_url'],
+                'srcset': thumbnail_urls['thumbnail_srcset']
             })
         else:
             return JsonResponse({'error': 'Не удалось сгенерировать URL миниатюры'}, status=400)
@@ -686,6 +931,43 @@ def get_thumbnail_url(request, video_id):
         logger.error(f"Error generating thumbnail URL: {str(e)}")
         return JsonResponse({'error': str(e)}, status=500)
 
+@login_required
+@require_http_methods(["GET"])
+def processing_status(request, video_id):
+    """
+    Progress of quality processing for one of the current user's videos
+    
+    status: queued | running | done | failed, or none if nothing was queued
+    """
+    try:
+        owner_id = _user_storage_id(request.user)
+        user_id = owner_id
+        if '__' in video_id:
+            user_id, video_id = video_id.split('__', 1)
+        
+        if user_id != owner_id:
+            return JsonResponse({'success': False, 'error': 'Video not found'}, status=404)
+        
+        job = get_latest_job(user_id, video_id)
+        status = job_status(job) if job else {'status': 'none', 'progress': 0}
+        
+        if not job or job.status == job.STATUS_DONE:
+            metadata = get_video_metadata(user_id, video_id)
+            if not metadata:
+                return JsonResponse({'success': False, 'error': 'Video not found'}, status=404)
+            status['available_qualities'] = metadata.get('available_qualities', [])
+            if not job and metadata.get('quality_variants'):
+                # Обработано до появления очереди
+                status.update(status='done', progress=1.0)
+        
+        response = JsonResponse({'success': True, 'video_id': f"{user_id}__{video_id}", **status})
+        response['Cache-Control'] = 'no-store'
+        return response
+    
+    except Exception as e:
+        logger.error(f"Error getting processing status: {str(e)}")
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
 @login_required
 @require_http_methods(["GET"])
 def refresh_metadata_cache(request):
@@ -827,7 +1109,7 @@ def add_comment(request):
         user_profile = get_user_profile_from_gcs(username)
         avatar_url = user_profile.get('avatar_url', None) if user_profile else None
         
-        success = add_comment(
+        new_comment = add_comment(
             user_id=video_owner_id,  # Use the determined video owner ID
             video_id=actual_video_id,  # Use the actual video ID (without user prefix)
             comment_user_id=username,
@@ -836,25 +1118,13 @@ def add_comment(request):
             avatar_url=avatar_url  # Добавляем URL аватара в комментарий
         )
         
-        if not success:
+        if not new_comment:
             logger.error(f"Failed to add comment to video {actual_video_id} for owner {video_owner_id}")
             return JsonResponse({'success': False, 'error': 'Не удалось добавить комментарий'}, status=500)
         
-        # Return success response with comment data
-        import uuid
-        from datetime import datetime
-        
-        # В ответе также включаем URL аватара
-        comment_data = {
-            'id': str(uuid.uuid4()),  # Generate random ID for now (GCS should return real ID)
-            'user_id': username,
-            'display_name': display_name,
-            'text': text,
-            'date': datetime.now().isoformat(),
-            'likes': 0,
-            'replies': [],
-            'avatar_url': avatar_url  # Добавляем URL аватара в ответ
-        }
+        # Return success response with the stored comment (real ID, avatar URL included)
+        comment_data = dict(new_comment, avatar_url=avatar_url)
+        publish_video_event(video_owner_id, actual_video_id, 'comment', dict(comment_data, reply_count=0))
         
         logger.info(f"Comment successfully added")
         return JsonResponse({'success': True, 'comment': comment_data})
@@ -968,7 +1238,7 @@ def add_reply(request):
         avatar_url = user_profile.get('avatar_url', None) if user_profile else None
         
         # Add reply
-        success = add_reply(
+        new_reply = add_reply(
             user_id=video_owner_id,  # Use the determined video owner ID
             video_id=actual_video_id,  # Use the actual video ID (without user prefix)
             comment_id=comment_id,
@@ -978,22 +1248,13 @@ def add_reply(request):
             avatar_url=avatar_url  # Добавляем URL аватара
         )
         
-        if not success:
+        if not new_reply:
             logger.error(f"Failed to add reply to comment {comment_id} on video {actual_video_id}")
             return JsonResponse({'success': False, 'error': 'Не удалось добавить ответ'}, status=500)
         
-        # Return success response with reply data
-        import uuid
-        from datetime import datetime
-        reply_data = {
-            'id': str(uuid.uuid4()),  # Generate random ID for now
-            'user_id': username,
-            'display_name': display_name,
-            'text': text,
-            'date': datetime.now().isoformat(),
-            'likes': 0,
-            'avatar_url': avatar_url  # Добавляем URL аватара
-        }
+        # Return success response with the stored reply
+        reply_data = dict(new_reply, avatar_url=avatar_url)
+        publish_video_event(video_owner_id, actual_video_id, 'reply', {'comment_id': comment_id, 'reply': reply_data})
         
         logger.info(f"Reply successfully added")
         return JsonResponse({'success': True, 'reply': reply_data})
@@ -1072,6 +1333,49 @@ def track_video_view(request):
         logger.error(f"Error tracking view: {str(e)}")
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
 
+@require_http_methods(["POST"])
+def track_player_events_batch(request):
+    """
+    API endpoint for batched player events (view start, heartbeat, quality change, seek).
+    Events are validated in bulk and stored with a single bulk_create;
+    views and watch time are aggregated later by the aggregate_player_events command.
+    """
+    from .player_events import parse_event_batch, build_player_events
+    from .models import PlayerEvent
+
+    try:
+        data, raw_events = parse_event_batch(request)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': f'Invalid payload: {e}'}, status=400)
+
+    try:
+        user = request.user if request.user.is_authenticated else None
+        session_id = data.get('session_id')
+
+        if not user and not session_id:
+            return JsonResponse({'success': False, 'error': 'Session ID required for non-authenticated users'}, status=400)
+
+        events, rejected = build_player_events(
+            raw_events,
+            user=user,
+            session_id=session_id,
+            default_video_id=data.get('video_id'),
+            default_owner=data.get('user_id'),
+        )
+
+        if events:
+            PlayerEvent.objects.bulk_create(events)
+
+        return JsonResponse({
+            'success': True,
+            'accepted': len(events),
+            'rejected': rejected
+        })
+
+    except Exception as e:
+        logger.error(f"Error storing player events: {str(e)}")
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
 def get_client_ip(request):
     """Получает IP-адрес клиента из заголовков запроса"""
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
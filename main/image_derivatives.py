@@ -0,0 +1,167 @@
+"""
+Resized derivatives of uploaded images (video thumbnails and avatars)
+
+Originals are stored as uploaded but pages only load the derivatives: fixed
+widths in WebP and JPEG, with EXIF removed (orientation is applied first) and
+re-encoded at a lower quality until each file fits its size budget.
+
+Templates use the JPEG of the default width as `src` and the WebP widths as
+`srcset`, so old clients without srcset support still get a JPEG.
+
+For thumbnails a tiny preview (LQIP) is also computed: a THUMBNAIL_LQIP_WIDTH
+px WebP inlined as a data URI, which listings show until the real image loads.
+
+Requires Pillow. Without it uploads keep working and pages fall back to the
+original image.
+"""
+import base64
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FORMATS = ('webp', 'jpeg')
+CONTENT_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+# Derivative file names contain a version token, so they never change
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Video cards are ~320 px wide, the player poster up to 1280 px
+THUMBNAIL_WIDTHS = (320, 640, 1280)
+THUMBNAIL_DEFAULT_WIDTH = 640
+THUMBNAIL_SIZE_BUDGET = {320: 25 * 1024, 640: 70 * 1024, 1280: 180 * 1024}
+
+# Avatars are shown at 40 px in lists and up to ~96 px on the channel page
+AVATAR_WIDTHS = (48, 96, 192)
+AVATAR_DEFAULT_WIDTH = 96
+AVATAR_SIZE_BUDGET = {48: 4 * 1024, 96: 10 * 1024, 192: 28 * 1024}
+
+# Qualities tried in turn until the encoded image fits its budget
+QUALITY_STEPS = (82, 74, 66, 58, 50, 42)
+
+# Low quality placeholder: ~150-300 bytes of base64 per video card
+THUMBNAIL_LQIP_WIDTH = 16
+THUMBNAIL_LQIP_QUALITY = 40
+
+
+def _encode(image, image_format, width, budget):
+    """Encodes the image, lowering quality until it fits the budget"""
+    data = b''
+    for quality in QUALITY_STEPS:
+        buffer = io.BytesIO()
+        if image_format == 'webp':
+            image.save(buffer, format='WEBP', quality=quality, method=6)
+        else:
+            image.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True)
+        data = buffer.getvalue()
+        if len(data) <= budget:
+            return data
+
+    logger.warning(f"{image_format} derivative at {width}px is {len(data)} bytes, over budget of {budget}")
+    return data
+
+
+def _load_rgb(source_path, draft_size=None):
+    """
+    Opens an image as RGB with EXIF orientation applied, or returns None.
+    draft_size lets the JPEG decoder downscale while decoding (LQIP only needs
+    a few pixels, decoding a full photo for it would be wasted work).
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        logger.warning("Pillow is not installed, image derivatives are not generated")
+        return None
+
+    try:
+        with Image.open(source_path) as original:
+            if draft_size:
+                original.draft('RGB', draft_size)
+            # Поворачиваем по EXIF до удаления метаданных
+            image = ImageOps.exif_transpose(original)
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                return background
+            return image.convert('RGB')
+    except Exception as e:
+        logger.error(f"Could not decode image {source_path}: {e}")
+        return None
+
+
+def render_derivatives(source_path, widths, size_budget, square=False):
+    """
+    Builds resized copies of an image in every format of IMAGE_FORMATS
+
+    Args:
+        source_path: path to the uploaded image
+        widths: target widths; widths above the source width are skipped
+            (the smallest one is always produced)
+        size_budget: {width: max bytes}
+        square: center-crop to a square (avatars)
+
+    Returns:
+        list: [{'width', 'height', 'format', 'content_type', 'extension', 'data'}],
+        empty if Pillow is not installed or the image cannot be decoded
+    """
+    image = _load_rgb(source_path)
+    if image is None:
+        return []
+
+    from PIL import Image, ImageOps
+
+    if square:
+        side = min(image.size)
+        image = ImageOps.fit(image, (side, side))
+
+    source_width, source_height = image.size
+    targets = [width for width in sorted(widths) if width <= source_width] or [min(widths)]
+
+    derivatives = []
+    for width in targets:
+        height = max(1, round(source_height * width / source_width))
+        # Новое изображение не наследует EXIF/ICC/XMP оригинала
+        resized = image.resize((width, height), Image.LANCZOS)
+        for image_format in IMAGE_FORMATS:
+            derivatives.append({
+                'width': width,
+                'height': height,
+                'format': image_format,
+                'content_type': CONTENT_TYPES[image_format],
+                'extension': EXTENSIONS[image_format],
+                'data': _encode(resized, image_format, width, size_budget[width]),
+            })
+    return derivatives
+
+
+def render_lqip(source_path):
+    """
+    Builds a tiny blurred-looking preview of an image
+
+    Returns:
+        str: data:image/webp;base64,... URI or None if it cannot be built
+    """
+    image = _load_rgb(source_path, draft_size=(THUMBNAIL_LQIP_WIDTH * 8, THUMBNAIL_LQIP_WIDTH * 8))
+    if image is None:
+        return None
+
+    from PIL import Image
+
+    width, height = image.size
+    preview_height = max(1, round(height * THUMBNAIL_LQIP_WIDTH / width))
+    preview = image.resize((THUMBNAIL_LQIP_WIDTH, preview_height), Image.BILINEAR)
+
+    buffer = io.BytesIO()
+    preview.save(buffer, format='WEBP', quality=THUMBNAIL_LQIP_QUALITY)
+    return f"data:image/webp;base64,{base64.b64encode(buffer.getvalue()).decode('ascii')}"
+
+
+def pick_derivative(derivatives, image_format, width):
+    """Smallest derivative of the format at least `width` wide, else the largest one"""
+    candidates = sorted((d for d in derivatives if d['format'] == image_format), key=lambda d: d['width'])
+    for derivative in candidates:
+        if derivative['width'] >= width:
+            return derivative
+    return candidates[-1] if candidates else None
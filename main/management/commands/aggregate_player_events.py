@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+import time
+
+
+class Command(BaseCommand):
+    help = 'Aggregate queued player events into video views and watch time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=5000, help='Maximum number of events to process per run')
+        parser.add_argument('--loop', action='store_true', help='Keep running and aggregate periodically')
+        parser.add_argument('--interval', type=int, default=30, help='Seconds between runs in --loop mode')
+
+    def handle(self, *args, **options):
+        from main.player_events import aggregate_player_events
+
+        limit = options['limit']
+        interval = options['interval']
+
+        while True:
+            result = aggregate_player_events(limit=limit)
+            self.stdout.write(f"Processed {result['events']} events, counted {result['views']} new views")
+
+            if not options['loop']:
+                break
+
+            # Drain the backlog without waiting if the batch was full
+            if result['events'] < limit:
+                time.sleep(interval)
+
+        self.stdout.write(self.style.SUCCESS('Aggregation completed'))
@@ -0,0 +1,133 @@
+from django.core.management.base import BaseCommand, CommandError
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def _children_cpu_seconds():
+    """User + system CPU time of finished child processes (ffmpeg)"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Command(BaseCommand):
+    help = 'Compare per-preset ffmpeg runs with the single-decode multi-rendition encoding'
+
+    def add_arguments(self, parser):
+        parser.add_argument('clips', nargs='*', help='Local video files to benchmark')
+        parser.add_argument('--generate', action='store_true', help='Generate synthetic sample clips with ffmpeg')
+        parser.add_argument('--sizes', default='1920x1080,1280x720', help='Resolutions of generated clips')
+        parser.add_argument('--duration', type=int, default=20, help='Seconds of each generated clip')
+        parser.add_argument('--threads', type=int, default=None, help='ffmpeg threads for both runs (as set by transcode_worker)')
+
+    def handle(self, *args, **options):
+        from main.video_quality import (
+            get_ffmpeg_path, get_video_info, applicable_presets,
+            build_single_rendition_command, build_multi_rendition_command, _run_with_progress, _rendition_ok
+        )
+
+        ffmpeg_path = get_ffmpeg_path()
+        threads = options['threads']
+        work_dir = tempfile.mkdtemp(prefix='transcode-bench-')
+        try:
+            clips = list(options['clips'])
+            if options['generate']:
+                clips += self.generate_clips(ffmpeg_path, work_dir, options['sizes'].split(','), options['duration'])
+            if not clips:
+                raise CommandError('Pass video files or --generate')
+
+            rows = []
+            for clip in clips:
+                info = get_video_info(clip)
+                presets = applicable_presets(info.get('height'))
+                if not presets:
+                    self.stdout.write(self.style.WARNING(f"Skipping {clip}: no presets for {info.get('height')}p"))
+                    continue
+
+                renditions = [
+                    (quality, preset, os.path.join(work_dir, f"out_{quality}.mp4"))
+                    for quality, preset in presets.items()
+                ]
+
+                # Старый способ: отдельный ffmpeg (и отдельное декодирование) на каждый пресет
+                def run_per_preset():
+                    for quality, preset, output_path in renditions:
+                        cmd = build_single_rendition_command(ffmpeg_path, clip, preset, output_path, threads)
+                        subprocess.run(cmd, capture_output=True, check=True)
+
+                def run_single_pass():
+                    returncode, stderr = _run_with_progress(
+                        build_multi_rendition_command(ffmpeg_path, clip, renditions, threads), info.get('duration')
+                    )
+                    if returncode != 0:
+                        raise CommandError(f"Single-pass encoding failed: {stderr}")
+
+                per_preset = self.measure(run_per_preset)
+                single_pass = self.measure(run_single_pass)
+                failed = [
+                    quality for quality, preset, output_path in renditions
+                    if not _rendition_ok(output_path, preset, info.get('duration'))
+                ]
+                rows.append((os.path.basename(clip), info, list(presets), per_preset, single_pass, failed))
+
+            self.report(rows)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def generate_clips(self, ffmpeg_path, work_dir, sizes, duration):
+        """Synthetic clips with motion, detail and a sine audio track"""
+        clips = []
+        for size in sizes:
+            path = os.path.join(work_dir, f"sample_{size}.mp4")
+            cmd = [
+                ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-y',
+                '-f', 'lavfi', '-i', f"testsrc2=size={size}:rate=30:duration={duration}",
+                '-f', 'lavfi', '-i', f"sine=frequency=440:sample_rate=48000:duration={duration}",
+                '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18', '-c:a', 'aac', '-shortest', path
+            ]
+            self.stdout.write(f"Generating {path}")
+            subprocess.run(cmd, check=True)
+            clips.append(path)
+        return clips
+
+    def measure(self, run):
+        cpu_before = _children_cpu_seconds()
+        started = time.perf_counter()
+        run()
+        wall = time.perf_counter() - started
+        cpu = None if cpu_before is None else _children_cpu_seconds() - cpu_before
+        return wall, cpu
+
+    def report(self, rows):
+        def fmt(value):
+            return '-' if value is None else f"{value:.1f}s"
+
+        def saving(old, new):
+            return '-' if not old or new is None else f"{(1 - new / old) * 100:.0f}%"
+
+        header = f"{'clip':<28} {'renditions':<22} {'wall old':>9} {'wall new':>9} {'saved':>6} {'cpu old':>9} {'cpu new':>9} {'saved':>6}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for name, info, qualities, (wall_old, cpu_old), (wall_new, cpu_new), failed in rows:
+            self.stdout.write(
+                f"{name[:28]:<28} {','.join(qualities):<22} {fmt(wall_old):>9} {fmt(wall_new):>9} "
+                f"{saving(wall_old, wall_new):>6} {fmt(cpu_old):>9} {fmt(cpu_new):>9} {saving(cpu_old, cpu_new):>6}"
+            )
+            if failed:
+                self.stdout.write(self.style.ERROR(f"  renditions failing validation: {', '.join(failed)}"))
+
+        if rows:
+            total_old = sum(row[3][0] for row in rows)
+            total_new = sum(row[4][0] for row in rows)
+            self.stdout.write(self.style.SUCCESS(
+                f"Total wall clock: {total_old:.1f}s -> {total_new:.1f}s ({saving(total_old, total_new)} saved)"
+            ))
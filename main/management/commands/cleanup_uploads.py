@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+import time
+
+
+class Command(BaseCommand):
+    help = 'Abort expired resumable uploads and purge finished upload sessions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep running and clean up periodically')
+        parser.add_argument('--interval', type=int, default=600, help='Seconds between runs in --loop mode')
+
+    def handle(self, *args, **options):
+        from main.resumable_uploads import cleanup_sessions
+
+        while True:
+            result = cleanup_sessions()
+            self.stdout.write(
+                f"Aborted {result['aborted']} expired uploads, purged {result['purged']} finished sessions"
+            )
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS('Cleanup completed'))
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand, CommandError
+import time
+
+
+class Command(BaseCommand):
+    help = 'Merge append-only comment segments into per-video comment snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=str, help='Compact comments only for specific user')
+        parser.add_argument('--video-id', type=str, help='Compact comments for specific video ID (requires --user)')
+        parser.add_argument('--min-segments', type=int, default=1, help='Skip videos with fewer pending segments')
+        parser.add_argument('--loop', action='store_true', help='Keep running and compact periodically')
+        parser.add_argument('--interval', type=int, default=300, help='Seconds between runs in --loop mode')
+
+    def handle(self, *args, **options):
+        from main.gcs_storage import get_bucket, compact_video_comments
+
+        specific_user = options.get('user')
+        specific_video = options.get('video_id')
+        min_segments = max(options['min_segments'], 1)
+
+        if specific_video and not specific_user:
+            raise CommandError('--video-id requires --user')
+        if specific_user and not specific_user.startswith('@'):
+            specific_user = f'@{specific_user}'
+
+        bucket = get_bucket()
+        if not bucket:
+            raise CommandError('Could not get bucket')
+
+        while True:
+            pending = self._find_pending(bucket, specific_user, specific_video)
+            compacted = 0
+
+            for (user_id, video_id), count in sorted(pending.items()):
+                if count < min_segments:
+                    continue
+                merged = compact_video_comments(user_id, video_id, bucket=bucket)
+                if merged < 0:
+                    self.stdout.write(self.style.ERROR(f"Failed to compact {user_id}/{video_id}"))
+                else:
+                    compacted += merged
+
+            self.stdout.write(f"Merged {compacted} segments across {len(pending)} videos")
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS('Compaction completed'))
+
+    def _find_pending(self, bucket, specific_user, specific_video):
+        """Returns {(user_id, video_id): segment_count} for videos with a non-empty tail"""
+        if specific_user:
+            users = [specific_user]
+        else:
+            iterator = bucket.list_blobs(delimiter='/')
+            list(iterator)  # prefixes are populated while paging
+            users = sorted(prefix.rstrip('/') for prefix in iterator.prefixes if prefix.startswith('@'))
+
+        pending = {}
+        for user_id in users:
+            prefix = f"{user_id}/comments/{specific_video}_segments/" if specific_video else f"{user_id}/comments/"
+            for blob in bucket.list_blobs(prefix=prefix):
+                folder = blob.name[len(f"{user_id}/comments/"):].split('/', 1)[0]
+                if not folder.endswith('_segments'):
+                    continue
+                key = (user_id, folder[:-len('_segments')])
+                pending[key] = pending.get(key, 0) + 1
+        return pending
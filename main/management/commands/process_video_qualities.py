@@ -1,10 +1,88 @@
 from django.core.management.base import BaseCommand, CommandError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+import json
 import logging
 import sys
 import os
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_CHECKPOINT = os.path.join('logs', 'process_video_qualities.checkpoint')
+
+STATUS_PROCESSED = 'processed'
+STATUS_SKIPPED = 'skipped'
+STATUS_FAILED = 'failed'
+# Failed videos are not final: --resume tries them again
+FINAL_STATUSES = (STATUS_PROCESSED, STATUS_SKIPPED)
+
+
+class Checkpoint:
+    """
+    Append-only file with one JSON line per finished video
+
+    A line is flushed as soon as a video is done, so after a crash or Ctrl+C
+    --resume skips everything that was completed before. Runs always append
+    (the last line of a video wins); only reset starts an empty file.
+    """
+
+    def __init__(self, path, resume=False, reset=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.statuses = {}
+        if resume and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Строка, оборванная при аварийном завершении
+                        continue
+                    self.statuses[entry['video']] = entry['status']
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Обычный повторный запуск не должен стирать записи незавершенного прогона
+        self.file = open(path, 'w' if reset else 'a', encoding='utf-8')
+
+    def is_done(self, key):
+        return self.statuses.get(key) in FINAL_STATUSES
+
+    def record(self, key, status, **fields):
+        entry = dict(video=key, status=status, finished_at=datetime.now().isoformat(), **fields)
+        with self.lock:
+            self.statuses[key] = status
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class RateLimiter:
+    """Spaces out video starts across all workers: at most per_minute starts a minute"""
+
+    def __init__(self, per_minute=None):
+        self.interval = 60.0 / per_minute if per_minute else 0
+        self.lock = threading.Lock()
+        self.next_start = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        time.sleep(start - now)
+
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}h{rest // 60:02d}m" if hours else f"{rest // 60}m{rest % 60:02d}s"
+
+
 class Command(BaseCommand):
     help = 'Process video qualities for existing videos in Google Cloud Storage'
 
@@ -12,13 +90,19 @@ class Command(BaseCommand):
         parser.add_argument('--user', type=str, help='Process videos only for specific user')
         parser.add_argument('--video-id', type=str, help='Process specific video ID')
         parser.add_argument('--max-videos', type=int, default=None, help='Maximum number of videos to process')
-        parser.add_argument('--.Concurrent conversations are limited to 2force', action='store_true', help='Force re-processing videos')
+        parser.add_argument('--force', action='store_true', help='Force re-processing videos')
         parser.add_argument('--dry-run', action='store_true', help='Show what would be processed without processing')
         parser.add_argument('--prefix', type=str, default='', help='Base prefix for user folders')
+        parser.add_argument('--workers', type=int, default=0, help='Videos processed in parallel (0 - derived from the CPU budget)')
+        parser.add_argument('--cpu-budget', type=int, default=0, help='Cores all workers may use together (default: TRANSCODE_CPU_BUDGET or all cores)')
+        parser.add_argument('--rate-limit', type=float, default=None, help='Maximum number of videos started per minute')
+        parser.add_argument('--checkpoint', type=str, default=DEFAULT_CHECKPOINT, help='File recording finished videos')
+        parser.add_argument('--resume', action='store_true', help='Skip videos the checkpoint file records as finished')
+        parser.add_argument('--reset-checkpoint', action='store_true', help='Clear the checkpoint file before the run')
 
     def handle(self, *args, **options):
-        from main.gcs_storage import get_bucket, BUCKET_NAME, get_video_metadata
-        from main.video_quality import create_quality_variants
+        from main.gcs_storage import get_bucket, BUCKET_NAME
+        from main.transcode_queue import plan_workers
 
         specific_user = options.get('user')
         specific_video = options.get('video_id')
@@ -27,6 +111,9 @@ class Command(BaseCommand):
         dry_run = options.get('dry_run')
         base_prefix = options.get('prefix', '').rstrip('/')
 
+        if options['resume'] and options['reset_checkpoint']:
+            raise CommandError("--resume and --reset-checkpoint can not be used together")
+
         # Setup logging
         handler = logging.StreamHandler(sys.stdout)
         handler.setLevel(logging.INFO)
@@ -35,7 +122,7 @@ class Command(BaseCommand):
         logger.addHandler(handler)
         logger.setLevel(logging.INFO)
 
-        # Get GCS bucket
+        # Один клиент и бакет на весь прогон, а не на каждое видео
         bucket = get_bucket(BUCKET_NAME)
         if not bucket:
             logger.error("Failed to get bucket")
@@ -43,6 +130,14 @@ class Command(BaseCommand):
 
         logger.info(f"Connected to bucket: {BUCKET_NAME}")
 
+        workers, threads = plan_workers(options['workers'], options['cpu_budget'])
+        checkpoint = None if dry_run else Checkpoint(
+            options['checkpoint'], resume=options['resume'], reset=options['reset_checkpoint']
+        )
+        if checkpoint and options['resume']:
+            done = sum(1 for status in checkpoint.statuses.values() if status in FINAL_STATUSES)
+            self.stdout.write(f"Resuming from {checkpoint.path}: {done} videos already finished")
+
         try:
             # Get list of users
             if specific_user:
@@ -59,71 +154,161 @@ class Command(BaseCommand):
                 users = sorted(list(users))
                 self.stdout.write(f"Found {len(users)} users")
 
-            processed_count = 0
-            skipped_count = 0
-
-            for user_id in users:
-                self.stdout.write(f"Processing user: {user_id}")
-                metadata_prefix = f"{base_prefix + '/' if base_prefix else ''}{user_id}/metadata/"
-                metadata_blobs = list(bucket.list_blobs(prefix=metadata_prefix))
-                videos_to_process = [os.path.splitext(os.path.basename(blob.name))[0] for blob in metadata_blobs if blob.name.endswith('.json')]
-                
-                self.stdout.write(f"Found {len(videos_to_process)} videos for user {user_id}")
-
-                for video_id in videos_to_process:
-                    if max_videos is not None and processed_count >= max_videos:
-                        self.stdout.write(f"Reached maximum of {max_videos} videos")
-                        break
-                    
-                    # Get metadata
-                    metadata = get_video_metadata(user_id, video_id)
-                    if not metadata:
-                        self.stdout.write(self.style.WARNING(f"Skipping video {video_id}: No metadata found"))
-                        skipped_count += 1
-                        continue
-                    
-                    # Check quality variants
-                    if not force and metadata.get('quality_variants'):
-                        self.stdout.write(f"Skipping video {video_id}: Already has quality variants {metadata.get('available_qualities')}")
-                        skipped_count += 1
-                        continue
-                    
-                    # Check file path
-                    file_path = metadata.get('file_path')
-                    if not file_path:
-                        self.stdout.write(self.style.WARNING(f"Skipping video {video_id}: No file path in metadata"))
-                        skipped_count += 1
-                        continue
-                    
-                    # Verify file exists in GCS
-                    blob = bucket.blob(file_path)
-                    if not blob.exists():
-                        self.stdout.write(self.style.WARNING(f"Skipping video {video_id}: File {file_path} does not exist in GCS"))
-                        skipped_count += 1
-                        continue
-                    
-                    gcs_video_path = f"gs://{BUCKET_NAME}/{file_path}"
-                    
-                    if dry_run:
-                        self.stdout.write(f"Would process video {video_id} (path: {gcs_video_path})")
-                        processed_count += 1
-                        continue
-                    
-                    try:
-                        self.stdout.write(f"Processing video {video_id} (file: {os.path.basename(file_path)})")
-                        quality_variants = create_quality_variants(gcs_video_path, user_id, video_id)
-                        if quality_variants:
-                            self.stdout.write(self.style.SUCCESS(f"Processed video {video_id} with qualities: {', '.join(quality_variants.keys())}"))
-                            processed_count += 1
-                        else:
-                            self.stdout.write(self.style.WARNING(f"No quality variants created for video {video_id}"))
-                            skipped_count += 1
-                    except Exception as e:
-                        self.stdout.write(self.style.ERROR(f"Error processing video {video_id}: {str(e)}"))
-                        skipped_count += 1
-            
-            self.stdout.write(self.style.SUCCESS(f"Completed. Processed {processed_count} videos. Skipped {skipped_count} videos."))
-        
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                candidates, skipped_count = self.collect_videos(
+                    executor, bucket, users, base_prefix, specific_video, max_videos, force, checkpoint
+                )
+
+                if dry_run:
+                    for user_id, video_id, metadata in candidates:
+                        self.stdout.write(f"Would process video {video_id} (path: gs://{BUCKET_NAME}/{metadata['file_path']})")
+                    self.stdout.write(self.style.SUCCESS(
+                        f"Dry run. Would process {len(candidates)} videos. Skipped {skipped_count} videos."
+                    ))
+                    return
+
+                self.stdout.write(
+                    f"Processing {len(candidates)} videos with {workers} worker(s), {threads} ffmpeg thread(s) each"
+                )
+                processed_count, failed_count = self.process_videos(
+                    executor, bucket, candidates, threads, RateLimiter(options['rate_limit']), checkpoint
+                )
+
+            self.stdout.write(self.style.SUCCESS(
+                f"Completed. Processed {processed_count} videos. Skipped {skipped_count} videos. "
+                f"Failed {failed_count} videos."
+            ))
+            if failed_count:
+                self.stdout.write("Run again with --resume to retry failed videos")
+
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING("Interrupted. Run again with --resume to continue"))
         except Exception as e:
             logger.error(f"Error in processing: {str(e)}")
-            raise CommandError(f"Failed to process videos: {str(e)}")
\ No newline at end of file
+            raise CommandError(f"Failed to process videos: {str(e)}")
+        finally:
+            if checkpoint:
+                checkpoint.close()
+
+    def collect_videos(self, executor, bucket, users, base_prefix, specific_video, max_videos, force, checkpoint):
+        """
+        Reads the metadata of every video and picks those that need processing
+
+        Returns:
+            tuple: ([(user_id, video_id, metadata)], skipped count)
+        """
+        def read_metadata(blob):
+            try:
+                return json.loads(blob.download_as_text())
+            except Exception as e:
+                logger.error(f"Error reading {blob.name}: {e}")
+                return None
+
+        candidates = []
+        skipped_count = 0
+        for user_id in users:
+            metadata_prefix = f"{base_prefix + '/' if base_prefix else ''}{user_id}/metadata/"
+            metadata_blobs = [
+                blob for blob in bucket.list_blobs(prefix=metadata_prefix)
+                if blob.name.endswith('.json')
+                and (not specific_video or os.path.splitext(os.path.basename(blob.name))[0] == specific_video)
+            ]
+            self.stdout.write(f"Found {len(metadata_blobs)} videos for user {user_id}")
+
+            # Метаданные листинга читаются параллельно, без повторного get_bucket на каждое видео
+            for blob, metadata in zip(metadata_blobs, executor.map(read_metadata, metadata_blobs)):
+                video_id = os.path.splitext(os.path.basename(blob.name))[0]
+                key = f"{user_id}__{video_id}"
+
+                if checkpoint and checkpoint.is_done(key):
+                    skipped_count += 1
+                    continue
+                if max_videos is not None and len(candidates) >= max_videos:
+                    self.stdout.write(f"Reached maximum of {max_videos} videos")
+                    return candidates, skipped_count
+
+                reason = None
+                if not metadata:
+                    reason = "No metadata found"
+                elif not force and metadata.get('quality_variants'):
+                    reason = f"Already has quality variants {metadata.get('available_qualities')}"
+                elif not metadata.get('file_path'):
+                    reason = "No file path in metadata"
+                elif metadata.get('shared_from'):
+                    # Варианты общего оригинала кодируются для видео, загруженного первым
+                    reason = f"Shares the original of {metadata['shared_from']}"
+
+                if reason:
+                    self.stdout.write(self.style.WARNING(f"Skipping video {video_id}: {reason}"))
+                    if checkpoint:
+                        checkpoint.record(key, STATUS_SKIPPED, reason=reason)
+                    skipped_count += 1
+                    continue
+
+                candidates.append((user_id, video_id, metadata))
+
+        return candidates, skipped_count
+
+    def process_videos(self, executor, bucket, candidates, threads, rate_limiter, checkpoint):
+        """Runs the candidates on the worker pool, reporting throughput and ETA"""
+        from main.gcs_storage import process_stored_video_qualities
+
+        def process(user_id, video_id, metadata):
+            rate_limiter.wait()
+            started = time.monotonic()
+            self.stdout.write(f"Processing video {video_id} (file: {os.path.basename(metadata['file_path'])})")
+            quality_variants = process_stored_video_qualities(
+                user_id, video_id, metadata['file_path'], threads=threads, media_info=metadata, bucket=bucket
+            )
+            return quality_variants, time.monotonic() - started
+
+        futures = {
+            executor.submit(process, user_id, video_id, metadata): (user_id, video_id)
+            for user_id, video_id, metadata in candidates
+        }
+
+        processed_count = 0
+        failed_count = 0
+        started = time.monotonic()
+        try:
+            for index, future in enumerate(as_completed(futures), 1):
+                user_id, video_id = futures[future]
+                key = f"{user_id}__{video_id}"
+                try:
+                    quality_variants, seconds = future.result()
+                    if quality_variants:
+                        self.stdout.write(self.style.SUCCESS(
+                            f"Processed video {video_id} with qualities: {', '.join(quality_variants.keys())}"
+                        ))
+                        checkpoint.record(key, STATUS_PROCESSED, qualities=list(quality_variants), seconds=round(seconds, 1))
+                        processed_count += 1
+                    elif quality_variants is None:
+                        error = "Original not available"
+                        self.stdout.write(self.style.WARNING(f"{error} for video {video_id}"))
+                        checkpoint.record(key, STATUS_FAILED, error=error)
+                        failed_count += 1
+                    else:
+                        # Ошибки кодирования приходят исключением: пустой результат - исходник ниже всех пресетов
+                        reason = "Below every quality preset"
+                        self.stdout.write(self.style.WARNING(f"Skipping video {video_id}: {reason}"))
+                        checkpoint.record(key, STATUS_SKIPPED, reason=reason)
+                except Exception as e:
+                    self.stdout.write(self.style.ERROR(f"Error processing video {video_id}: {str(e)}"))
+                    checkpoint.record(key, STATUS_FAILED, error=str(e))
+                    failed_count += 1
+
+                # Пропускная способность по всем завершенным видео этого прогона
+                elapsed = time.monotonic() - started
+                per_hour = index / elapsed * 3600 if elapsed else 0
+                remaining = len(candidates) - index
+                eta = format_eta(remaining / per_hour * 3600) if per_hour else '-'
+                self.stdout.write(
+                    f"[{index}/{len(candidates)}] {per_hour:.1f} videos/h, ETA {eta if remaining else 'done'}"
+                )
+        except KeyboardInterrupt:
+            # Еще не начатые видео отменяются; текущие дорабатывают, --resume проверит их метаданные заново
+            for future in futures:
+                future.cancel()
+            raise
+
+        return processed_count, failed_count
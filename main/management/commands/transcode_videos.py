@@ -1,16 +1,18 @@
 """
 Django management command to transcode videos.
 Can be run manually or as a scheduled task.
+
+Originals are streamed from storage into ffmpeg and the results streamed
+back (see main.video_transcoder), so no local disk space proportional to
+the video size is needed.
 """
 
-import os
 import json
 import logging
-import tempfile
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from main.gcs_storage import get_bucket, BUCKET_NAME, get_video_metadata
-from main.video_transcoder import transcode_to_quality, get_video_info
+from main.video_transcoder import transcode_to_quality, get_video_info, TRANSCODE_PRESETS
 
 logger = logging.getLogger(__name__)
 
@@ -174,6 +176,23 @@ class Command(BaseCommand):
         if not original_path:
             self.stdout.write(self.style.ERROR(f"No file path found for video {video_id}"))
             return
+        
+        # Дубликат использует варианты качества видео, которому принадлежит оригинал
+        if metadata.get('shared_from'):
+            self.stdout.write(f"Skipping {video_id}: shares the original of {metadata['shared_from']}")
+            return
+        
+        # Original stays in storage: it is read with ranged requests while transcoding
+        original_blob = bucket.get_blob(original_path)
+        if original_blob is None:
+            self.stdout.write(self.style.ERROR(f"Original video not found at {original_path}"))
+            return
+            
+        # Get video info (stored at upload, probed over a signed URL for older videos)
+        video_info = get_video_info(original_blob, metadata)
+        if not video_info:
+            self.stdout.write(self.style.ERROR(f"Could not get video info for {video_id}"))
+            return
             
         # Get available qualities
         available_qualities = metadata.get('available_qualities', [])
@@ -181,8 +200,8 @@ class Command(BaseCommand):
         # Determine qualities to generate
         qualities_to_generate = []
         if quality_option == 'all':
-            # Select qualities based on original resolution
-            original_height = metadata.get('height', 0)
+            # Select qualities based on original resolution (probed, older metadata has no height)
+            original_height = video_info.get('height') or 0
             
             if original_height >= 1080:
                 qualities_to_generate = ['480p', '720p', '1080p']
@@ -207,68 +226,50 @@ class Command(BaseCommand):
             
         self.stdout.write(f"Generating qualities: {', '.join(qualities_to_generate)}")
         
-        # Download original video to temp file
-        original_blob = bucket.blob(original_path)
-        if not original_blob.exists():
-            self.stdout.write(self.style.ERROR(f"Original video not found at {original_path}"))
-            return
-            
-        # Create temp directory for processing
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Download original video
-            local_input_path = os.path.join(temp_dir, f"original_{video_id}.mp4")
-            self.stdout.write(f"Downloading original video...")
-            original_blob.download_to_filename(local_input_path)
-            
-            # Get video info with ffprobe
-            video_info = get_video_info(local_input_path)
-            if not video_info:
-                self.stdout.write(self.style.ERROR(f"Could not get video info for {video_id}"))
-                return
+        quality_variants = metadata.get('quality_variants', {})
+        
+        # Process each quality
+        for quality in qualities_to_generate:
+            try:
+                self.stdout.write(f"Transcoding to {quality}...")
                 
-            # Process each quality
-            for quality in qualities_to_generate:
-                try:
-                    self.stdout.write(f"Transcoding to {quality}...")
-                    
-                    # Set output path for transcoded video
-                    local_output_path = os.path.join(temp_dir, f"{video_id}_{quality}.mp4")
-                    
-                    # Transcode video
-                    success = transcode_to_quality(local_input_path, local_output_path, quality)
-                    
-                    if not success:
-                        self.stdout.write(self.style.ERROR(f"Failed to transcode {video_id} to {quality}"))
-                        continue
-                        
-                    # Upload transcoded video to GCS
-                    transcoded_path = f"{user_id}/videos/{video_id}_{quality}.mp4"
-                    transcoded_blob = bucket.blob(transcoded_path)
-                    
-                    self.stdout.write(f"Uploading {quality} version...")
-                    transcoded_blob.upload_from_filename(
-                        local_output_path, 
-                        content_type='video/mp4'
-                    )
-                    
-                    # Update available qualities in metadata
-                    if quality not in available_qualities:
-                        available_qualities.append(quality)
-                        
-                    self.stdout.write(self.style.SUCCESS(f"Successfully processed {quality} version"))
+                # Transcoded video is streamed straight into storage
+                transcoded_path = f"{user_id}/videos/{video_id}_{quality}.mp4"
+                success = transcode_to_quality(
+                    original_blob, bucket.blob(transcoded_path), quality,
+                    expected_duration=video_info.get('duration')
+                )
+                
+                if not success:
+                    self.stdout.write(self.style.ERROR(f"Failed to transcode {video_id} to {quality}"))
+                    continue
+                
+                # Update available qualities in metadata
+                if quality not in available_qualities:
+                    available_qualities.append(quality)
+                quality_variants[quality] = {
+                    'path': transcoded_path,
+                    'resolution': TRANSCODE_PRESETS[quality]['resolution'],
+                    'bitrate': TRANSCODE_PRESETS[quality]['bitrate']
+                }
                     
-                except Exception as e:
-                    self.stdout.write(self.style.ERROR(f"Error transcoding to {quality}: {e}"))
-            
-            # Update metadata with new available qualities
-            metadata['available_qualities'] = available_qualities
-            metadata_path = f"{user_id}/metadata/{video_id}.json"
-            metadata_blob = bucket.blob(metadata_path)
-            
-            self.stdout.write(f"Updating metadata with new qualities: {available_qualities}")
-            metadata_blob.upload_from_string(
-                json.dumps(metadata, indent=2), 
-                content_type='application/json'
-            )
-            
-            self.stdout.write(self.style.SUCCESS(f"Completed processing video {video_id}"))
\ No newline at end of file
+                self.stdout.write(self.style.SUCCESS(f"Successfully processed {quality} version"))
+                
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f"Error transcoding to {quality}: {e}"))
+        
+        # Update metadata with new available qualities
+        metadata['available_qualities'] = available_qualities
+        if quality_variants:
+            metadata['quality_variants'] = quality_variants
+            metadata['highest_quality'] = max(quality_variants, key=lambda q: int(q.rstrip('p')))
+        metadata_path = f"{user_id}/metadata/{video_id}.json"
+        metadata_blob = bucket.blob(metadata_path)
+        
+        self.stdout.write(f"Updating metadata with new qualities: {available_qualities}")
+        metadata_blob.upload_from_string(
+            json.dumps(metadata, indent=2), 
+            content_type='application/json'
+        )
+        
+        self.stdout.write(self.style.SUCCESS(f"Completed processing video {video_id}"))
\ No newline at end of file
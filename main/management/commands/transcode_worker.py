@@ -0,0 +1,107 @@
+from django.core.management.base import BaseCommand
+import logging
+import multiprocessing
+import signal
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _worker_loop(worker_id, threads, lease_seconds, poll_interval, once, stop_event):
+    """
+    Processes finalized uploads and runs transcode jobs until stop_event is
+    set (or both queues are empty with once). Uploads go first: the author
+    waits for them, and registering a video is short next to transcoding.
+    """
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        # Процессы, запущенные через spawn (Windows), настраивают Django заново
+        django.setup()
+
+    from django.db import close_old_connections
+    from main.resumable_uploads import process_next_upload
+    from main.transcode_queue import process_next_job
+
+    processed = 0
+    try:
+        while not stop_event.is_set():
+            close_old_connections()
+            if process_next_upload(worker_id) or process_next_job(worker_id, lease_seconds, threads=threads):
+                processed += 1
+                continue
+            if once:
+                break
+            stop_event.wait(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_old_connections()
+    logger.info(f"Worker {worker_id} stopped after {processed} jobs")
+    return processed
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of workers that process finalized uploads and the quality variant transcoding queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=0, help='Number of worker processes (0 - derived from the CPU budget)')
+        parser.add_argument('--cpu-budget', type=int, default=0, help='Cores all workers may use together (default: TRANSCODE_CPU_BUDGET or all cores)')
+        parser.add_argument('--lease', type=int, default=300, help='Seconds a job stays claimed without a heartbeat')
+        parser.add_argument('--poll-interval', type=float, default=5, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Exit when the queue is empty')
+
+    def handle(self, *args, **options):
+        from django.db import connections
+        from main.transcode_queue import default_worker_id, plan_workers
+
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(processName)s - %(levelname)s - %(message)s'))
+        for name in ('main.transcode_queue', 'main.resumable_uploads', __name__):
+            logging.getLogger(name).addHandler(handler)
+            logging.getLogger(name).setLevel(logging.INFO)
+
+        # workers x threads <= бюджет: параллельные задачи не делят ядра сверх него
+        workers, threads = plan_workers(options['workers'], options['cpu_budget'])
+        self.stdout.write(f'{workers} worker(s) with {threads} ffmpeg thread(s) each')
+        args = (threads, options['lease'], options['poll_interval'], options['once'])
+        stop_event = multiprocessing.Event()
+
+        def request_stop(signum, frame):
+            self.stdout.write('Stopping after the current jobs...')
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, request_stop)
+
+        if workers == 1:
+            try:
+                processed = _worker_loop(default_worker_id(), *args, stop_event)
+            except KeyboardInterrupt:
+                processed = 0
+            self.stdout.write(self.style.SUCCESS(f'Worker finished, processed {processed} jobs'))
+            return
+
+        # Дочерние процессы не должны наследовать открытые соединения с БД
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(
+                target=_worker_loop,
+                args=(f"{default_worker_id()}/{index}", *args, stop_event),
+                name=f"transcode-worker-{index}"
+            )
+            for index in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        self.stdout.write(f'Started {workers} transcode workers')
+
+        try:
+            while any(process.is_alive() for process in processes):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            stop_event.set()
+        for process in processes:
+            process.join()
+
+        self.stdout.write(self.style.SUCCESS('Transcode workers finished'))
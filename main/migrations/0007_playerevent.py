@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:16
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_subscription'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayerEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('video_id', models.CharField(max_length=255)),
+                ('video_owner', models.CharField(max_length=255)),
+                ('event_type', models.CharField(choices=[('view_start', 'View start'), ('heartbeat', 'Heartbeat'), ('quality_change', 'Quality change'), ('seek', 'Seek')], max_length=20)),
+                ('position', models.FloatField(default=0)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('client_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed', models.BooleanField(default=False)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['processed', 'id'], name='main_player_process_815b46_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:17
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_subscriber_counts(apps, schema_editor):
+    """Fills ChannelStats from the existing subscriptions"""
+    Subscription = apps.get_model('main', 'Subscription')
+    ChannelStats = apps.get_model('main', 'ChannelStats')
+    counts = Subscription.objects.values('channel_id').annotate(total=Count('id'))
+    ChannelStats.objects.bulk_create([
+        ChannelStats(channel_id=row['channel_id'], subscriber_count=row['total'])
+        for row in counts
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_playerevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChannelStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel_id', models.CharField(max_length=255, unique=True)),
+                ('subscriber_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Channel Stats',
+                'verbose_name_plural': 'Channel Stats',
+            },
+        ),
+        migrations.RunPython(backfill_subscriber_counts, migrations.RunPython.noop),
+    ]
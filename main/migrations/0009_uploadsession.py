@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:40
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_channelstats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('file_name', models.CharField(max_length=255)),
+                ('content_type', models.CharField(default='video/mp4', max_length=100)),
+                ('gcs_path', models.CharField(max_length=512)),
+                ('session_url', models.TextField()),
+                ('upload_length', models.BigIntegerField()),
+                ('upload_offset', models.BigIntegerField(default=0)),
+                ('status', models.CharField(choices=[('uploading', 'Uploading'), ('processing', 'Processing'), ('complete', 'Complete'), ('failed', 'Failed')], default='uploading', max_length=20)),
+                ('video_id', models.CharField(blank=True, max_length=255)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('expires_at', models.DateTimeField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'expires_at'], name='main_upload_status_2115eb_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_uploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranscodeJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.CharField(max_length=255)),
+                ('video_id', models.CharField(max_length=255)),
+                ('source_path', models.CharField(max_length=512)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('priority', models.IntegerField(default=0)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('max_attempts', models.PositiveIntegerField(default=3)),
+                ('run_after', models.DateTimeField(blank=True, null=True)),
+                ('lease_owner', models.CharField(blank=True, max_length=255)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('progress', models.FloatField(default=0)),
+                ('current_step', models.CharField(blank=True, max_length=50)),
+                ('result', models.JSONField(blank=True, default=dict)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', '-priority', 'created_at'], name='main_transc_status_5fc847_idx'), models.Index(fields=['user_id', 'video_id'], name='main_transc_user_id_c71a00_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_transcodejob'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='transcodejob',
+            name='main_transc_status_5fc847_idx',
+        ),
+        migrations.AddField(
+            model_name='transcodejob',
+            name='source_size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='transcodejob',
+            index=models.Index(fields=['status', '-priority', 'source_size'], name='main_transc_status_05aef8_idx'),
+        ),
+    ]
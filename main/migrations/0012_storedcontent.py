@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_transcodejob_source_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredContent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('source_path', models.CharField(max_length=512)),
+                ('size', models.BigIntegerField(default=0)),
+                ('user_id', models.CharField(max_length=255)),
+                ('video_id', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ContentReference',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.CharField(max_length=255)),
+                ('video_id', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('content', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='references', to='main.storedcontent')),
+            ],
+            options={
+                'unique_together': {('user_id', 'video_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_storedcontent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='description',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='process_qualities',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='title',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
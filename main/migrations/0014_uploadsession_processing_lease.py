@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_uploadsession_finalize_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='thumbnail_path',
+            field=models.CharField(blank=True, max_length=512),
+        ),
+    ]
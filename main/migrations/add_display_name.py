@@ -21,7 +21,8 @@ class Migration(migrations.Migration):
     ]
 
     operations = [
-        migrations.AddField(
+        # Поле уже добавлено в 0006_auto_20250410_2320: AddField ломал миграцию новой базы
+        migrations.AlterField(
             model_name='userprofile',
             name='display_name',
             field=models.CharField(blank=True, max_length=50, null=True),
@@ -1,6 +1,9 @@
-from django.db import models
+import uuid
+
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.db.models.functions import Greatest
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
@@ -91,6 +94,43 @@ class VideoView(models.Model):
             ('session_id', 'video_id', 'video_owner'),  # Уникальность для неавторизованных
         ]
     
+class PlayerEvent(models.Model):
+    """
+    Raw player event received from the batched beacon endpoint
+
+    Events are written in bulk and act as a queue: the aggregate_player_events
+    command folds unprocessed rows into VideoView records and video metadata.
+    """
+    EVENT_VIEW_START = 'view_start'
+    EVENT_HEARTBEAT = 'heartbeat'
+    EVENT_QUALITY_CHANGE = 'quality_change'
+    EVENT_SEEK = 'seek'
+    EVENT_TYPES = (
+        (EVENT_VIEW_START, 'View start'),
+        (EVENT_HEARTBEAT, 'Heartbeat'),
+        (EVENT_QUALITY_CHANGE, 'Quality change'),
+        (EVENT_SEEK, 'Seek'),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)  # Null для неавторизованных
+    session_id = models.CharField(max_length=255, null=True, blank=True)
+    video_id = models.CharField(max_length=255)  # ID видео в GCS
+    video_owner = models.CharField(max_length=255)  # Владелец видео (user_id)
+    event_type = models.CharField(max_length=20, choices=EVENT_TYPES)
+    position = models.FloatField(default=0)  # Playback position in seconds
+    payload = models.JSONField(default=dict, blank=True)  # Event specific data (quality, seek target)
+    client_timestamp = models.DateTimeField(null=True, blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['processed', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.event_type} on {self.video_owner}__{self.video_id}"
+
 class Subscription(models.Model):
     """
     Model to track user subscriptions to channels
@@ -105,7 +145,183 @@ class Subscription(models.Model):
         verbose_name_plural = 'Subscriptions'
         
     def __str__(self):
-        return f"{self.subscriber.username} subscribed to {self.channel_id}"    
+        return f"{self.subscriber.username} subscribed to {self.channel_id}"
+
+class ChannelStats(models.Model):
+    """
+    Denormalized per-channel counters
+
+    subscriber_count is maintained transactionally together with Subscription
+    rows, so reading it never requires a COUNT over the subscriptions table.
+    """
+    channel_id = models.CharField(max_length=255, unique=True)  # User ID (with @ prefix) of the channel/author
+    subscriber_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Channel Stats'
+        verbose_name_plural = 'Channel Stats'
+
+    def __str__(self):
+        return f"{self.channel_id}: {self.subscriber_count} subscribers"
+
+    @classmethod
+    def adjust_subscribers(cls, channel_id, delta):
+        """
+        Atomically changes the subscriber counter of a channel.
+        Joins the transaction that creates/deletes the Subscription, if any.
+        """
+        with transaction.atomic():
+            stats, _ = cls.objects.get_or_create(channel_id=channel_id)
+            cls.objects.filter(pk=stats.pk).update(
+                subscriber_count=Greatest(models.F('subscriber_count') + delta, 0)
+            )
+
+    @classmethod
+    def get_subscriber_count(cls, channel_id):
+        return cls.objects.filter(channel_id=channel_id).values_list('subscriber_count', flat=True).first() or 0
+
+    @classmethod
+    def get_subscriber_counts(cls, channel_ids):
+        """Returns {channel_id: subscriber_count} for many channels with a single query"""
+        counts = dict(
+            cls.objects.filter(channel_id__in=channel_ids).values_list('channel_id', 'subscriber_count')
+        )
+        return {channel_id: counts.get(channel_id, 0) for channel_id in channel_ids}
+
+class UploadSession(models.Model):
+    """
+    Resumable (tus-style) video upload
+
+    Chunks are written straight into a GCS resumable upload session. The row
+    keeps the session URI and the committed offset, so the next chunk, a
+    status request or the finalize call can be served by any worker.
+    A finalized session in processing is a queue entry: transcode_worker
+    claims it with a lease and registers the video.
+    """
+    STATUS_UPLOADING = 'uploading'
+    STATUS_PROCESSING = 'processing'
+    STATUS_COMPLETE = 'complete'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_UPLOADING, 'Uploading'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_COMPLETE, 'Complete'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    file_name = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, default='video/mp4')
+    gcs_path = models.CharField(max_length=512)  # Итоговый путь объекта {user}/videos/...
+    session_url = models.TextField()  # URI resumable-сессии GCS
+    upload_length = models.BigIntegerField()
+    upload_offset = models.BigIntegerField(default=0)  # Байты, подтвержденные GCS
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_UPLOADING)
+    video_id = models.CharField(max_length=255, blank=True)  # Заполняется после обработки
+    error = models.TextField(blank=True)
+    # Поля формы finalize: по ним незавершенную обработку можно повторить
+    title = models.CharField(max_length=255, blank=True)
+    description = models.TextField(blank=True)
+    process_qualities = models.BooleanField(default=True)
+    thumbnail_path = models.CharField(max_length=512, blank=True)  # Миниатюра из формы, ждет обработки в GCS
+    attempts = models.PositiveIntegerField(default=0)  # Попытки обработки воркером
+    lease_expires_at = models.DateTimeField(null=True, blank=True)  # Аренда воркера, обрабатывающего загрузку
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.file_name} ({self.upload_offset}/{self.upload_length}, {self.status})"
+
+class TranscodeJob(models.Model):
+    """
+    Quality variant transcoding job
+
+    The table is the queue: transcode_worker processes claim the next job
+    by setting a lease, renew it while ffmpeg runs and re-queue the job with
+    a backoff if it fails. A job whose lease expired (worker crashed or was
+    restarted) is claimed again by another worker. Within a priority the
+    smallest source goes first (see main.transcode_queue).
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    user_id = models.CharField(max_length=255)  # Владелец видео (с префиксом @)
+    video_id = models.CharField(max_length=255)
+    source_path = models.CharField(max_length=512)  # Оригинал в GCS
+    source_size = models.BigIntegerField(default=0)  # Байты оригинала - оценка длительности кодирования
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    priority = models.IntegerField(default=0)  # Больше - раньше
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(null=True, blank=True)  # Отложенный повтор после ошибки
+    lease_owner = models.CharField(max_length=255, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    progress = models.FloatField(default=0)  # 0..1
+    current_step = models.CharField(max_length=50, blank=True)  # Например, '720p'
+    result = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', '-priority', 'source_size']),
+            models.Index(fields=['user_id', 'video_id']),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}/{self.video_id} ({self.status}, {self.progress:.0%})"
+
+class StoredContent(models.Model):
+    """
+    Content-addressed index of stored originals
+
+    One row per distinct file (SHA-256). Videos uploaded with the same
+    content reference the row and share its original and renditions, which
+    are deleted only with the last reference (see main.content_index).
+    user_id/video_id is the video whose transcoding serves all references.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    source_path = models.CharField(max_length=512)  # Оригинал в GCS
+    size = models.BigIntegerField(default=0)
+    user_id = models.CharField(max_length=255)  # Видео, для которого кодируются варианты
+    video_id = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.source_path})"
+
+class ContentReference(models.Model):
+    """A video using a StoredContent; the number of rows is its reference count"""
+    content = models.ForeignKey(StoredContent, on_delete=models.CASCADE, related_name='references')
+    user_id = models.CharField(max_length=255)  # Владелец видео (с префиксом @)
+    video_id = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('user_id', 'video_id')
+
+    def __str__(self):
+        return f"{self.user_id}/{self.video_id} -> {self.content.sha256[:12]}"
 
 # Add new model for expertise areas
 class ExpertiseArea(models.Model):
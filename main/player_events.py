@@ -0,0 +1,226 @@
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from .models import PlayerEvent, VideoView
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of events accepted in a single beacon
+MAX_EVENTS_PER_BATCH = 200
+
+# Interval (seconds) between heartbeats sent by kronik-player.js
+HEARTBEAT_INTERVAL = 15
+
+VALID_EVENT_TYPES = {event_type for event_type, _ in PlayerEvent.EVENT_TYPES}
+
+
+def _parse_client_timestamp(value):
+    """Converts a JS millisecond timestamp into an aware datetime"""
+    try:
+        return datetime.fromtimestamp(float(value) / 1000, tz=dt_timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+
+
+def build_player_events(raw_events, user=None, session_id=None, default_video_id=None, default_owner=None):
+    """
+    Validates a batch of raw player events and builds unsaved PlayerEvent objects
+
+    Args:
+        raw_events: list of dicts sent by the player
+        user: authenticated user or None
+        session_id: client session id for anonymous viewers
+        default_video_id: composite or plain video id applied to events without one
+        default_owner: video owner applied to events without one
+
+    Returns:
+        tuple: (list of PlayerEvent, number of rejected events)
+    """
+    events = []
+    rejected = 0
+
+    for raw in raw_events[:MAX_EVENTS_PER_BATCH]:
+        if not isinstance(raw, dict):
+            rejected += 1
+            continue
+
+        event_type = raw.get('type')
+        if event_type not in VALID_EVENT_TYPES:
+            rejected += 1
+            continue
+
+        video_id = raw.get('video_id') or default_video_id
+        owner = raw.get('user_id') or default_owner
+        if not isinstance(video_id, str) or not isinstance(owner or '', str):
+            rejected += 1
+            continue
+        if '__' in video_id:
+            owner, video_id = video_id.split('__', 1)
+        if not video_id or not owner:
+            rejected += 1
+            continue
+
+        try:
+            position = max(0.0, float(raw.get('position', 0) or 0))
+        except (TypeError, ValueError):
+            rejected += 1
+            continue
+
+        payload = raw.get('payload') or {}
+        if not isinstance(payload, dict):
+            payload = {}
+
+        events.append(PlayerEvent(
+            user=user,
+            session_id=None if user else session_id,
+            video_id=video_id[:255],
+            video_owner=owner[:255],
+            event_type=event_type,
+            position=position,
+            payload=payload,
+            client_timestamp=_parse_client_timestamp(raw.get('ts')),
+        ))
+
+    rejected += max(0, len(raw_events) - MAX_EVENTS_PER_BATCH)
+    return events, rejected
+
+
+def parse_event_batch(request):
+    """
+    Extracts the event list from a beacon request.
+    Accepts either a JSON body or a form field named 'events' (sendBeacon with FormData).
+    """
+    if request.content_type == 'application/json':
+        data = json.loads(request.body or b'{}')
+        if not isinstance(data, dict):
+            raise ValueError('payload must be an object')
+    else:
+        data = {
+            'events': json.loads(request.POST.get('events') or '[]'),
+            'session_id': request.POST.get('session_id'),
+            'video_id': request.POST.get('video_id'),
+            'user_id': request.POST.get('user_id'),
+        }
+
+    raw_events = data.get('events') or []
+    if not isinstance(raw_events, list):
+        raise ValueError('events must be a list')
+    return data, raw_events
+
+
+def _viewer_key(event):
+    if event.user_id:
+        return ('user', event.user_id)
+    if event.session_id:
+        return ('session', event.session_id)
+    return None
+
+
+def _aggregate_video_events(video_owner, video_id, events):
+    """Applies one video's pending events to VideoView and GCS metadata"""
+    from .gcs_storage import get_video_metadata, update_video_metadata
+
+    viewers = {}
+    heartbeats = 0
+    for event in events:
+        if event.event_type == PlayerEvent.EVENT_VIEW_START:
+            key = _viewer_key(event)
+            if key and key not in viewers:
+                viewers[key] = event
+        elif event.event_type == PlayerEvent.EVENT_HEARTBEAT:
+            heartbeats += 1
+
+    counted_views = 0
+    if viewers:
+        user_ids = [key[1] for key in viewers if key[0] == 'user']
+        session_ids = [key[1] for key in viewers if key[0] == 'session']
+        existing = VideoView.objects.filter(
+            video_id=video_id,
+            video_owner=video_owner,
+        ).filter(Q(user_id__in=user_ids) | Q(session_id__in=session_ids))
+
+        seen = set()
+        for user_id, session_id in existing.values_list('user_id', 'session_id'):
+            if user_id:
+                seen.add(('user', user_id))
+            if session_id:
+                seen.add(('session', session_id))
+
+        for key, event in viewers.items():
+            if key in seen:
+                continue
+            # Only rows that were actually inserted are counted: a concurrent
+            # request may have recorded the same viewer since the check above
+            try:
+                with transaction.atomic():
+                    VideoView.objects.create(
+                        user_id=event.user_id,
+                        session_id=event.session_id,
+                        video_id=video_id,
+                        video_owner=video_owner,
+                    )
+                counted_views += 1
+            except IntegrityError:
+                pass
+
+    if counted_views or heartbeats:
+        metadata = get_video_metadata(video_owner, video_id)
+        if metadata:
+            metadata['views'] = int(metadata.get('views', 0)) + counted_views
+            metadata['watch_time_seconds'] = int(metadata.get('watch_time_seconds', 0)) + heartbeats * HEARTBEAT_INTERVAL
+            if not update_video_metadata(video_owner, video_id, metadata):
+                raise RuntimeError(f"Failed to update metadata for {video_owner}/{video_id}")
+        else:
+            logger.warning(f"Metadata for video {video_owner}/{video_id} not found, dropping aggregated counters")
+
+    return counted_views
+
+
+def aggregate_player_events(limit=5000):
+    """
+    Folds unprocessed player events into views and watch time.
+    Events are grouped per video so every video's metadata is read and written once per run.
+
+    Returns:
+        dict: number of processed events and newly counted views
+    """
+    pending = PlayerEvent.objects.filter(processed=False).order_by('id').values_list(
+        'id', 'video_owner', 'video_id'
+    )[:limit]
+    if not pending:
+        return {'events': 0, 'views': 0}
+
+    grouped = defaultdict(list)
+    for event_id, video_owner, video_id in pending:
+        grouped[(video_owner, video_id)].append(event_id)
+
+    processed_events = 0
+    counted_views = 0
+    for (video_owner, video_id), event_ids in grouped.items():
+        try:
+            with transaction.atomic():
+                # Events are claimed under a row lock: a concurrent run skips locked
+                # rows, and rows it has already processed no longer match
+                video_events = list(
+                    PlayerEvent.objects.select_for_update(skip_locked=True).filter(
+                        id__in=event_ids, processed=False
+                    ).order_by('id')
+                )
+                if not video_events:
+                    continue
+                counted_views += _aggregate_video_events(video_owner, video_id, video_events)
+                PlayerEvent.objects.filter(
+                    id__in=[event.id for event in video_events]
+                ).update(processed=True)
+            processed_events += len(video_events)
+        except Exception as e:
+            # Events stay unprocessed and will be retried on the next run
+            logger.error(f"Error aggregating events for video {video_owner}/{video_id}: {e}")
+
+    logger.info(f"Aggregated {processed_events} player events, {counted_views} new views")
+    return {'events': processed_events, 'views': counted_views}
@@ -0,0 +1,172 @@
+"""
+Real-time push of Q&A events (new comments, replies, like counts) per video
+
+Views publish an event after a successful write and the SSE endpoint
+(video_event_stream, ASGI only) streams it to every connected client.
+
+The broker backend is configured with settings.REALTIME_BROKER:
+- main.realtime.InProcessBroker (default) fans events out inside one process
+- main.realtime.RedisBroker relays them through Redis pub/sub, so that a
+  comment posted on one worker reaches clients connected to any other
+  (requires the redis package and settings.REALTIME_REDIS_URL)
+
+Every subscriber has a bounded queue. A client that cannot keep up is not
+allowed to grow memory: its queue is dropped and it is told to resync.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_QUEUE_SIZE = 100
+HEARTBEAT_INTERVAL = 15  # seconds between SSE comments keeping proxies from closing the stream
+RETRY_MS = 3000  # EventSource reconnect delay
+
+# Sentinel placed in a subscriber queue after an overflow
+RESYNC = None
+
+
+def video_channel(video_owner, video_id):
+    return f"video:{video_owner}__{video_id}"
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class Subscription:
+    """A single stream consumer bound to the event loop it was created in"""
+
+    def __init__(self, broker, channel, maxsize):
+        self.broker = broker
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def deliver(self, message):
+        """Runs in the subscriber's event loop"""
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # Клиент не успевает читать: сбрасываем очередь, клиент перечитает комментарии
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+            logger.warning(f"Subscriber on {self.channel} overflowed, requesting resync")
+
+    async def get(self, timeout):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InProcessBroker:
+    """Pub/sub within the current process; publish may be called from any thread"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, channel, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        subscription = Subscription(self, channel, maxsize)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.channel]
+
+    def publish(self, channel, event, data):
+        self._fan_out(channel, format_sse(event, data))
+
+    def _fan_out(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, message)
+            except RuntimeError:
+                # Event loop of the subscriber is already closed
+                self.unsubscribe(subscription)
+
+
+class RedisBroker(InProcessBroker):
+    """
+    Relays events through Redis pub/sub. Each process runs one listener thread
+    that forwards messages to its local subscribers.
+    """
+    CHANNEL_PREFIX = 'kronik:'
+
+    def __init__(self):
+        super().__init__()
+        import redis  # optional dependency, only needed for this backend
+
+        self._redis = redis.Redis.from_url(getattr(settings, 'REALTIME_REDIS_URL', 'redis://localhost:6379/0'))
+        self._listener = None
+
+    def publish(self, channel, event, data):
+        self._redis.publish(f"{self.CHANNEL_PREFIX}{channel}", format_sse(event, data))
+
+    def subscribe(self, channel, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        self._ensure_listener()
+        return super().subscribe(channel, maxsize)
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='realtime-redis-listener', daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f"{self.CHANNEL_PREFIX}*")
+                for message in pubsub.listen():
+                    channel = message['channel'].decode()[len(self.CHANNEL_PREFIX):]
+                    self._fan_out(channel, message['data'].decode())
+            except Exception as e:
+                logger.error(f"Realtime Redis listener failed, reconnecting: {e}")
+                time.sleep(1)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                broker_path = getattr(settings, 'REALTIME_BROKER', 'main.realtime.InProcessBroker')
+                _broker = import_string(broker_path)()
+    return _broker
+
+
+def publish_video_event(video_owner, video_id, event, data):
+    """
+    Publishes an event for a video. Never raises: a failed push must not fail
+    the write that triggered it, clients catch up on the next page load.
+    """
+    try:
+        get_broker().publish(video_channel(video_owner, video_id), event, data)
+    except Exception as e:
+        logger.error(f"Error publishing {event} event for video {video_id}: {e}")
@@ -0,0 +1,508 @@
+"""
+Resumable chunked video uploads (tus-style)
+
+Protocol (see the /api/uploads/ views in gcs_views):
+1. POST /api/uploads/ creates a session for a file of known size
+2. PATCH /api/uploads/<id>/ with an Upload-Offset header appends a chunk
+3. HEAD /api/uploads/<id>/ returns the committed offset for resuming
+4. POST /api/uploads/<id>/finalize/ queues the upload for processing (202);
+   the client polls the session (GET) until it is complete or failed
+
+Chunks are forwarded to a GCS resumable upload session, so a chunk is never
+written to local disk and GCS is the source of truth for how many bytes
+were committed. The session URI and offset are kept in UploadSession, so a
+resume may land on any worker.
+
+Direct uploads (POST /api/uploads/direct/) skip step 2: the client gets the
+GCS session URI itself and PUTs the chunks straight to storage. The URI is
+a short-lived capability for exactly one object of exactly upload_length
+bytes, so it is only issued after the author and quota checks. HEAD and
+finalize then ask GCS for the committed offset and finalize verifies the
+stored object before processing starts.
+
+Processing (hashing for deduplication, probing, the thumbnail, queueing
+transcoding) reads the whole object, so it never runs in the finalize
+request: transcode_worker claims finalized sessions with a lease
+(process_next_upload), and a session whose worker died is claimed again.
+
+Setting STORAGE_EMULATOR_HOST (e.g. fake-gcs-server) points the client at a
+local emulator, which serves the same session protocol.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from .models import ContentReference, StoredContent, UploadSession
+
+logger = logging.getLogger(__name__)
+
+# GCS accepts non-final chunks only in multiples of 256 KiB
+CHUNK_ALIGNMENT = 256 * 1024
+CHUNK_SIZE = 32 * CHUNK_ALIGNMENT  # 8 MiB, advertised to clients
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+MAX_UPLOAD_SIZE = 20 * 1024 * 1024 * 1024
+
+# GCS resumable sessions live for a week
+SESSION_TTL = timedelta(days=7)
+# A worker that has not finished processing an upload for this long is considered dead
+PROCESSING_LEASE = timedelta(minutes=30)
+PROCESSING_ATTEMPTS = 3
+CLAIM_CANDIDATES = 5
+
+# Bytes of original videos a single author may store (settings.VIDEO_STORAGE_QUOTA)
+DEFAULT_STORAGE_QUOTA = 50 * 1024 * 1024 * 1024
+
+GCS_REQUEST_TIMEOUT = 120
+
+
+class _BoundedStream:
+    """
+    Exposes exactly `length` bytes of a readable (e.g. the request) to
+    requests, which then sends it with Content-Length instead of chunked
+    encoding, without buffering the chunk in memory.
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.len = length
+
+    def read(self, size=-1):
+        if self.len <= 0:
+            return b''
+        data = self.stream.read(self.len if size is None or size < 0 else min(size, self.len))
+        self.len -= len(data)
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(64 * 1024), b'')
+
+
+class UploadError(Exception):
+    """Rejected upload request; status is the HTTP status for the response"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _parse_committed_range(response, upload_length):
+    """Bytes committed by GCS from a resumable upload response"""
+    if response.status_code in (200, 201):
+        return upload_length
+    if response.status_code == 308:
+        # Range: bytes=0-N; отсутствие заголовка значит, что не сохранено ничего
+        committed = response.headers.get('Range')
+        return int(committed.rsplit('-', 1)[1]) + 1 if committed else 0
+    if response.status_code in (404, 410):
+        raise UploadError('Upload session expired', status=410)
+    raise UploadError(f'Storage rejected the upload ({response.status_code})', status=502)
+
+
+def storage_usage(user_id, bucket):
+    """
+    Bytes of original videos stored by the user, from the recorded sizes
+
+    Indexed videos count the size of their StoredContent, once per content
+    even if several of the user's videos share it; videos uploaded before
+    the content index (or stored without a hash) count the file_size of
+    their metadata. Renditions, streaming segments and previews are made
+    by the server: they are not charged and the videos/ prefix holding
+    them is never listed.
+    """
+    references = ContentReference.objects.filter(user_id=user_id)
+    stored = StoredContent.objects.filter(pk__in=references.values('content_id')).aggregate(total=Sum('size'))['total'] or 0
+
+    indexed = set(references.values_list('video_id', flat=True))
+    for blob in bucket.list_blobs(prefix=f"{user_id}/metadata/"):
+        video_id, extension = os.path.splitext(os.path.basename(blob.name))
+        if extension != '.json' or video_id in indexed:
+            continue
+        try:
+            stored += int(json.loads(blob.download_as_text()).get('file_size') or 0)
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.warning(f"Could not read file size from {blob.name}: {e}")
+    return stored
+
+
+def check_upload_allowed(user, user_id, upload_length, bucket):
+    """
+    Raises UploadError unless the user is an author with room for
+    upload_length more bytes. Usage counts stored originals plus sessions
+    that are still being uploaded or wait for processing.
+    """
+    profile = getattr(user, 'profile', None)
+    if not profile or not profile.is_author:
+        raise UploadError('Only authors can upload videos', status=403)
+
+    if upload_length <= 0 or upload_length > MAX_UPLOAD_SIZE:
+        raise UploadError('Invalid upload length', status=413 if upload_length > 0 else 400)
+
+    quota = getattr(settings, 'VIDEO_STORAGE_QUOTA', DEFAULT_STORAGE_QUOTA)
+    stored = storage_usage(user_id, bucket)
+    # Завершенная загрузка без video_id еще не попала ни в индекс, ни в метаданные
+    pending = UploadSession.objects.filter(
+        Q(status=UploadSession.STATUS_UPLOADING, expires_at__gt=timezone.now()) |
+        Q(status=UploadSession.STATUS_PROCESSING, video_id=''),
+        user=user
+    ).aggregate(total=Sum('upload_length'))['total'] or 0
+
+    if stored + pending + upload_length > quota:
+        raise UploadError(f'Storage quota exceeded: {stored + pending} of {quota} bytes used', status=413)
+
+
+def create_session(user, user_id, file_name, upload_length, content_type=None, origin=None):
+    """
+    Opens a GCS resumable session for a new video object
+
+    origin is the page origin for direct uploads: GCS then answers the
+    browser's cross-origin chunk requests for this session.
+    """
+    from .gcs_storage import get_bucket, new_video_id
+
+    bucket = get_bucket()
+    if not bucket:
+        raise UploadError('Could not access storage', status=503)
+
+    check_upload_allowed(user, user_id, upload_length, bucket)
+
+    file_name = os.path.basename(file_name or 'video.mp4')
+    extension = os.path.splitext(file_name)[1] or '.mp4'
+    content_type = content_type or 'video/mp4'
+    video_id = new_video_id(f"{uuid.uuid4()}_{file_name}")
+    gcs_path = f"{user_id}/videos/{video_id}{extension}"
+
+    session_url = bucket.blob(gcs_path).create_resumable_upload_session(
+        content_type=content_type,
+        size=upload_length,
+        origin=origin
+    )
+
+    session = UploadSession.objects.create(
+        user=user,
+        file_name=file_name,
+        content_type=content_type,
+        gcs_path=gcs_path,
+        session_url=session_url,
+        upload_length=upload_length,
+        expires_at=timezone.now() + SESSION_TTL
+    )
+    logger.info(f"Created upload session {session.id} for {gcs_path} ({upload_length} bytes)")
+    return session
+
+
+def _check_uploading(session):
+    if session.status != UploadSession.STATUS_UPLOADING:
+        raise UploadError(f'Upload is {session.status}', status=409)
+    if session.expires_at <= timezone.now():
+        raise UploadError('Upload session expired', status=410)
+
+
+def write_chunk(session, offset, stream, length):
+    """
+    Forwards a chunk to GCS and returns the new committed offset
+
+    GCS may persist less than it was sent; the client continues from the
+    returned offset in that case, as tus allows.
+    """
+    _check_uploading(session)
+
+    if offset != session.upload_offset:
+        raise UploadError(f'Offset mismatch, expected {session.upload_offset}', status=409)
+    if length <= 0 or length > MAX_CHUNK_SIZE or offset + length > session.upload_length:
+        raise UploadError('Invalid chunk length')
+    if offset + length < session.upload_length and length % CHUNK_ALIGNMENT:
+        raise UploadError(f'Chunks must be a multiple of {CHUNK_ALIGNMENT} bytes')
+
+    response = requests.put(
+        session.session_url,
+        data=_BoundedStream(stream, length),
+        headers={
+            'Content-Length': str(length),
+            'Content-Range': f'bytes {offset}-{offset + length - 1}/{session.upload_length}',
+        },
+        timeout=GCS_REQUEST_TIMEOUT
+    )
+    new_offset = _parse_committed_range(response, session.upload_length)
+
+    # Условное обновление: параллельный PATCH с тем же смещением не сдвинет offset дважды
+    updated = UploadSession.objects.filter(pk=session.pk, upload_offset=offset).update(
+        upload_offset=new_offset, updated_at=timezone.now()
+    )
+    if not updated:
+        raise UploadError('Concurrent upload to the same session', status=409)
+
+    session.upload_offset = new_offset
+    return new_offset
+
+
+def sync_offset(session):
+    """
+    Asks GCS for the committed offset. Used when resuming: a worker could
+    have died after GCS stored a chunk but before the row was updated.
+    """
+    if session.status != UploadSession.STATUS_UPLOADING or session.upload_offset == session.upload_length:
+        return session.upload_offset
+
+    response = requests.put(
+        session.session_url,
+        headers={'Content-Length': '0', 'Content-Range': f'bytes */{session.upload_length}'},
+        timeout=GCS_REQUEST_TIMEOUT
+    )
+    committed = _parse_committed_range(response, session.upload_length)
+    if committed != session.upload_offset:
+        UploadSession.objects.filter(pk=session.pk).update(upload_offset=committed, updated_at=timezone.now())
+        session.upload_offset = committed
+    return committed
+
+
+def abort_session(session):
+    """Cancels the GCS session so no object is created"""
+    _check_uploading(session)
+    _cancel_gcs_session(session)
+    session.delete()
+
+
+def verify_stored_object(session):
+    """Checks that the finished object exists and has the announced size"""
+    from .gcs_storage import get_bucket
+
+    bucket = get_bucket()
+    if not bucket:
+        raise UploadError('Could not access storage', status=503)
+
+    blob = bucket.get_blob(session.gcs_path)
+    if blob is None:
+        raise UploadError('Uploaded object not found', status=409)
+    if blob.size != session.upload_length:
+        raise UploadError(f'Uploaded object is {blob.size} bytes, expected {session.upload_length}', status=409)
+    return blob
+
+
+def _stage_thumbnail(session, thumbnail_path):
+    """Stores the thumbnail of the finalize form until a worker processes the upload"""
+    from .gcs_storage import get_bucket
+
+    user_id = session.gcs_path.split('/', 1)[0]
+    extension = os.path.splitext(thumbnail_path)[1] or '.jpg'
+    staged_path = f"{user_id}/uploads/{session.pk}_{uuid.uuid4().hex}{extension}"
+    get_bucket().blob(staged_path).upload_from_filename(thumbnail_path)
+    return staged_path
+
+
+def _delete_staged_thumbnail(path):
+    from .gcs_storage import get_bucket
+
+    try:
+        blob = get_bucket().get_blob(path)
+        if blob is not None:
+            blob.delete()
+    except Exception as e:
+        logger.warning(f"Could not delete staged thumbnail {path}: {e}")
+
+
+def finalize_session(session, title, description='', process_qualities=True, thumbnail_path=None):
+    """
+    Queues a fully uploaded session for processing
+
+    Only checks the stored object and records the form fields (a custom
+    thumbnail is staged in GCS), so the request returns at once whatever
+    the size of the video. Registration runs in transcode_worker.
+    """
+    _check_uploading(session)
+    # При прямой загрузке байты шли мимо Django - смещение знает только GCS
+    sync_offset(session)
+    if session.upload_offset != session.upload_length:
+        raise UploadError(f'Upload incomplete: {session.upload_offset} of {session.upload_length} bytes', status=409)
+    verify_stored_object(session)
+
+    staged_thumbnail = _stage_thumbnail(session, thumbnail_path) if thumbnail_path else ''
+
+    # Переход в processing выполняется ровно одним запросом
+    claimed = UploadSession.objects.filter(pk=session.pk, status=UploadSession.STATUS_UPLOADING).update(
+        status=UploadSession.STATUS_PROCESSING,
+        title=title,
+        description=description,
+        process_qualities=process_qualities,
+        thumbnail_path=staged_thumbnail,
+        attempts=0,
+        lease_expires_at=None,
+        updated_at=timezone.now()
+    )
+    if not claimed:
+        if staged_thumbnail:
+            _delete_staged_thumbnail(staged_thumbnail)
+        raise UploadError('Upload is already being finalized', status=409)
+
+    session.refresh_from_db()
+    logger.info(f"Upload {session.pk} queued for processing")
+
+
+def _claimable(now):
+    # Сессия ждет воркера или ее воркер перестал работать (пока есть попытки)
+    return Q(status=UploadSession.STATUS_PROCESSING, attempts__lt=PROCESSING_ATTEMPTS) & \
+        (Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now))
+
+
+def fail_abandoned_uploads(now):
+    """Fails uploads whose worker stopped on every attempt, so they are not claimed forever"""
+    failed = UploadSession.objects.filter(
+        status=UploadSession.STATUS_PROCESSING, attempts__gte=PROCESSING_ATTEMPTS, lease_expires_at__lt=now
+    ).update(
+        status=UploadSession.STATUS_FAILED,
+        error='Worker stopped during the last processing attempt',
+        lease_expires_at=None,
+        updated_at=now
+    )
+    if failed:
+        logger.error(f"{failed} uploads failed permanently: their workers stopped on every attempt")
+    return failed
+
+
+def claim_upload(now=None):
+    """Takes the oldest finalized upload waiting for processing, or returns None"""
+    now = now or timezone.now()
+    fail_abandoned_uploads(now)
+    candidates = UploadSession.objects.filter(_claimable(now)).order_by('updated_at').values_list('pk', flat=True)
+
+    for upload_id in candidates[:CLAIM_CANDIDATES]:
+        # Условие повторяется в UPDATE: загрузку получает только один воркер
+        claimed = UploadSession.objects.filter(_claimable(now), pk=upload_id).update(
+            lease_expires_at=now + PROCESSING_LEASE, attempts=F('attempts') + 1, updated_at=now
+        )
+        if claimed:
+            return UploadSession.objects.get(pk=upload_id)
+    return None
+
+
+def process_next_upload(worker_id):
+    """Claims and processes one finalized upload; returns False if none is waiting"""
+    session = claim_upload()
+    if not session:
+        return False
+    logger.info(f"Worker {worker_id} processing upload {session.pk} (attempt {session.attempts})")
+    process_upload(session)
+    return True
+
+
+def process_upload(session):
+    """
+    Registers the video of a session claimed for processing; sets the
+    session to complete or failed. Safe to repeat: a registered video is
+    not registered again and transcoding is queued once.
+    """
+    from .content_index import blob_sha256, enqueue_transcode_once
+    from .gcs_storage import create_auto_thumbnail, get_bucket, register_uploaded_video, upload_thumbnail
+
+    user_id = session.gcs_path.split('/', 1)[0]
+    work_dir = None
+
+    try:
+        video_id = session.video_id
+        if not video_id:
+            # Куски шли через разные воркеры (или напрямую в GCS): хэш считается по сохраненному
+            # объекту здесь, в фоновом воркере - запрос finalize объект не читает
+            sha256 = None
+            try:
+                sha256 = blob_sha256(get_bucket().blob(session.gcs_path))
+            except Exception as e:
+                logger.warning(f"Could not hash upload {session.pk}, it is stored without deduplication: {e}")
+
+            video_id = register_uploaded_video(
+                user_id, session.gcs_path, title=session.title, description=session.description, sha256=sha256
+            )
+            if not video_id:
+                raise RuntimeError('Could not register uploaded video')
+
+            UploadSession.objects.filter(pk=session.pk).update(video_id=video_id, updated_at=timezone.now())
+            session.video_id = video_id
+
+        if session.thumbnail_path:
+            work_dir = tempfile.mkdtemp(prefix='upload-thumbnail-')
+            thumbnail_path = os.path.join(work_dir, os.path.basename(session.thumbnail_path))
+            get_bucket().blob(session.thumbnail_path).download_to_filename(thumbnail_path)
+            upload_thumbnail(user_id, video_id, thumbnail_path)
+            _delete_staged_thumbnail(session.thumbnail_path)
+        else:
+            create_auto_thumbnail(user_id, video_id)
+        # Статус complete не ждет транскодирования: его выполняет transcode_worker
+        if session.process_qualities:
+            enqueue_transcode_once(user_id, video_id, session.gcs_path, source_size=session.upload_length)
+
+        session.status = UploadSession.STATUS_COMPLETE
+        UploadSession.objects.filter(pk=session.pk).update(
+            status=session.status, thumbnail_path='', lease_expires_at=None, updated_at=timezone.now()
+        )
+        logger.info(f"Upload {session.pk} processed as video {video_id}")
+    except Exception as e:
+        logger.error(f"Error processing upload {session.pk}: {e}")
+        session.status, session.error = UploadSession.STATUS_FAILED, str(e)
+        UploadSession.objects.filter(pk=session.pk).update(
+            status=session.status, error=session.error, lease_expires_at=None, updated_at=timezone.now()
+        )
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _cancel_gcs_session(session):
+    try:
+        requests.delete(session.session_url, timeout=GCS_REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        logger.warning(f"Could not cancel GCS session for upload {session.id}: {e}")
+
+
+def cleanup_sessions(now=None):
+    """
+    Sweeps upload sessions (run periodically by `manage.py cleanup_uploads`)
+
+    - expired sessions that were never finalized: the GCS session is
+      cancelled (so no partial object is left) and the row deleted
+    - finished sessions past their expiry: rows deleted, together with the
+      stored object and staged thumbnail of a failed upload that was never
+      registered
+
+    Uploads interrupted during processing need no sweep: their lease
+    expires and a worker claims them again.
+
+    Returns:
+        dict: number of sessions per action
+    """
+    from .gcs_storage import get_bucket
+
+    now = now or timezone.now()
+    result = {'aborted': 0, 'purged': 0}
+
+    for session in UploadSession.objects.filter(status=UploadSession.STATUS_UPLOADING, expires_at__lte=now):
+        _cancel_gcs_session(session)
+        session.delete()
+        result['aborted'] += 1
+
+    finished = UploadSession.objects.filter(
+        status__in=(UploadSession.STATUS_COMPLETE, UploadSession.STATUS_FAILED), expires_at__lte=now
+    )
+    for session in finished:
+        if session.status == UploadSession.STATUS_FAILED and not session.video_id:
+            try:
+                bucket = get_bucket()
+                blob = bucket.get_blob(session.gcs_path) if bucket else None
+                if blob is not None:
+                    blob.delete()
+            except Exception as e:
+                logger.error(f"Could not delete object of failed upload {session.pk}: {e}")
+                continue
+        if session.thumbnail_path:
+            _delete_staged_thumbnail(session.thumbnail_path)
+        session.delete()
+        result['purged'] += 1
+
+    logger.info(f"Upload sessions cleaned up: {result}")
+    return result
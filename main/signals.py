@@ -1,7 +1,7 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserProfile
+from .models import UserProfile, Subscription, ChannelStats
 from django.conf import settings
 import logging
 
@@ -19,4 +19,15 @@ def create_profile(sender, instance, created, **kwargs):
 def save_profile(sender, instance, **kwargs):
     """Save the UserProfile when the User is updated."""
     if hasattr(instance, 'profile'):
-        instance.profile.save()
\ No newline at end of file
+        instance.profile.save()
+
+@receiver(post_save, sender=Subscription)
+def increment_subscriber_count(sender, instance, created, **kwargs):
+    """Keep ChannelStats.subscriber_count in sync when a subscription is created."""
+    if created:
+        ChannelStats.adjust_subscribers(instance.channel_id, 1)
+
+@receiver(post_delete, sender=Subscription)
+def decrement_subscriber_count(sender, instance, **kwargs):
+    """Keep ChannelStats.subscriber_count in sync when a subscription is removed."""
+    ChannelStats.adjust_subscribers(instance.channel_id, -1)
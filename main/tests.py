@@ -1,3 +1,1000 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+
+from . import comments, content_index, gcs_storage, gcs_views, resumable_uploads, transcode_queue, video_quality
+from .models import ContentReference, PlayerEvent, StoredContent, TranscodeJob, UploadSession, VideoView
+from .player_events import aggregate_player_events, build_player_events, parse_event_batch
+
+
+class PlayerEventsTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_build_rejects_only_invalid_events(self):
+        raw = [
+            {'type': 'view_start', 'video_id': '@alice__lecture1'},
+            {'type': 'view_start', 'video_id': 42},
+            {'type': 'heartbeat', 'video_id': ['@alice__lecture1']},
+            {'type': 'unknown', 'video_id': '@alice__lecture1'},
+            {'type': 'seek', 'video_id': 'lecture2', 'position': 'x'},
+            'not an event',
+        ]
+        events, rejected = build_player_events(raw, session_id='s1')
+        self.assertEqual(rejected, 5)
+        self.assertEqual(len(events), 1)
+        self.assertEqual((events[0].video_owner, events[0].video_id), ('@alice', 'lecture1'))
+        self.assertEqual(events[0].session_id, 's1')
+
+    def test_build_uses_batch_defaults(self):
+        events, rejected = build_player_events(
+            [{'type': 'heartbeat', 'position': 12.5}], session_id='s1',
+            default_video_id='lecture1', default_owner='@alice'
+        )
+        self.assertEqual(rejected, 0)
+        self.assertEqual((events[0].video_owner, events[0].video_id, events[0].position), ('@alice', 'lecture1', 12.5))
+
+    def test_parse_rejects_non_object_body(self):
+        request = self.factory.post('/', data='[1, 2]', content_type='application/json')
+        with self.assertRaises(ValueError):
+            parse_event_batch(request)
+
+    def test_parse_form_beacon(self):
+        request = self.factory.post('/', {'events': json.dumps([{'type': 'seek'}]), 'session_id': 's1'})
+        data, raw_events = parse_event_batch(request)
+        self.assertEqual(data['session_id'], 's1')
+        self.assertEqual(raw_events, [{'type': 'seek'}])
+
+    @mock.patch('main.gcs_storage.update_video_metadata', return_value=True)
+    @mock.patch('main.gcs_storage.get_video_metadata')
+    def test_aggregate_counts_inserted_views_only(self, get_metadata, update_metadata):
+        get_metadata.return_value = {'views': 10, 'watch_time_seconds': 0}
+        user = User.objects.create(username='@bob')
+        VideoView.objects.create(session_id='seen', video_id='lecture1', video_owner='@alice')
+        PlayerEvent.objects.bulk_create([
+            PlayerEvent(session_id='seen', video_id='lecture1', video_owner='@alice', event_type='view_start'),
+            PlayerEvent(session_id='new', video_id='lecture1', video_owner='@alice', event_type='view_start'),
+            PlayerEvent(session_id='new', video_id='lecture1', video_owner='@alice', event_type='view_start'),
+            PlayerEvent(user=user, video_id='lecture1', video_owner='@alice', event_type='view_start'),
+            PlayerEvent(user=user, video_id='lecture1', video_owner='@alice', event_type='heartbeat'),
+        ])
+
+        result = aggregate_player_events()
+
+        self.assertEqual(result, {'events': 5, 'views': 2})
+        metadata = update_metadata.call_args[0][2]
+        self.assertEqual(metadata['views'], 12)
+        self.assertEqual(metadata['watch_time_seconds'], 15)
+        self.assertFalse(PlayerEvent.objects.filter(processed=False).exists())
+        # A second run has nothing left to count
+        self.assertEqual(aggregate_player_events(), {'events': 0, 'views': 0})
+
+    @mock.patch('main.gcs_storage.update_video_metadata', return_value=False)
+    @mock.patch('main.gcs_storage.get_video_metadata', return_value={'views': 0})
+    def test_aggregate_keeps_events_when_metadata_update_fails(self, get_metadata, update_metadata):
+        PlayerEvent.objects.create(session_id='s1', video_id='lecture1', video_owner='@alice', event_type='view_start')
+
+        self.assertEqual(aggregate_player_events(), {'events': 0, 'views': 0})
+        self.assertTrue(PlayerEvent.objects.filter(processed=False).exists())
+        self.assertFalse(VideoView.objects.exists())
+
+
+class FakeBlobWriter(io.BytesIO):
+    """Like a resumable upload: the object appears only when the writer is closed"""
+
+    def __init__(self, blob):
+        super().__init__()
+        self.blob = blob
+
+    def close(self):
+        if not self.closed:
+            self.blob.upload_from_string(self.getvalue())
+        super().close()
+
+
+class FakeBlob:
+    """In-memory stand-in for google.cloud.storage.Blob"""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def generation(self):
+        return self.bucket.objects[self.name][1] if self.name in self.bucket.objects else None
+
+    @property
+    def size(self):
+        return len(self.bucket.objects[self.name][0]) if self.name in self.bucket.objects else None
+
+    content_type = None
+
+    def exists(self):
+        return self.name in self.bucket.objects
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        from google.api_core.exceptions import PreconditionFailed
+
+        if if_generation_match is not None and (self.generation or 0) != if_generation_match:
+            raise PreconditionFailed(self.name)
+        if isinstance(data, str):
+            data = data.encode()
+        self.bucket.generation += 1
+        self.bucket.objects[self.name] = (data, self.bucket.generation)
+
+    def upload_from_filename(self, filename, content_type=None):
+        with open(filename, 'rb') as f:
+            self.upload_from_string(f.read(), content_type=content_type)
+
+    def download_as_bytes(self):
+        from google.api_core.exceptions import NotFound
+
+        if self.name not in self.bucket.objects:
+            raise NotFound(self.name)
+        return self.bucket.objects[self.name][0]
+
+    def download_as_text(self):
+        return self.download_as_bytes().decode()
+
+    def download_to_filename(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.download_as_bytes())
+
+    def open(self, mode='rb', chunk_size=None, content_type=None, ignore_flush=False):
+        if mode == 'wb':
+            return FakeBlobWriter(self)
+        return io.BytesIO(self.download_as_bytes())
+
+    def delete(self):
+        from google.api_core.exceptions import NotFound
+
+        if self.bucket.objects.pop(self.name, None) is None:
+            raise NotFound(self.name)
+
+    def generate_signed_url(self, **kwargs):
+        return f"https://storage.example/{self.name}"
+
+
+class FakeBucket:
+    """In-memory stand-in for google.cloud.storage.Bucket"""
+
+    name = 'test-bucket'
+
+    def __init__(self):
+        self.objects = {}
+        self.generation = 0
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        return FakeBlob(self, name) if name in self.objects else None
+
+    def list_blobs(self, prefix=''):
+        return [FakeBlob(self, name) for name in sorted(self.objects) if name.startswith(prefix)]
+
+    def put_json(self, name, data):
+        self.blob(name).upload_from_string(json.dumps(data))
+
+    def get_json(self, name):
+        return json.loads(self.blob(name).download_as_text())
+
+
+class CommentSegmentsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.bucket = FakeBucket()
+        patcher = mock.patch('main.gcs_storage.get_bucket', return_value=self.bucket)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.prefix = gcs_storage._comment_segments_prefix('@alice', 'lecture1')
+
+    def put_segment(self, name, entry):
+        self.bucket.put_json(f"{self.prefix}{name}.json", entry)
+
+    def test_reply_sorted_before_its_comment_is_compacted(self):
+        # Часы воркера, записавшего ответ, отстают: его сегмент листингуется первым
+        self.put_segment('0000000000001_b', {'type': 'reply', 'comment_id': 'c1', 'reply': {'id': 'r1'}})
+        self.put_segment('0000000000002_a', {'type': 'comment', 'comment': {'id': 'c1'}})
+
+        self.assertEqual(gcs_storage.compact_video_comments('@alice', 'lecture1'), 2)
+
+        snapshot = self.bucket.get_json(gcs_storage._comments_path('@alice', 'lecture1'))
+        self.assertEqual([reply['id'] for reply in snapshot['comments'][0]['replies']], ['r1'])
+        self.assertEqual(self.bucket.list_blobs(self.prefix), [])
+
+    def test_compaction_keeps_orphan_replies_in_tail(self):
+        self.put_segment('0000000000001_a', {'type': 'comment', 'comment': {'id': 'c1'}})
+        self.put_segment('0000000000002_b', {'type': 'reply', 'comment_id': 'missing', 'reply': {'id': 'r1'}})
+
+        self.assertEqual(gcs_storage.compact_video_comments('@alice', 'lecture1'), 1)
+        self.assertEqual([blob.name for blob in self.bucket.list_blobs(self.prefix)], [f"{self.prefix}0000000000002_b.json"])
+
+        # Compacting again is a no-op and the snapshot is unchanged
+        self.assertEqual(gcs_storage.compact_video_comments('@alice', 'lecture1'), 0)
+        comments = gcs_storage.get_video_comments('@alice', 'lecture1')['comments']
+        self.assertEqual([(comment['id'], comment['replies']) for comment in comments], [('c1', [])])
+
+    def test_add_reply_requires_existing_comment(self):
+        self.assertIsNone(gcs_storage.add_reply('@alice', 'lecture1', 'missing', '@bob', 'text'))
+        self.assertEqual(self.bucket.list_blobs(self.prefix), [])
+
+        comment = gcs_storage.add_comment('@alice', 'lecture1', '@bob', 'question')
+        reply = gcs_storage.add_reply('@alice', 'lecture1', comment['id'], '@carol', 'answer')
+
+        self.assertIsNotNone(reply)
+        comments = gcs_storage.get_video_comments('@alice', 'lecture1')['comments']
+        self.assertEqual(comments[0]['replies'][0]['id'], reply['id'])
+
+    def test_add_reply_to_compacted_comment(self):
+        comment = gcs_storage.add_comment('@alice', 'lecture1', '@bob', 'question')
+        gcs_storage.compact_video_comments('@alice', 'lecture1')
+
+        self.assertIsNotNone(gcs_storage.add_reply('@alice', 'lecture1', comment['id'], '@carol', 'answer'))
+
+
+    def test_compaction_between_reads_does_not_hide_comments(self):
+        comment = gcs_storage.add_comment('@alice', 'lecture1', '@bob', 'question')
+        load_snapshot = gcs_storage._load_comments_snapshot
+        compacted = []
+
+        def compact_after_read(*args):
+            result = load_snapshot(*args)
+            if not compacted:
+                compacted.append(True)
+                gcs_storage.compact_video_comments('@alice', 'lecture1')
+            return result
+
+        with mock.patch('main.gcs_storage._load_comments_snapshot', side_effect=compact_after_read):
+            comments = gcs_storage.get_video_comments('@alice', 'lecture1')['comments']
+
+        self.assertEqual([c['id'] for c in comments], [comment['id']])
+
+    def test_segment_already_in_snapshot_is_read_once(self):
+        comment = gcs_storage.add_comment('@alice', 'lecture1', '@bob', 'question')
+        # Компакция записала снапшот, но еще не удалила сегмент
+        self.bucket.put_json(gcs_storage._comments_path('@alice', 'lecture1'), {'comments': [dict(comment, replies=[])]})
+
+        comments = gcs_storage.get_video_comments('@alice', 'lecture1')['comments']
+
+        self.assertEqual([c['id'] for c in comments], [comment['id']])
+
+
+    def test_repeated_reads_download_only_new_segments(self):
+        first = gcs_storage.add_comment('@alice', 'lecture1', '@bob', 'first')
+        gcs_storage.compact_video_comments('@alice', 'lecture1')
+        gcs_storage.get_video_comments('@alice', 'lecture1')
+        second = gcs_storage.add_comment('@alice', 'lecture1', '@bob', 'second')
+
+        with mock.patch.object(FakeBlob, 'download_as_bytes', autospec=True,
+                               side_effect=FakeBlob.download_as_bytes) as download:
+            comments = gcs_storage.get_video_comments('@alice', 'lecture1')['comments']
+            self.assertEqual(len(download.call_args_list), 1)
+            self.assertTrue(download.call_args.args[0].name.startswith(self.prefix))
+
+            download.reset_mock()
+            self.assertEqual(gcs_storage.get_video_comments('@alice', 'lecture1')['comments'], comments)
+            self.assertFalse(download.called)
+
+        self.assertEqual({c['id'] for c in comments}, {first['id'], second['id']})
+
+        # Компакция перезаписывает снапшот - набор читается заново
+        gcs_storage.compact_video_comments('@alice', 'lecture1')
+        self.assertEqual(len(gcs_storage.get_video_comments('@alice', 'lecture1')['comments']), 2)
+
+
+class StreamedUploadTests(TestCase):
+    def setUp(self):
+        self.bucket = FakeBucket()
+        for target in ('main.gcs_storage.get_bucket', 'main.gcs_views.get_bucket'):
+            patcher = mock.patch(target, return_value=self.bucket)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.user = User.objects.create(username='@alice')
+
+    def post(self, data, user=None, enforce_csrf=False):
+        request = RequestFactory().post('/api/upload-video/', data)
+        request.user = user or self.user
+        request._dont_enforce_csrf_checks = not enforce_csrf
+        # With a cookie but no form token, CSRF fails only after the body has been read
+        request.COOKIES['csrftoken'] = 'x' * 32
+        return gcs_views.upload_video_to_gcs(request)
+
+    def video(self):
+        return SimpleUploadedFile('lecture.mp4', b'video bytes', 'video/mp4')
+
+    def stored_videos(self):
+        return self.bucket.list_blobs('@alice/videos/')
+
+    def test_anonymous_request_is_rejected_before_streaming(self):
+        from django.contrib.auth.models import AnonymousUser
+
+        response = self.post({'title': 'Lecture', 'video_file': self.video()}, user=AnonymousUser())
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.bucket.objects, {})
+
+    def test_csrf_failure_discards_streamed_object(self):
+        response = self.post({'title': 'Lecture', 'video_file': self.video()}, enforce_csrf=True)
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.stored_videos(), [])
+
+    def test_invalid_form_discards_streamed_object(self):
+        response = self.post({'video_file': self.video()})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stored_videos(), [])
+
+    @mock.patch('main.gcs_views.register_uploaded_video', side_effect=RuntimeError('boom'))
+    def test_error_discards_streamed_object(self, register):
+        response = self.post({'title': 'Lecture', 'video_file': self.video()})
+
+        self.assertEqual(response.status_code, 500)
+        self.assertTrue(register.called)
+        self.assertEqual(self.stored_videos(), [])
+
+    @mock.patch('main.gcs_views.get_video_metadata', return_value=None)
+    @mock.patch('main.gcs_views.register_uploaded_video', return_value='lecture1')
+    def test_registered_video_is_kept_on_later_error(self, register, get_metadata):
+        response = self.post({'title': 'Lecture', 'video_file': self.video(), 'process_qualities': 'false'})
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(len(self.stored_videos()), 1)
+
+
+class UploadSessionTests(TestCase):
+    def setUp(self):
+        self.bucket = FakeBucket()
+        self.user = User.objects.create(username='@alice')
+        patches = {
+            'main.gcs_storage.get_bucket': mock.DEFAULT,
+            'main.gcs_storage.register_uploaded_video': mock.DEFAULT,
+            'main.gcs_storage.create_auto_thumbnail': mock.DEFAULT,
+            'main.content_index.enqueue_transcode_once': mock.DEFAULT,
+            'main.resumable_uploads.sync_offset': mock.DEFAULT,
+            'main.resumable_uploads.verify_stored_object': mock.DEFAULT,
+            'main.resumable_uploads.requests.delete': mock.DEFAULT,
+        }
+        self.mocks = {}
+        for target in patches:
+            patcher = mock.patch(target)
+            self.mocks[target.rsplit('.', 1)[1]] = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.mocks['get_bucket'].return_value = self.bucket
+        self.mocks['register_uploaded_video'].return_value = 'lecture1'
+
+    def create_session(self, **fields):
+        defaults = {
+            'user': self.user,
+            'file_name': 'lecture.mp4',
+            'gcs_path': '@alice/videos/lecture1.mp4',
+            'session_url': 'https://storage.example/session',
+            'upload_length': 5,
+            'upload_offset': 5,
+            'expires_at': timezone.now() + timedelta(days=1),
+        }
+        defaults.update(fields)
+        session = UploadSession.objects.create(**defaults)
+        self.bucket.blob(session.gcs_path).upload_from_string(b'video')
+        return session
+
+    def test_finalize_only_queues_processing(self):
+        session = self.create_session()
+
+        resumable_uploads.finalize_session(session, 'Lecture', 'About', process_qualities=True)
+
+        session.refresh_from_db()
+        self.assertEqual((session.status, session.title, session.video_id), ('processing', 'Lecture', ''))
+        self.assertFalse(self.mocks['register_uploaded_video'].called)
+        self.assertFalse(self.mocks['enqueue_transcode_once'].called)
+
+        self.assertTrue(resumable_uploads.process_next_upload('w1'))
+
+        session.refresh_from_db()
+        self.assertEqual((session.status, session.video_id, session.attempts), ('complete', 'lecture1', 1))
+        register = self.mocks['register_uploaded_video']
+        self.assertEqual(len(register.call_args.kwargs['sha256']), 64)
+        self.mocks['enqueue_transcode_once'].assert_called_once_with(
+            '@alice', 'lecture1', session.gcs_path, source_size=5
+        )
+        self.assertFalse(resumable_uploads.process_next_upload('w1'))
+
+    def test_finalize_request_does_not_read_the_object(self):
+        session = self.create_session()
+
+        with mock.patch('main.content_index.blob_sha256', return_value='a' * 64) as blob_sha256:
+            resumable_uploads.finalize_session(session, 'Lecture')
+            self.assertFalse(blob_sha256.called)
+
+            resumable_uploads.process_next_upload('w1')
+        blob_sha256.assert_called_once()
+        self.assertEqual(self.mocks['register_uploaded_video'].call_args.kwargs['sha256'], 'a' * 64)
+
+    def test_finalize_view_answers_accepted(self):
+        session = self.create_session()
+        request = RequestFactory().post(f'/api/uploads/{session.pk}/finalize/', {'title': 'Lecture'})
+        request.user = self.user
+
+        response = gcs_views.finalize_upload_session(request, session.pk)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(json.loads(response.content)['status'], 'processing')
+
+    def test_finalize_is_claimed_once(self):
+        session = self.create_session(status=UploadSession.STATUS_PROCESSING)
+
+        with self.assertRaises(resumable_uploads.UploadError) as error:
+            resumable_uploads.finalize_session(session, 'Lecture')
+        self.assertEqual(error.exception.status, 409)
+
+    @mock.patch('main.gcs_storage.upload_thumbnail')
+    def test_custom_thumbnail_is_staged_for_the_worker(self, upload_thumbnail):
+        session = self.create_session()
+        thumbnail = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
+        thumbnail.write(b'jpeg')
+        thumbnail.close()
+        self.addCleanup(os.remove, thumbnail.name)
+
+        resumable_uploads.finalize_session(session, 'Lecture', thumbnail_path=thumbnail.name)
+        staged = UploadSession.objects.get(pk=session.pk).thumbnail_path
+        self.assertEqual(self.bucket.blob(staged).download_as_bytes(), b'jpeg')
+
+        def check_upload(user_id, video_id, path):
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'jpeg')
+        upload_thumbnail.side_effect = check_upload
+        resumable_uploads.process_next_upload('w1')
+
+        self.assertEqual(upload_thumbnail.call_args.args[:2], ('@alice', 'lecture1'))
+        self.assertFalse(self.mocks['create_auto_thumbnail'].called)
+        self.assertIsNone(self.bucket.get_blob(staged))
+
+    def test_leased_upload_is_not_claimed_twice(self):
+        self.create_session(status=UploadSession.STATUS_PROCESSING)
+
+        self.assertIsNotNone(resumable_uploads.claim_upload())
+        self.assertIsNone(resumable_uploads.claim_upload())
+
+    def test_interrupted_processing_is_repeated_without_registering_twice(self):
+        session = self.create_session(status=UploadSession.STATUS_PROCESSING, video_id='lecture1', title='Lecture',
+                                      attempts=1, lease_expires_at=timezone.now() - timedelta(minutes=1))
+
+        self.assertTrue(resumable_uploads.process_next_upload('w2'))
+
+        session.refresh_from_db()
+        self.assertEqual((session.status, session.attempts), ('complete', 2))
+        self.assertFalse(self.mocks['register_uploaded_video'].called)
+        self.assertTrue(self.mocks['enqueue_transcode_once'].called)
+
+    def test_upload_that_stops_every_worker_fails(self):
+        session = self.create_session(status=UploadSession.STATUS_PROCESSING,
+                                      attempts=resumable_uploads.PROCESSING_ATTEMPTS,
+                                      lease_expires_at=timezone.now() - timedelta(minutes=1))
+
+        self.assertFalse(resumable_uploads.process_next_upload('w1'))
+
+        session.refresh_from_db()
+        self.assertEqual(session.status, 'failed')
+        self.assertFalse(self.mocks['register_uploaded_video'].called)
+
+    def test_failed_registration_marks_session_failed(self):
+        self.mocks['register_uploaded_video'].return_value = None
+        session = self.create_session(status=UploadSession.STATUS_PROCESSING)
+
+        resumable_uploads.process_next_upload('w1')
+
+        session.refresh_from_db()
+        self.assertEqual(session.status, 'failed')
+        self.assertIn('register', session.error)
+
+    def test_cleanup_sessions(self):
+        expired = self.create_session(gcs_path='@alice/videos/a.mp4', upload_offset=0,
+                                      expires_at=timezone.now() - timedelta(minutes=1))
+        busy = self.create_session(gcs_path='@alice/videos/c.mp4', status=UploadSession.STATUS_PROCESSING)
+        failed = self.create_session(gcs_path='@alice/videos/d.mp4', status=UploadSession.STATUS_FAILED,
+                                     thumbnail_path='@alice/uploads/d.jpg',
+                                     expires_at=timezone.now() - timedelta(minutes=1))
+        self.bucket.blob(failed.thumbnail_path).upload_from_string(b'jpeg')
+
+        result = resumable_uploads.cleanup_sessions()
+
+        self.assertEqual(result, {'aborted': 1, 'purged': 1})
+        self.mocks['delete'].assert_called_once_with(expired.session_url, timeout=resumable_uploads.GCS_REQUEST_TIMEOUT)
+        self.assertFalse(UploadSession.objects.filter(pk__in=[expired.pk, failed.pk]).exists())
+        self.assertEqual(UploadSession.objects.get(pk=busy.pk).status, 'processing')
+        self.assertIsNone(self.bucket.get_blob(failed.gcs_path))
+        self.assertIsNone(self.bucket.get_blob(failed.thumbnail_path))
+
+
+@override_settings(VIDEO_STORAGE_QUOTA=100)
+class UploadQuotaTests(TestCase):
+    def setUp(self):
+        self.bucket = FakeBucket()
+        with mock.patch('main.gcs_storage.get_bucket', return_value=self.bucket):
+            self.user = User.objects.create(username='@alice')
+        self.user.profile.is_author = True
+        self.user.profile.save()
+
+        shared = StoredContent.objects.create(sha256='a' * 64, source_path='@alice/videos/v1.mp4', size=40,
+                                              user_id='@alice', video_id='v1')
+        for video_id in ('v1', 'v2'):
+            ContentReference.objects.create(content=shared, user_id='@alice', video_id=video_id)
+            self.bucket.put_json(f'@alice/metadata/{video_id}.json', {'file_size': 999})
+        # Видео, загруженное до индекса содержимого
+        self.bucket.put_json('@alice/metadata/v0.json', {'file_size': 25})
+        self.bucket.blob('@alice/metadata/.keep').upload_from_string('')
+        # Варианты качества и сегменты создает сервер
+        self.bucket.blob('@alice/videos/v1_720p.mp4').upload_from_string(b'x' * 1000)
+        self.bucket.blob('@alice/videos/v1/hls/720p/0001.m4s').upload_from_string(b'x' * 1000)
+
+        for status, length in (('uploading', 10), ('processing', 5), ('complete', 50)):
+            UploadSession.objects.create(
+                user=self.user, file_name='a.mp4', gcs_path='@alice/videos/a.mp4', session_url='x',
+                upload_length=length, status=status, expires_at=timezone.now() + timedelta(days=1)
+            )
+
+    def test_usage_counts_recorded_original_sizes(self):
+        self.assertEqual(resumable_uploads.storage_usage('@alice', self.bucket), 65)
+
+    def test_quota_includes_pending_uploads(self):
+        resumable_uploads.check_upload_allowed(self.user, '@alice', 20, self.bucket)
+
+        with self.assertRaises(resumable_uploads.UploadError) as error:
+            resumable_uploads.check_upload_allowed(self.user, '@alice', 21, self.bucket)
+        self.assertEqual(error.exception.status, 413)
+
+    def test_only_authors_upload(self):
+        self.user.profile.is_author = False
+        self.user.profile.save()
+
+        with self.assertRaises(resumable_uploads.UploadError) as error:
+            resumable_uploads.check_upload_allowed(self.user, '@alice', 1, self.bucket)
+        self.assertEqual(error.exception.status, 403)
+
+
+class TranscodeQueueTests(TestCase):
+    def enqueue(self, video_id, **fields):
+        return TranscodeJob.objects.create(
+            user_id='@alice', video_id=video_id, source_path=f'@alice/videos/{video_id}.mp4', **fields
+        )
+
+    def expire_lease(self, job):
+        TranscodeJob.objects.filter(pk=job.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_claim_order(self):
+        self.enqueue('large', source_size=900)
+        self.enqueue('small', source_size=100)
+        self.enqueue('urgent', source_size=5000, priority=5)
+        starved = self.enqueue('starved', source_size=10000)
+        TranscodeJob.objects.filter(pk=starved.pk).update(
+            created_at=timezone.now() - transcode_queue.SJF_MAX_WAIT - timedelta(minutes=1)
+        )
+
+        claimed = [transcode_queue.claim_job('w1').video_id for _ in range(4)]
+
+        self.assertEqual(claimed, ['urgent', 'starved', 'small', 'large'])
+        self.assertIsNone(transcode_queue.claim_job('w1'))
+
+    def test_expired_lease_is_reclaimed_until_attempts_run_out(self):
+        job = self.enqueue('crashy', max_attempts=2)
+
+        self.assertEqual(transcode_queue.claim_job('w1').pk, job.pk)
+        self.expire_lease(job)
+        reclaimed = transcode_queue.claim_job('w2')
+        self.assertEqual((reclaimed.pk, reclaimed.attempts, reclaimed.lease_owner), (job.pk, 2, 'w2'))
+        self.assertFalse(transcode_queue.renew_lease(job, 'w1'))
+
+        self.expire_lease(job)
+        self.assertIsNone(transcode_queue.claim_job('w3'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.lease_owner), (TranscodeJob.STATUS_FAILED, ''))
+
+    @mock.patch('main.gcs_storage.get_video_metadata', return_value={'height': 720})
+    def test_encode_error_is_retried(self, get_metadata):
+        self.enqueue('lecture1')
+        job = transcode_queue.claim_job('w1')
+
+        with mock.patch('main.gcs_storage.process_stored_video_qualities',
+                        side_effect=video_quality.QualityProcessingError('ffmpeg exited with code 1')):
+            transcode_queue.run_job(job, 'w1')
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.lease_owner), (TranscodeJob.STATUS_QUEUED, 1, ''))
+        self.assertIn('ffmpeg', job.error)
+        self.assertGreater(job.run_after, timezone.now())
+
+    @mock.patch('main.gcs_storage.get_video_metadata', return_value={'height': 144})
+    def test_source_below_every_preset_completes(self, get_metadata):
+        self.enqueue('tiny')
+        job = transcode_queue.claim_job('w1')
+
+        with mock.patch('main.gcs_storage.process_stored_video_qualities', return_value={}):
+            transcode_queue.run_job(job, 'w1')
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result), (TranscodeJob.STATUS_DONE, {}))
+
+    def test_last_failure_is_permanent(self):
+        job = self.enqueue('broken', max_attempts=1)
+        job = transcode_queue.claim_job('w1')
+
+        transcode_queue.fail_job(job, 'w1', 'boom')
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, TranscodeJob.STATUS_FAILED)
+        self.assertIsNone(transcode_queue.claim_job('w1'))
+
+
+class QualityVariantsTests(TestCase):
+    media = {'width': 1280, 'height': 720, 'duration_seconds': 10}
+
+    @mock.patch('main.video_quality.encode_renditions', return_value=set())
+    @mock.patch('main.video_quality.build_encoding_ladder')
+    def test_failed_encode_raises(self, build_ladder, encode):
+        build_ladder.return_value = ({'360p': video_quality.QUALITY_PRESETS['360p']}, {})
+
+        with self.assertRaises(video_quality.QualityProcessingError):
+            video_quality.create_quality_variants(
+                'source.mp4', '@alice', 'lecture1', media_info=self.media, bucket=FakeBucket()
+            )
+
+    @mock.patch('main.video_quality.encode_renditions')
+    @mock.patch('main.video_quality.build_encoding_ladder', return_value=({}, {}))
+    def test_source_below_every_preset_returns_empty(self, build_ladder, encode):
+        variants = video_quality.create_quality_variants(
+            'source.mp4', '@alice', 'lecture1', media_info=self.media, bucket=FakeBucket()
+        )
+
+        self.assertEqual(variants, {})
+        self.assertFalse(encode.called)
+
+
+class EncodingLadderTests(TestCase):
+    video_info = {'height': 1080, 'duration': 120}
+
+    def probe(self, kbps, returncode=0):
+        """Fake ffmpeg run writing each probe output at the given bitrate"""
+        sampled_seconds = video_quality.PROBE_SAMPLES * video_quality.PROBE_SAMPLE_SECONDS
+
+        def run(cmd, **kwargs):
+            for arg in cmd:
+                name = os.path.basename(arg)
+                if name.startswith('probe_') and returncode == 0:
+                    with open(arg, 'wb') as output:
+                        output.truncate(kbps[name[len('probe_'):-len('.mp4')]] * 1000 * sampled_seconds // 8)
+            return mock.Mock(returncode=returncode, stderr='')
+        return mock.patch('main.video_quality.subprocess.run', side_effect=run)
+
+    def build(self, video_info=None):
+        return video_quality.build_encoding_ladder('source.mp4', video_info or self.video_info)
+
+    def test_low_motion_drops_rungs_that_save_too_little(self):
+        with self.probe({'1080p': 300, '720p': 250, '360p': 80}):
+            ladder, info = self.build()
+
+        self.assertEqual({q: p['bitrate'] for q, p in ladder.items()}, {'360p': '100k', '1080p': '345k'})
+        self.assertEqual(info['method'], 'crf_probe')
+        self.assertEqual(info['dropped'], ['720p'])
+        self.assertEqual(info['rungs']['1080p']['probe_bitrate'], '300k')
+
+    def test_presets_cap_high_motion_bitrates(self):
+        with self.probe({'1080p': 8000, '720p': 3000, '360p': 700}):
+            ladder, info = self.build()
+
+        self.assertEqual(
+            {q: p['bitrate'] for q, p in ladder.items()},
+            {q: video_quality.QUALITY_PRESETS[q]['bitrate'] for q in ('360p', '720p', '1080p')}
+        )
+        self.assertEqual(info['dropped'], [])
+
+    def test_failed_probe_falls_back_to_fixed_presets(self):
+        with self.probe({}, returncode=1):
+            ladder, info = self.build()
+
+        self.assertEqual(ladder, video_quality.applicable_presets(1080))
+        self.assertEqual(info, {'method': 'fixed'})
+
+    def test_source_below_every_preset(self):
+        with self.probe({}) as run:
+            self.assertEqual(self.build({'height': 240, 'duration': 60}), ({}, None))
+        self.assertFalse(run.called)
+
+    def test_short_videos_are_sampled_once(self):
+        self.assertEqual(video_quality._probe_positions(8), [0])
+        self.assertEqual(len(video_quality._probe_positions(120)), video_quality.PROBE_SAMPLES)
+
+
+class ScrubPreviewTests(TestCase):
+    def cues(self, vtt):
+        return [block.split('\n') for block in vtt.strip().split('\n\n')[1:]]
+
+    def test_vtt_timestamp(self):
+        self.assertEqual(video_quality._vtt_timestamp(0), '00:00:00.000')
+        self.assertEqual(video_quality._vtt_timestamp(3725.5), '01:02:05.500')
+
+    def test_cues_point_into_tiles_of_each_sheet(self):
+        vtt = video_quality.thumbnails_vtt(['sprite_000.jpg', 'sprite_001.jpg'], (160, 90), 5, 503)
+        cues = self.cues(vtt)
+
+        self.assertTrue(vtt.startswith('WEBVTT\n'))
+        self.assertEqual(len(cues), 101)
+        self.assertEqual(cues[0], ['00:00:00.000 --> 00:00:05.000', 'sprite_000.jpg#xywh=0,0,160,90'])
+        self.assertEqual(cues[11][1], 'sprite_000.jpg#xywh=160,90,160,90')
+        # Последний кадр на втором листе и заканчивается вместе с видео
+        self.assertEqual(cues[100], ['00:08:20.000 --> 00:08:23.000', 'sprite_001.jpg#xywh=0,0,160,90'])
+
+    def test_cues_are_limited_to_rendered_tiles(self):
+        vtt = video_quality.thumbnails_vtt(['sprite_000.jpg'], (160, 90), 5, 1000)
+
+        self.assertEqual(len(self.cues(vtt)), video_quality.SPRITE_COLUMNS * video_quality.SPRITE_ROWS)
+
+    def test_sprite_command(self):
+        cmd = video_quality.build_sprite_command('ffmpeg', 'in.mp4', 'out/sprite_%03d.jpg', 5, (160, 90), threads=2)
+
+        self.assertEqual(cmd[cmd.index('-vf') + 1], 'fps=1/5,scale=160:90,tile=10x10')
+        self.assertLess(cmd.index('-threads'), cmd.index('-i'))
+        self.assertEqual(cmd[-1], 'out/sprite_%03d.jpg')
+
+
+class TranscodeVideosCommandTests(TestCase):
+    def transcode(self, metadata):
+        from .management.commands.transcode_videos import Command
+
+        bucket = FakeBucket()
+        bucket.blob('@alice/videos/v1.mp4').upload_from_string(b'video')
+        video = {'user_id': '@alice', 'video_id': 'v1', 'metadata': dict(metadata, file_path='@alice/videos/v1.mp4')}
+        with mock.patch('main.management.commands.transcode_videos.transcode_to_quality', return_value=False) as encode:
+            Command(stdout=io.StringIO()).transcode_video(bucket, video, 'all')
+        return [call.args[2] for call in encode.call_args_list]
+
+    @mock.patch('main.management.commands.transcode_videos.get_video_info', return_value={'height': 1080, 'duration': 60})
+    def test_rungs_follow_probed_height_of_older_videos(self, get_video_info):
+        self.assertEqual(self.transcode({'height': None}), ['480p', '720p', '1080p'])
+        self.assertTrue(get_video_info.called)
+
+    @mock.patch('main.management.commands.transcode_videos.get_video_info')
+    def test_duplicates_are_skipped(self, get_video_info):
+        self.assertEqual(self.transcode({'height': 1080, 'shared_from': '@bob__v2'}), [])
+        self.assertFalse(get_video_info.called)
+
+
+class CheckpointTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, 'run.checkpoint')
+
+    def run_checkpoint(self, key=None, **options):
+        from .management.commands.process_video_qualities import STATUS_PROCESSED, Checkpoint
+
+        checkpoint = Checkpoint(self.path, **options)
+        if key:
+            checkpoint.record(key, STATUS_PROCESSED)
+        checkpoint.close()
+        return checkpoint
+
+    def test_plain_rerun_keeps_finished_videos(self):
+        self.run_checkpoint('@alice/v1')
+        self.run_checkpoint('@alice/v2')
+
+        resumed = self.run_checkpoint(resume=True)
+
+        self.assertTrue(resumed.is_done('@alice/v1'))
+        self.assertTrue(resumed.is_done('@alice/v2'))
+
+    def test_reset_clears_the_checkpoint(self):
+        self.run_checkpoint('@alice/v1')
+        self.run_checkpoint(reset=True)
+
+        self.assertFalse(self.run_checkpoint(resume=True).is_done('@alice/v1'))
+
+
+class ContentIndexTests(TestCase):
+    probe = {'duration': '00:10', 'duration_seconds': 10.0, 'width': 1280, 'height': 720}
+
+    def setUp(self):
+        self.bucket = FakeBucket()
+        for target, value in (
+            ('main.gcs_storage.get_bucket', self.bucket),
+            ('main.gcs_storage.probe_video', self.probe),
+            ('main.gcs_storage.update_user_stats', True),
+        ):
+            patcher = mock.patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.data = b'lecture bytes'
+        self.sha256 = content_index.file_sha256(self.write_file(self.data))
+
+    def write_file(self, data, name='lecture.mp4'):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def register(self, user_id, video_id):
+        path = f"{user_id}/videos/{video_id}.mp4"
+        self.bucket.blob(path).upload_from_string(self.data)
+        self.assertEqual(gcs_storage.register_uploaded_video(user_id, path, sha256=self.sha256), video_id)
+        return gcs_storage.get_video_metadata(user_id, video_id)
+
+    def add_renditions(self, user_id, video_id):
+        metadata = gcs_storage.get_video_metadata(user_id, video_id)
+        metadata.update(
+            quality_variants={'360p': {'path': f"{user_id}/videos/{video_id}_360p.mp4"}},
+            available_qualities=['360p'],
+            streaming={'prefix': f"{user_id}/videos/{video_id}/hls/"},
+        )
+        self.bucket.put_json(f"{user_id}/metadata/{video_id}.json", metadata)
+        self.bucket.blob(f"{user_id}/videos/{video_id}_360p.mp4").upload_from_string(b'360p')
+        self.bucket.blob(f"{user_id}/videos/{video_id}/hls/master.m3u8").upload_from_string(b'#EXTM3U')
+        return metadata
+
+    def test_duplicate_links_to_stored_original(self):
+        self.register('@alice', 'v1')
+        self.add_renditions('@alice', 'v1')
+
+        duplicate = self.register('@bob', 'v2')
+
+        self.assertEqual(duplicate['file_path'], '@alice/videos/v1.mp4')
+        self.assertEqual(duplicate['shared_from'], '@alice__v1')
+        self.assertEqual(duplicate['available_qualities'], ['360p'])
+        self.assertIsNone(self.bucket.get_blob('@bob/videos/v2.mp4'))
+        self.assertIsNone(content_index.enqueue_transcode_once('@bob', 'v2', '@bob/videos/v2.mp4'))
+        self.assertFalse(TranscodeJob.objects.exists())
+
+    def test_duplicate_transcodes_the_owner_once(self):
+        self.register('@alice', 'v1')
+        first = content_index.enqueue_transcode_once('@alice', 'v1', '@alice/videos/v1.mp4')
+        self.register('@bob', 'v2')
+
+        second = content_index.enqueue_transcode_once('@bob', 'v2', '@bob/videos/v2.mp4')
+
+        self.assertEqual(second.pk, first.pk)
+        metadata = self.add_renditions('@alice', 'v1')
+        self.assertEqual(content_index.propagate_renditions('@alice', 'v1', metadata, self.bucket), 1)
+        self.assertEqual(gcs_storage.get_video_metadata('@bob', 'v2')['available_qualities'], ['360p'])
+
+    def test_shared_objects_are_deleted_with_the_last_reference(self):
+        self.register('@alice', 'v1')
+        self.add_renditions('@alice', 'v1')
+        self.register('@bob', 'v2')
+        self.register('@carol', 'v3')
+
+        self.assertTrue(gcs_storage.delete_video('@alice', 'v1'))
+        self.assertIsNotNone(self.bucket.get_blob('@alice/videos/v1.mp4'))
+        self.assertIsNotNone(self.bucket.get_blob('@alice/videos/v1_360p.mp4'))
+        self.assertEqual(StoredContent.objects.get().video_id, 'v2')
+        self.assertNotIn('shared_from', gcs_storage.get_video_metadata('@bob', 'v2'))
+        self.assertEqual(gcs_storage.get_video_metadata('@carol', 'v3')['shared_from'], '@bob__v2')
+
+        self.assertTrue(gcs_storage.delete_video('@bob', 'v2'))
+        self.assertIsNotNone(self.bucket.get_blob('@alice/videos/v1.mp4'))
+
+        self.assertTrue(gcs_storage.delete_video('@carol', 'v3'))
+        self.assertEqual(self.bucket.list_blobs('@alice/videos/'), [])
+        self.assertFalse(StoredContent.objects.exists())
+        self.assertFalse(ContentReference.objects.exists())
+
+    def test_owner_deleted_while_transcoding_requeues_new_owner(self):
+        self.register('@alice', 'v1')
+        content_index.enqueue_transcode_once('@alice', 'v1', '@alice/videos/v1.mp4')
+        self.register('@bob', 'v2')
+
+        gcs_storage.delete_video('@alice', 'v1')
+
+        job = TranscodeJob.objects.get(user_id='@bob')
+        self.assertEqual((job.video_id, job.source_path), ('v2', '@alice/videos/v1.mp4'))
+
+    def test_local_upload_is_indexed_after_it_is_stored(self):
+        link = gcs_storage._link_stored_content
+        stored_when_linked = []
+
+        def check_stored(bucket, user_id, video_id, sha256, video_path, size):
+            stored_when_linked.append(bucket.get_blob(video_path) is not None)
+            return link(bucket, user_id, video_id, sha256, video_path, size)
+
+        with mock.patch('main.gcs_storage._link_stored_content', side_effect=check_stored):
+            first = gcs_storage.upload_video('@alice', self.write_file(self.data, 'first.mp4'))
+
+        self.assertEqual(stored_when_linked, [True])
+        self.assertEqual(StoredContent.objects.get().source_path, f'@alice/videos/{first}.mp4')
+
+    def test_local_duplicate_is_not_uploaded(self):
+        first = gcs_storage.upload_video('@alice', self.write_file(self.data, 'first.mp4'))
+
+        with mock.patch.object(FakeBlob, 'upload_from_filename', autospec=True) as upload:
+            second = gcs_storage.upload_video('@bob', self.write_file(self.data, 'second.mp4'))
+
+        self.assertFalse(upload.called)
+        self.assertEqual(gcs_storage.get_video_metadata('@bob', second)['shared_from'], f'@alice__{first}')
+        self.assertEqual(ContentReference.objects.count(), 2)
+
+    def test_local_upload_replaces_missing_indexed_original(self):
+        first = gcs_storage.upload_video('@alice', self.write_file(self.data, 'first.mp4'))
+        self.bucket.blob(f'@alice/videos/{first}.mp4').delete()
+
+        second = gcs_storage.upload_video('@bob', self.write_file(self.data, 'second.mp4'))
+
+        self.assertEqual(self.bucket.blob(f'@bob/videos/{second}.mp4').download_as_bytes(), self.data)
+        self.assertEqual(StoredContent.objects.get().source_path, f'@bob/videos/{second}.mp4')
+        self.assertNotIn('shared_from', gcs_storage.get_video_metadata('@bob', second))
+
+
+@mock.patch('main.gcs_storage.get_user_profiles_from_gcs', return_value={})
+class CommentPaginationTests(TestCase):
+    def comment(self, comment_id, date, likes=0, replies=()):
+        return {'id': comment_id, 'date': date, 'likes': likes, 'replies': list(replies)}
+
+    def test_cursor_round_trip(self, profiles):
+        cursor = comments.encode_cursor('top', (3, '2025-01-01', 'c1'))
+
+        self.assertEqual(comments.decode_cursor('top', cursor), (3, '2025-01-01', 'c1'))
+        with self.assertRaises(comments.InvalidCursor):
+            comments.decode_cursor('newest', cursor)
+        for broken in ('', 'not-base64!', comments.encode_cursor('top', ())[:-2]):
+            with self.assertRaises(comments.InvalidCursor):
+                comments.decode_cursor('top', broken)
+
+    def test_newest_pages_are_stable_when_comments_are_added(self, profiles):
+        data = {'comments': [self.comment(f'c{day}', f'2025-01-0{day}') for day in range(1, 6)]}
+
+        first = comments.get_comments_page(data, cursor=None, limit=2)
+        data['comments'].append(self.comment('c9', '2025-01-09'))
+        second = comments.get_comments_page(data, cursor=first['next_cursor'], limit=2)
+        third = comments.get_comments_page(data, cursor=second['next_cursor'], limit=2)
+
+        self.assertEqual([c['id'] for c in first['comments']], ['c5', 'c4'])
+        self.assertEqual([c['id'] for c in second['comments']], ['c3', 'c2'])
+        self.assertEqual([c['id'] for c in third['comments']], ['c1'])
+        self.assertIsNone(third['next_cursor'])
+        self.assertEqual(third['total'], 6)
+
+    def test_top_order_breaks_ties_by_date_and_id(self, profiles):
+        data = {'comments': [
+            self.comment('a', '2025-01-01', likes=5),
+            self.comment('b', '2025-01-01', likes=5),
+            self.comment('c', '2025-01-02', likes=1, replies=[{'id': 'r1'}]),
+        ]}
+
+        first = comments.get_comments_page(data, order='top', limit=1)
+        rest = comments.get_comments_page(data, order='top', cursor=first['next_cursor'], limit=5)
+
+        self.assertEqual([c['id'] for c in first['comments'] + rest['comments']], ['b', 'a', 'c'])
+        self.assertNotIn('replies', rest['comments'][1])
+        self.assertEqual(rest['comments'][1]['reply_count'], 1)
+
+    def test_replies_oldest_first(self, profiles):
+        replies = [{'id': f'r{day}', 'date': f'2025-01-0{day}'} for day in (3, 1, 2)]
+        data = {'comments': [self.comment('c1', '2025-01-01', replies=replies)]}
+
+        first = comments.get_replies_page(data, 'c1', limit=2)
+        rest = comments.get_replies_page(data, 'c1', cursor=first['next_cursor'], limit=2)
+
+        self.assertEqual([r['id'] for r in first['replies'] + rest['replies']], ['r1', 'r2', 'r3'])
+        self.assertIsNone(comments.get_replies_page(data, 'missing'))
+
+    def test_stored_avatar_urls_are_replaced_by_profiles(self, profiles):
+        profiles.return_value = {'@bob': {'display_name': 'Bob', 'avatar_url': 'https://fresh'}}
+        data = {'comments': [
+            dict(self.comment('c1', '2025-01-01'), user_id='@bob', avatar_url='https://expired'),
+            dict(self.comment('c2', '2025-01-02'), user_id='@gone', avatar_url='https://expired'),
+        ]}
+
+        page = comments.get_comments_page(data)['comments']
+
+        self.assertEqual(page[0]['id'], 'c2')
+        self.assertNotIn('avatar_url', page[0])
+        self.assertEqual((page[1]['display_name'], page[1]['avatar_url']), ('Bob', 'https://fresh'))
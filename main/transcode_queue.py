@@ -0,0 +1,313 @@
+"""
+Durable queue of quality variant transcoding jobs
+
+Uploads only call enqueue_transcode(); the ffmpeg work is done by
+`manage.py transcode_worker` processes, so an upload request returns as soon
+as the original is stored, and queued work survives restarts.
+
+A worker claims a job with a conditional UPDATE (no row locks, so it works
+on SQLite as well as on PostgreSQL) and holds a lease on it. While ffmpeg
+runs a heartbeat thread renews the lease and stores the progress. If the
+worker dies the lease expires and another worker picks the job up again.
+Failed jobs are retried with an exponential backoff up to max_attempts.
+
+Scheduling: within a priority the job with the smallest source is claimed
+first (shortest job first), except that jobs waiting longer than
+SJF_MAX_WAIT go ahead so large lectures are not starved. plan_workers()
+splits the CPU budget (settings.TRANSCODE_CPU_BUDGET, all cores by
+default) between worker processes and ffmpeg -threads, so workers x
+threads never exceeds the budget.
+"""
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.utils import timezone
+
+from .models import TranscodeJob
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 300
+RETRY_BACKOFF_SECONDS = 60
+# Кандидатов больше одного: соседний воркер может перехватить первую задачу
+CLAIM_CANDIDATES = 5
+
+ACTIVE_STATUSES = (TranscodeJob.STATUS_QUEUED, TranscodeJob.STATUS_RUNNING)
+
+# Задачи, ждущие дольше, обгоняют короткие - защита от голодания
+SJF_MAX_WAIT = timedelta(hours=1)
+
+# x264 scales well up to a few threads per encode; beyond that more
+# concurrent jobs give better throughput than more threads per job
+THREADS_PER_JOB = 2
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def available_cpus():
+    """Cores this process may run on (respects CPU affinity/cgroup pinning)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def cpu_budget():
+    return getattr(settings, 'TRANSCODE_CPU_BUDGET', None) or available_cpus()
+
+
+def plan_workers(workers=None, budget=None):
+    """
+    Splits the CPU budget into worker processes and ffmpeg threads per job
+
+    Returns:
+        tuple: (workers, threads per job)
+    """
+    budget = max(1, budget or cpu_budget())
+    if not workers:
+        workers = max(1, budget // THREADS_PER_JOB)
+    workers = min(workers, budget)
+    return workers, max(1, budget // workers)
+
+
+def _source_size(source_path):
+    from .gcs_storage import get_bucket
+
+    try:
+        bucket = get_bucket()
+        blob = bucket.get_blob(source_path) if bucket else None
+        return blob.size if blob else 0
+    except Exception as e:
+        logger.warning(f"Could not get size of {source_path}: {e}")
+        return 0
+
+
+def enqueue_transcode(user_id, video_id, source_path, priority=0, source_size=None):
+    """
+    Queues quality processing for a stored video
+
+    source_size (bytes) orders the queue; it is looked up in storage when
+    the caller does not know it. Returns the existing job if the video is
+    already queued or running.
+    """
+    job = TranscodeJob.objects.filter(
+        user_id=user_id, video_id=video_id, status__in=ACTIVE_STATUSES
+    ).first()
+    if job:
+        return job
+
+    job = TranscodeJob.objects.create(
+        user_id=user_id,
+        video_id=video_id,
+        source_path=source_path,
+        source_size=source_size if source_size is not None else _source_size(source_path),
+        priority=priority
+    )
+    logger.info(f"Queued transcode job {job.pk} for {user_id}/{video_id}")
+    return job
+
+
+def get_latest_job(user_id, video_id):
+    return TranscodeJob.objects.filter(user_id=user_id, video_id=video_id).order_by('-created_at', '-pk').first()
+
+
+def _claimable(now):
+    # Задача в очереди или задача, воркер которой перестал продлевать аренду (пока есть попытки)
+    return (Q(status=TranscodeJob.STATUS_QUEUED) & (Q(run_after__isnull=True) | Q(run_after__lte=now))) | \
+        Q(status=TranscodeJob.STATUS_RUNNING, lease_expires_at__lt=now, attempts__lt=F('max_attempts'))
+
+
+def fail_abandoned_jobs(now):
+    """
+    Fails running jobs whose lease expired on the last attempt: a video that
+    kills its worker (OOM, ffmpeg crash) must not take down one worker
+    every lease period forever
+    """
+    failed = TranscodeJob.objects.filter(
+        status=TranscodeJob.STATUS_RUNNING, lease_expires_at__lt=now, attempts__gte=F('max_attempts')
+    ).update(
+        status=TranscodeJob.STATUS_FAILED,
+        lease_owner='',
+        lease_expires_at=None,
+        error='Worker stopped during the last attempt (lease expired)',
+        finished_at=now,
+        updated_at=now
+    )
+    if failed:
+        logger.error(f"{failed} transcode jobs failed permanently: their workers stopped on every attempt")
+    return failed
+
+
+def claim_job(worker_id, lease_seconds=LEASE_SECONDS):
+    """Takes the next job (priority, then shortest first), or returns None"""
+    now = timezone.now()
+    fail_abandoned_jobs(now)
+    overdue = Case(
+        When(created_at__lt=now - SJF_MAX_WAIT, then=Value(0)),
+        default=Value(1),
+        output_field=IntegerField()
+    )
+    candidates = TranscodeJob.objects.filter(_claimable(now)).order_by(
+        '-priority', overdue, 'source_size', 'created_at'
+    ).values_list('pk', flat=True)
+
+    for job_id in candidates[:CLAIM_CANDIDATES]:
+        # Условие повторяется в UPDATE: задачу получает только один воркер
+        claimed = TranscodeJob.objects.filter(_claimable(now), pk=job_id).update(
+            status=TranscodeJob.STATUS_RUNNING,
+            lease_owner=worker_id,
+            lease_expires_at=now + timedelta(seconds=lease_seconds),
+            attempts=F('attempts') + 1,
+            started_at=now,
+            error='',
+            updated_at=now
+        )
+        if claimed:
+            return TranscodeJob.objects.get(pk=job_id)
+    return None
+
+
+def renew_lease(job, worker_id, lease_seconds=LEASE_SECONDS, **fields):
+    """Extends the lease (and stores progress fields); False if the job was taken over"""
+    now = timezone.now()
+    return bool(TranscodeJob.objects.filter(
+        pk=job.pk, status=TranscodeJob.STATUS_RUNNING, lease_owner=worker_id
+    ).update(lease_expires_at=now + timedelta(seconds=lease_seconds), updated_at=now, **fields))
+
+
+def _finish_job(job, worker_id, **fields):
+    now = timezone.now()
+    return TranscodeJob.objects.filter(pk=job.pk, lease_owner=worker_id).update(
+        lease_owner='', lease_expires_at=None, updated_at=now, **fields
+    )
+
+
+def complete_job(job, worker_id, result):
+    _finish_job(
+        job, worker_id,
+        status=TranscodeJob.STATUS_DONE,
+        progress=1.0,
+        current_step='',
+        result=result,
+        finished_at=timezone.now()
+    )
+    logger.info(f"Transcode job {job.pk} done: {', '.join(result) or 'no variants'}")
+
+
+def fail_job(job, worker_id, error):
+    """Re-queues the job with a backoff or marks it failed after max_attempts"""
+    job.refresh_from_db(fields=['attempts', 'max_attempts'])
+    if job.attempts < job.max_attempts:
+        delay = RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1)
+        _finish_job(
+            job, worker_id,
+            status=TranscodeJob.STATUS_QUEUED,
+            run_after=timezone.now() + timedelta(seconds=delay),
+            error=error
+        )
+        logger.warning(f"Transcode job {job.pk} failed (attempt {job.attempts}), retry in {delay}s: {error}")
+    else:
+        _finish_job(job, worker_id, status=TranscodeJob.STATUS_FAILED, error=error, finished_at=timezone.now())
+        logger.error(f"Transcode job {job.pk} failed permanently: {error}")
+
+
+class _LeaseKeeper(threading.Thread):
+    """Renews the lease of a running job and flushes its progress"""
+
+    def __init__(self, job, worker_id, lease_seconds):
+        super().__init__(daemon=True)
+        self.job = job
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.progress = {}
+        self.lost = False
+        self._stopped = False
+        self._wake = threading.Event()
+
+    def report(self, done, total, quality):
+        self.progress = {
+            'progress': done / total if total else 1.0,
+            'current_step': quality or '',
+        }
+        self._wake.set()  # Сохранить прогресс сразу, не дожидаясь следующего продления
+
+    def run(self):
+        try:
+            while not self.lost:
+                self._wake.wait(self.lease_seconds / 3)
+                self._wake.clear()
+                if self._stopped:
+                    break
+                if not renew_lease(self.job, self.worker_id, self.lease_seconds, **self.progress):
+                    logger.warning(f"Lost lease on transcode job {self.job.pk}")
+                    self.lost = True
+        finally:
+            close_old_connections()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+        self.join()
+
+
+def run_job(job, worker_id, lease_seconds=LEASE_SECONDS, threads=None):
+    """Transcodes the job's video with at most `threads` ffmpeg threads and records the outcome"""
+    from .gcs_storage import get_video_metadata, process_stored_video_qualities
+
+    keeper = _LeaseKeeper(job, worker_id, lease_seconds)
+    keeper.start()
+    try:
+        metadata = get_video_metadata(job.user_id, job.video_id)
+        if not metadata:
+            # Видео удалено, пока задача ждала в очереди (или хранилище недоступно)
+            keeper.stop()
+            fail_job(job, worker_id, 'Video metadata not found')
+            return
+
+        # Свойства файла, записанные при загрузке (probe_media), не определяются заново
+        variants = process_stored_video_qualities(
+            job.user_id, job.video_id, job.source_path, progress_callback=keeper.report, threads=threads,
+            media_info=metadata
+        )
+        keeper.stop()
+        if keeper.lost:
+            return
+        if variants is None:
+            fail_job(job, worker_id, f"Could not read {job.source_path}")
+        else:
+            # Пустой результат - исходник ниже всех пресетов; ошибки кодирования приходят исключением
+            complete_job(job, worker_id, {quality: info.get('path') for quality, info in variants.items()})
+    except Exception as e:
+        keeper.stop()
+        logger.error(f"Error running transcode job {job.pk}: {e}")
+        fail_job(job, worker_id, str(e))
+
+
+def process_next_job(worker_id, lease_seconds=LEASE_SECONDS, threads=None):
+    """Claims and runs one job; returns False if the queue is empty"""
+    job = claim_job(worker_id, lease_seconds)
+    if not job:
+        return False
+    logger.info(f"Worker {worker_id} running transcode job {job.pk} ({job.user_id}/{job.video_id}, attempt {job.attempts})")
+    run_job(job, worker_id, lease_seconds, threads=threads)
+    return True
+
+
+def job_status(job):
+    """Public view of a job for the processing status API"""
+    return {
+        'status': job.status,
+        'progress': round(job.progress, 3),
+        'step': job.current_step or None,
+        'attempts': job.attempts,
+        'error': job.error or None,
+        'queued_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
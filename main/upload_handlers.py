@@ -0,0 +1,119 @@
+"""
+Upload handlers that stream request bodies straight into Google Cloud Storage
+
+GCSStreamingUploadHandler takes over one file field of a multipart request
+and writes every chunk into a GCS resumable upload session as it arrives,
+while counting the size and computing SHA-256. Nothing is written to local
+disk and only one resumable chunk (UPLOAD_CHUNK_SIZE) is held in memory.
+
+Other fields (e.g. the thumbnail) are left to Django's default handlers.
+"""
+import hashlib
+import io
+import logging
+import os
+import uuid
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+logger = logging.getLogger(__name__)
+
+# Size of a resumable upload request; must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class GCSUploadedFile(UploadedFile):
+    """
+    A file that was already stored in GCS while the request was received.
+    It has no local content: use gcs_path (and sha256/size) instead.
+    video_id is set by the view once the object is registered as a video.
+    """
+
+    def __init__(self, name, content_type, size, charset, gcs_path, sha256):
+        super().__init__(io.BytesIO(), name, content_type, size, charset)
+        self.gcs_path = gcs_path
+        self.sha256 = sha256
+        self.video_id = None
+
+
+class GCSStreamingUploadHandler(FileUploadHandler):
+    """
+    Streams one file field into a new object at {user_id}/videos/.
+
+    The object name is built the same way as for regular uploads
+    ({date}_{uuid}_{name}), so the video ID can be derived from it.
+    If the bucket is unavailable the handler steps aside and the file is
+    handled by the default handlers.
+    """
+
+    def __init__(self, request, user_id, field_name='video_file'):
+        super().__init__(request)
+        self.user_id = user_id
+        self.target_field = field_name
+        self.writer = None
+        # The stored file, for the view to clean up if the request fails
+        self.uploaded_file = None
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self.writer = None
+        if field_name != self.target_field:
+            return
+
+        from .gcs_storage import get_bucket, new_video_id
+
+        bucket = get_bucket()
+        if not bucket:
+            logger.error("Could not get bucket for streaming upload, falling back to local spooling")
+            return
+
+        extension = os.path.splitext(file_name)[1]
+        video_id = new_video_id(f"{uuid.uuid4()}_{file_name}")
+        self.gcs_path = f"{self.user_id}/videos/{video_id}{extension}"
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.writer = bucket.blob(self.gcs_path).open(
+            'wb',
+            chunk_size=UPLOAD_CHUNK_SIZE,
+            content_type=content_type or 'video/mp4',
+            ignore_flush=True
+        )
+        logger.info(f"Streaming upload {file_name} to {self.gcs_path}")
+
+        # Остальные обработчики не должны создавать для этого файла временную копию
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.writer is None:
+            return raw_data
+
+        self.writer.write(raw_data)
+        self.sha256.update(raw_data)
+        self.size += len(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if self.writer is None:
+            return None
+
+        # close() отправляет последний фрагмент и завершает сессию - объект появляется только сейчас
+        self.writer.close()
+        self.writer = None
+        logger.info(f"Streamed {self.size} bytes to {self.gcs_path}")
+
+        self.uploaded_file = GCSUploadedFile(
+            name=self.file_name,
+            content_type=self.content_type,
+            size=self.size,
+            charset=self.charset,
+            gcs_path=self.gcs_path,
+            sha256=self.sha256.hexdigest()
+        )
+        return self.uploaded_file
+
+    def upload_interrupted(self):
+        if self.writer is not None:
+            # Незавершенная resumable-сессия не создает объект и истекает сама
+            logger.warning(f"Streaming upload to {self.gcs_path} was interrupted")
+            self.writer = None
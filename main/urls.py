@@ -23,18 +23,29 @@ urlpatterns = [
     
     # API endpoints for Google Cloud Storage
     path('api/upload-video/', gcs_views.upload_video_to_gcs, name='upload_video_to_gcs'),
+    path('api/uploads/', gcs_views.create_upload_session, name='create_upload_session'),
+    path('api/uploads/direct/', gcs_views.create_upload_session, {'direct': True}, name='create_direct_upload_session'),
+    path('api/uploads/<uuid:upload_id>/', gcs_views.upload_session, name='upload_session'),
+    path('api/uploads/<uuid:upload_id>/finalize/', gcs_views.finalize_upload_session, name='finalize_upload_session'),
     path('api/list-user-videos/', gcs_views.list_user_videos, name='list_user_videos'),
     path('api/list-user-videos/<str:username>/', gcs_views.list_user_videos, name='list_user_videos_for_user'),
     path('api/list-all-videos/', gcs_views.list_all_videos, name='list_all_videos'),
     path('api/delete-video/<str:video_id>/', gcs_views.delete_video_from_gcs, name='delete_video_from_gcs'),
     path('api/get-video-url/<str:video_id>/', gcs_views.get_video_url, name='get_video_url'),
     path('api/get-thumbnail-url/<str:video_id>/', gcs_views.get_thumbnail_url, name='get_thumbnail_url'),
+    path('api/processing-status/<str:video_id>/', gcs_views.processing_status, name='processing_status'),
+    path('api/stream/<str:video_id>/<path:name>', gcs_views.stream_manifest, name='stream_manifest'),
+    path('api/previews/<str:video_id>/thumbnails.vtt', gcs_views.scrub_previews, name='scrub_previews'),
     path('api/add-comment/', gcs_views.add_comment, name='add_comment'),
     path('api/add-reply/', gcs_views.add_reply, name='add_reply'),
+    path('api/comments/<str:video_id>/', views.get_comments, name='get_comments'),
+    path('api/comments/<str:video_id>/stream/', views.video_event_stream, name='video_event_stream'),
     path('api/track-view/', gcs_views.track_video_view, name='track_video_view'),
+    path('api/events/batch/', gcs_views.track_player_events_batch, name='track_player_events_batch'),
     
     # New endpoint for getting user profiles with avatar
     path('api/get-user-profile/', views.get_user_profile, name='get_user_profile'),
+    path('api/user-profiles/', views.get_user_profiles, name='get_user_profiles'),
     
     # New endpoints for like/dislike functionality
     path('api/toggle-video-like/', views.toggle_video_like, name='toggle_video_like'),
@@ -44,6 +55,9 @@ urlpatterns = [
     path('api/toggle-subscription/', views.toggle_subscription, name='toggle_subscription'),
     path('api/check-subscription/<str:channel_id>/', views.check_subscription, name='check_subscription'),
     path('api/get-subscriptions/', views.get_subscriptions, name='get_subscriptions'),
+
+    # Batched like/subscription state for page hydration
+    path('api/status/batch/', views.get_batch_status, name='get_batch_status'),
 ]
 
 if settings.DEBUG:
@@ -1,36 +1,83 @@
 import os
+import json
+import math
 import uuid
+import shutil
 import logging
 import subprocess
+from datetime import datetime
 from django.conf import settings
 from google.cloud import storage
 
 logger = logging.getLogger(__name__)
 
+
+class QualityProcessingError(Exception):
+    """Quality variants could not be created (encode, upload or metadata error)"""
+
 # Quality presets with their respective settings
 QUALITY_PRESETS = {
     '360p': {
         'resolution': '640x360',
         'bitrate': '800k',
-        'audio_bitrate': '96k'
+        'audio_bitrate': '96k',
+        'level': '3.0'
     },
     '720p': {
         'resolution': '1280x720',
         'bitrate': '2500k',
-        'audio_bitrate': '128k'
+        'audio_bitrate': '128k',
+        'level': '3.1'
     },
     '1080p': {
         'resolution': '1920x1080',
         'bitrate': '5000k',
-        'audio_bitrate': '192k'
+        'audio_bitrate': '192k',
+        'level': '4.0'
     },
     '2160p': {
         'resolution': '3840x2160',
         'bitrate': '12000k',
-        'audio_bitrate': '256k'
+        'audio_bitrate': '256k',
+        'level': '5.1'
     }
 }
 
+# Adaptive streaming: every rendition is cut into segments of this length
+# (see package_streaming); keyframes are forced on the segment boundaries
+SEGMENT_SECONDS = 4
+AUDIO_CODECS = 'mp4a.40.2'
+STREAMING_UPLOAD_WORKERS = 8
+STREAMING_CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.mpd': 'application/dash+xml',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+    '.vtt': 'text/vtt',
+    '.jpg': 'image/jpeg',
+}
+
+# Seek bar previews (see generate_scrub_previews): a thumbnail every
+# SPRITE_INTERVAL seconds, tiled into sprite sheets
+SPRITE_INTERVAL = 5
+# Longer videos get a longer interval, so the player loads a few sheets at most
+SPRITE_MAX_TILES = 500
+SPRITE_TILE_WIDTH = 160
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+SPRITE_VTT = 'thumbnails.vtt'
+
+# Per-title ladder (see build_encoding_ladder): QUALITY_PRESETS bitrates
+# are the ceilings, the probe decides how much of them a title needs
+PROBE_CRF = 23
+PROBE_SAMPLES = 4
+PROBE_SAMPLE_SECONDS = 3
+# ABR at the probed bitrate lands slightly below the CRF quality
+LADDER_HEADROOM = 1.15
+MIN_RUNG_BITRATE_KBPS = 100
+# A lower rung is kept only if it needs this much less than the rung above
+MIN_RUNG_RATIO = 1.5
+
 def get_ffmpeg_path():
     """Get the path to the ffmpeg executable"""
     if os.name == 'nt':  # Windows
@@ -43,82 +90,143 @@ def get_ffmpeg_path():
         ffmpeg_path = 'ffmpeg'  # Fallback to system ffmpeg
     return ffmpeg_path
 
-def get_video_info(video_path):
-    """Get video information using ffprobe"""
+def get_ffprobe_path():
+    """Get the path to the ffprobe executable"""
+    ffprobe_path = os.path.join(settings.BASE_DIR, 'ffmpeg', 'bin', 'ffprobe.exe' if os.name == 'nt' else 'ffprobe')
+    if not os.path.exists(ffprobe_path):
+        ffprobe_path = 'ffprobe'
+    return ffprobe_path
+
+# Fields written to the video metadata by probe_media (numeric: seconds, pixels, bits/s)
+MEDIA_FIELDS = (
+    'duration_seconds', 'width', 'height', 'fps', 'video_codec',
+    'audio_codec', 'has_audio', 'bitrate', 'rotation'
+)
+
+def _parse_rate(rate):
+    """'30000/1001' -> 29.97; None for missing or 0/0 rates"""
+    try:
+        if '/' in str(rate):
+            num, den = map(int, str(rate).split('/'))
+            return round(num / den, 3) if num and den else None
+        return float(rate) or None
+    except (TypeError, ValueError):
+        return None
+
+def _rotation(stream):
+    """Clockwise display rotation of a video stream in degrees"""
+    rotate = (stream.get('tags') or {}).get('rotate')
+    if rotate is not None:
+        return int(rotate) % 360
+    for side_data in stream.get('side_data_list') or []:
+        if 'rotation' in side_data:
+            # Display matrix хранит поворот против часовой стрелки
+            return int(-float(side_data['rotation'])) % 360
+    return 0
+
+def probe_media(source):
+    """
+    Probes a video file (or a signed URL - ffprobe reads only what it needs)
+    in one ffprobe run
+    
+    width and height are the displayed size: ffmpeg applies the rotation
+    when decoding, so a portrait phone video recorded as 1920x1080 with
+    rotation 90 is 1080x1920.
+    
+    Returns:
+        dict: MEDIA_FIELDS, or None if the file could not be probed
+    """
+    cmd = [
+        get_ffprobe_path(), '-v', 'error',
+        '-show_entries',
+        'stream=codec_type,codec_name,width,height,avg_frame_rate,r_frame_rate'
+        ':stream_tags=rotate:stream_side_data=rotation:format=duration,bit_rate',
+        '-of', 'json', source
+    ]
     try:
-        ffprobe_path = os.path.join(settings.BASE_DIR, 'ffmpeg', 'bin', 'ffprobe.exe' if os.name == 'nt' else 'ffprobe')
-        if not os.path.exists(ffprobe_path):
-            ffprobe_path = 'ffprobe'
-        
-        cmd = [
-            ffprobe_path, '-v', 'error', '-select_streams', 'v:0',
-            '-show_entries', 'stream=width,height,codec_name,r_frame_rate',
-            '-show_entries', 'format=duration', '-of', 'json', video_path
-        ]
-        
-        logger.info(f"Running ffprobe command: {' '.join(cmd)}")
-        
         result = subprocess.run(cmd, capture_output=True, text=True, check=False)
         if result.returncode != 0:
-            logger.error(f"ffprobe error: {result.stderr}")
-            logger.error(f"ffprobe output: {result.stdout}")
-            raise Exception(f"ffprobe exited with code {result.returncode}")
-        
-        logger.info(f"ffprobe result: {result.stdout}")
-        
-        import json
+            logger.error(f"ffprobe error for {source}: {result.stderr}")
+            return None
         data = json.loads(result.stdout)
-        stream_data = data.get('streams', [{}])[0]
-        format_data = data.get('format', {})
-        
-        width = stream_data.get('width')
-        height = stream_data.get('height')
-        
-        logger.info(f"Detected video dimensions: {width}x{height}")
-        
-        framerate = stream_data.get('r_frame_rate', '30/1')
-        if '/' in framerate:
-            try:
-                num, den = map(int, framerate.split('/'))
-                framerate = round(num / den, 2)
-            except (ValueError, ZeroDivisionError):
-                framerate = 30.0
-        else:
-            try:
-                framerate = float(framerate)
-            except ValueError:
-                framerate = 30.0
-        
-        return {
-            'width': width,
-            'height': height,
-            'codec': stream_data.get('codec_name'),
-            'duration': float(format_data.get('duration', 0)),
-            'framerate': framerate
-        }
-    except Exception as e:
-        logger.error(f"Error getting video info: {str(e)}")
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not probe {source}: {e}")
+        return None
+    
+    streams = data.get('streams') or []
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), None)
+    format_data = data.get('format') or {}
+    if video is None:
+        logger.error(f"No video stream in {source}")
+        return None
+    
+    rotation = _rotation(video)
+    width, height = video.get('width'), video.get('height')
+    if rotation in (90, 270):
+        width, height = height, width
+    
+    try:
+        duration = round(float(format_data.get('duration')), 3)
+    except (TypeError, ValueError):
+        duration = None
+    try:
+        bitrate = int(format_data.get('bit_rate'))
+    except (TypeError, ValueError):
+        bitrate = None
+    
+    media = {
+        'duration_seconds': duration,
+        'width': width,
+        'height': height,
+        'fps': _parse_rate(video.get('avg_frame_rate')) or _parse_rate(video.get('r_frame_rate')),
+        'video_codec': video.get('codec_name'),
+        'audio_codec': audio.get('codec_name') if audio else None,
+        'has_audio': audio is not None,
+        'bitrate': bitrate,
+        'rotation': rotation,
+    }
+    logger.info(f"Probed {source}: {width}x{height}, {duration}s, {media['fps']} fps, {media['video_codec']}/{media['audio_codec']}")
+    return media
+
+def video_info_from_media(media):
+    """
+    Transcoding view of probe_media output; also accepts video metadata,
+    which stores the same fields, so stored videos are not probed again
+    """
+    if not media or not media.get('height'):
+        return None
+    return {
+        'width': media.get('width'),
+        'height': media.get('height'),
+        'codec': media.get('video_codec'),
+        'duration': media.get('duration_seconds') or 0,
+        'framerate': media.get('fps') or 30,
+        'has_audio': media.get('has_audio'),
+    }
+
+def get_video_info(video_path):
+    """Get video information using ffprobe"""
+    video_info = video_info_from_media(probe_media(video_path))
+    if not video_info:
         # Return default values with None for dimensions
-        return {'width': None, 'height': None, 'codec': None, 'duration': 0, 'framerate': 30}
+        return {'width': None, 'height': None, 'codec': None, 'duration': 0, 'framerate': 30, 'has_audio': None}
+    return video_info
 
-def process_video_quality(video_file_path, user_id, video_id, bucket_name):
+def process_video_quality(video_file_path, user_id, video_id, bucket_name, threads=None):
     """Process video into different quality variants and upload to GCS"""
     logger.info(f"Starting process_video_quality for video_id: {video_id}, input: {video_file_path}")
     quality_paths = {}
-    ffmpeg_path = get_ffmpeg_path()
     
     # Get video info to determine which qualities to process
     video_info = get_video_info(video_file_path)
-    video_height = video_info.get('height', 0)
+    video_height = video_info.get('height') or 0
     video_width = video_info.get('width', 0)
     
     logger.info(f"Original video dimensions: {video_width}x{video_height}")
     
-    # Filter quality presets based on input video resolution
-    applicable_qualities = {
-        q: p for q, p in QUALITY_PRESETS.items()
-        if int(p['resolution'].split('x')[1]) <= video_height
-    }
+    # Rungs and bitrates for this title (fixed presets ceilings, no upscaling)
+    applicable_qualities, ladder_info = build_encoding_ladder(video_file_path, video_info)
     
     if not applicable_qualities:
         logger.warning(f"No applicable quality presets for video resolution {video_height}p")
@@ -127,55 +235,37 @@ def process_video_quality(video_file_path, user_id, video_id, bucket_name):
     import tempfile
     temp_dir = tempfile.mkdtemp()
     
-    for quality, preset in applicable_qualities.items():
-        target_width, target_height = map(int, preset['resolution'].split('x'))
-        
-        # Create a more reliable scaling filter
-        scale_filter = f"scale={target_width}:{target_height}:force_original_aspect_ratio=decrease,pad={target_width}:{target_height}:(ow-iw)/2:(oh-ih)/2:color=black"
-        
-        output_path = os.path.join(temp_dir, f"{video_id}_{quality}.mp4")
-        
-        cmd = [
-            ffmpeg_path, '-i', video_file_path,
-            '-vf', scale_filter,
-            '-c:v', 'libx264', '-b:v', preset['bitrate'],
-            '-c:a', 'aac', '-b:a', preset['audio_bitrate'],
-            '-preset', 'medium', '-y', output_path
-        ]
-        
-        logger.info(f"Running FFmpeg command: {' '.join(cmd)}")
-        
+    renditions = [
+        (quality, preset, os.path.join(temp_dir, f"{video_id}_{quality}.mp4"))
+        for quality, preset in applicable_qualities.items()
+    ]
+    encoded = encode_renditions(
+        video_file_path, renditions, source_duration=video_info.get('duration') or 0, threads=threads
+    )
+    
+    from google.cloud import storage
+    client = storage.Client()
+    bucket = client.bucket(bucket_name)
+    
+    for quality, preset, output_path in renditions:
         try:
-            process = subprocess.run(cmd, capture_output=True, text=True, check=False)
-            if process.returncode != 0:
-                logger.error(f"FFmpeg error for {quality}: {process.stderr}")
-                continue
-                
-            # Check if output file exists and has size
-            if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-                logger.error(f"Output file for {quality} was not created or is empty")
-                continue
+            if quality in encoded:
+                # Upload to GCS
+                gcs_path = f"{user_id}/videos/{video_id}_{quality}.mp4"
+                blob = bucket.blob(gcs_path)
+                blob.upload_from_filename(output_path, content_type='video/mp4')
                 
-            # Upload to GCS
-            from google.cloud import storage
-            client = storage.Client()
-            bucket = client.bucket(bucket_name)
-            
-            gcs_path = f"{user_id}/videos/{video_id}_{quality}.mp4"
-            blob = bucket.blob(gcs_path)
-            blob.upload_from_filename(output_path, content_type='video/mp4')
-            
-            logger.info(f"Successfully created {quality} variant at {gcs_path}")
-            quality_paths[quality] = gcs_path
-            
+                logger.info(f"Successfully created {quality} variant at {gcs_path}")
+                quality_paths[quality] = gcs_path
+        except Exception as e:
+            logger.error(f"Error processing {quality}: {str(e)}")
+        finally:
             # Clean up temporary file
             try:
-                os.remove(output_path)
+                if os.path.exists(output_path):
+                    os.remove(output_path)
             except Exception as e:
                 logger.warning(f"Could not remove temporary file {output_path}: {e}")
-                
-        except Exception as e:
-            logger.error(f"Error processing {quality}: {str(e)}")
     
     # Clean up temp directory
     try:
@@ -185,8 +275,567 @@ def process_video_quality(video_file_path, user_id, video_id, bucket_name):
     
     return quality_paths
 
-def create_quality_variants(video_file_path, user_id, video_id):
-    """Create quality variants for a video and update its metadata"""
+def applicable_presets(video_height):
+    """Presets not taller than the source (no upscaling)"""
+    return {
+        q: p for q, p in QUALITY_PRESETS.items()
+        if int(p['resolution'].split('x')[1]) <= (video_height or 0)
+    }
+
+def _kbps(bitrate):
+    return int(str(bitrate).rstrip('k'))
+
+def _probe_positions(duration):
+    """Start times of the sampled segments, spread evenly over the video"""
+    if not duration or duration <= PROBE_SAMPLES * PROBE_SAMPLE_SECONDS:
+        return [0]
+    step = duration / PROBE_SAMPLES
+    return [round(step * index + (step - PROBE_SAMPLE_SECONDS) / 2, 2) for index in range(PROBE_SAMPLES)]
+
+def build_probe_command(ffmpeg_path, input_path, positions, rungs):
+    """
+    One ffmpeg run encoding the sampled segments at every rung with constant quality
+    
+    Args:
+        positions: start times of the samples (PROBE_SAMPLE_SECONDS each)
+        rungs: list of (quality, preset, output_path)
+    """
+    cmd = [ffmpeg_path, '-hide_banner', '-nostats', '-loglevel', 'error', '-y']
+    for position in positions:
+        cmd += ['-ss', str(position), '-t', str(PROBE_SAMPLE_SECONDS), '-i', input_path]
+    
+    inputs = ''.join(f"[{index}:v]" for index in range(len(positions)))
+    graph = [
+        f"{inputs}concat=n={len(positions)}:v=1:a=0,split={len(rungs)}"
+        + ''.join(f"[v{index}]" for index in range(len(rungs)))
+    ]
+    for index, (quality, preset, output_path) in enumerate(rungs):
+        graph.append(f"[v{index}]{_scale_filter(preset)}[out{index}]")
+    cmd += ['-filter_complex', ';'.join(graph)]
+    
+    for index, (quality, preset, output_path) in enumerate(rungs):
+        cmd += [
+            '-map', f"[out{index}]", '-an', '-c:v', 'libx264',
+            '-crf', str(PROBE_CRF), '-preset', 'veryfast', output_path
+        ]
+    return cmd
+
+def build_encoding_ladder(video_file_path, video_info=None):
+    """
+    Per-title encoding ladder
+    
+    A few short samples of the video are encoded at a constant quality
+    (CRF) at every applicable resolution; the bitrate each resolution needed
+    becomes its rung bitrate (QUALITY_PRESETS is the ceiling). Slides and
+    screen recordings need a fraction of the preset bitrates, motion-heavy
+    content keeps them. A lower rung that would not save at least
+    MIN_RUNG_RATIO of the bitrate of the rung above is dropped: at that
+    bitrate the higher resolution looks better.
+    
+    Falls back to the fixed presets if the probe fails.
+    
+    Returns:
+        tuple: ({quality: preset}, ladder description for the video metadata)
+    """
+    import tempfile
+    
+    video_info = video_info or get_video_info(video_file_path)
+    candidates = applicable_presets(video_info.get('height'))
+    if not candidates:
+        return {}, None
+    
+    duration = video_info.get('duration') or 0
+    positions = _probe_positions(duration)
+    sampled_seconds = min(duration, PROBE_SAMPLE_SECONDS) if len(positions) == 1 and duration else \
+        len(positions) * PROBE_SAMPLE_SECONDS
+    
+    probe_dir = tempfile.mkdtemp()
+    try:
+        rungs = [
+            (quality, preset, os.path.join(probe_dir, f"probe_{quality}.mp4"))
+            for quality, preset in candidates.items()
+        ]
+        cmd = build_probe_command(get_ffmpeg_path(), video_file_path, positions, rungs)
+        process = subprocess.run(cmd, capture_output=True, text=True, check=False)
+        if process.returncode != 0 or not sampled_seconds:
+            logger.error(f"Ladder probe failed, using fixed presets: {process.stderr}")
+            return candidates, {'method': 'fixed'}
+        
+        probed = {
+            quality: int(os.path.getsize(output_path) * 8 / sampled_seconds / 1000)
+            for quality, preset, output_path in rungs
+            if os.path.exists(output_path)
+        }
+    finally:
+        shutil.rmtree(probe_dir, ignore_errors=True)
+    
+    if len(probed) != len(candidates):
+        logger.error("Ladder probe produced incomplete output, using fixed presets")
+        return candidates, {'method': 'fixed'}
+    
+    ladder = {}
+    dropped = []
+    rung_above = None
+    # Сверху вниз: верхняя ступень остается всегда
+    for quality in sorted(candidates, key=lambda q: int(q.rstrip('p')), reverse=True):
+        preset = candidates[quality]
+        bitrate = min(_kbps(preset['bitrate']), max(MIN_RUNG_BITRATE_KBPS, int(probed[quality] * LADDER_HEADROOM)))
+        if rung_above and bitrate * MIN_RUNG_RATIO > rung_above:
+            dropped.append(quality)
+            continue
+        ladder[quality] = dict(preset, bitrate=f"{bitrate}k")
+        rung_above = bitrate
+    
+    ladder = dict(sorted(ladder.items(), key=lambda item: int(item[0].rstrip('p'))))
+    rungs_text = ', '.join(f"{quality} {preset['bitrate']}" for quality, preset in ladder.items())
+    logger.info(f"Per-title ladder for {video_file_path}: {rungs_text}; dropped {dropped or 'none'}")
+    return ladder, {
+        'method': 'crf_probe',
+        'probe_crf': PROBE_CRF,
+        'sampled_seconds': sampled_seconds,
+        'rungs': {
+            quality: {
+                'resolution': preset['resolution'],
+                'bitrate': preset['bitrate'],
+                'probe_bitrate': f"{probed[quality]}k",
+            }
+            for quality, preset in ladder.items()
+        },
+        'dropped': dropped,
+    }
+
+def _scale_filter(preset):
+    """Scale into the preset frame keeping the aspect ratio, letterboxed with black"""
+    target_width, target_height = map(int, preset['resolution'].split('x'))
+    return f"scale={target_width}:{target_height}:force_original_aspect_ratio=decrease,pad={target_width}:{target_height}:(ow-iw)/2:(oh-ih)/2:color=black"
+
+def _encoder_args(preset, threads=None):
+    args = [
+        '-c:v', 'libx264', '-b:v', preset['bitrate'],
+        '-profile:v', 'high', '-level:v', preset['level'],
+        # Ключевые кадры на границах сегментов во всех качествах: сегменты HLS выровнены
+        '-force_key_frames', f"expr:gte(t,n_forced*{SEGMENT_SECONDS})",
+        '-c:a', 'aac', '-b:a', preset['audio_bitrate'],
+        '-preset', 'medium'
+    ]
+    return args + ['-threads', str(threads)] if threads else args
+
+def build_single_rendition_command(ffmpeg_path, input_path, preset, output_path, threads=None):
+    """One decode per rendition (used as a fallback for a failed rendition)"""
+    input_args = ['-threads', str(threads)] if threads else []
+    return [ffmpeg_path] + input_args + ['-i', input_path, '-vf', _scale_filter(preset)] + \
+        _encoder_args(preset, threads) + ['-y', output_path]
+
+def build_multi_rendition_command(ffmpeg_path, input_path, renditions, threads=None):
+    """
+    One ffmpeg run that decodes the source once and encodes every rendition
+    
+    The decoded video is split into one branch per rendition, each branch is
+    scaled and written to its own output; audio is mapped into every output
+    if the source has any.
+    
+    Args:
+        renditions: list of (quality, preset, output_path)
+        threads: CPU threads for the whole run; the encoders share them,
+            so several renditions are encoded concurrently within the budget
+    """
+    # Декодер и кодировщики вместе не должны занимать больше threads ядер
+    encoder_threads = max(1, threads // len(renditions)) if threads else None
+    input_args = ['-threads', str(threads), '-filter_complex_threads', str(threads)] if threads else []
+    
+    graph = [f"[0:v]split={len(renditions)}{''.join(f'[v{index}]' for index in range(len(renditions)))}"]
+    for index, (quality, preset, output_path) in enumerate(renditions):
+        graph.append(f"[v{index}]{_scale_filter(preset)}[out{index}]")
+    
+    cmd = [ffmpeg_path, '-hide_banner', '-nostats', '-loglevel', 'error', '-progress', 'pipe:1', '-y'] + \
+        input_args + ['-i', input_path, '-filter_complex', ';'.join(graph)]
+    for index, (quality, preset, output_path) in enumerate(renditions):
+        cmd += ['-map', f"[out{index}]", '-map', '0:a?'] + _encoder_args(preset, encoder_threads) + [output_path]
+    return cmd
+
+def _run_with_progress(cmd, duration, on_progress=None):
+    """
+    Runs ffmpeg with `-progress pipe:1`, reporting encoded seconds
+
+    Returns:
+        tuple: (returncode, stderr text)
+    """
+    import tempfile
+    
+    # stderr в файл: заполненный pipe заблокировал бы ffmpeg, пока читается stdout
+    with tempfile.TemporaryFile(mode='w+') as stderr_file:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+        for line in process.stdout:
+            key, _, value = line.strip().partition('=')
+            if key == 'out_time_us' and on_progress and duration:
+                try:
+                    on_progress(min(int(value) / 1000000, duration), duration)
+                except ValueError:
+                    pass
+        returncode = process.wait()
+        stderr_file.seek(0)
+        return returncode, stderr_file.read()
+
+def _rendition_ok(output_path, preset, source_duration):
+    """Per-rendition check: file exists, has the preset frame size and (almost) the full duration"""
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        return False
+    
+    info = get_video_info(output_path)
+    expected_width, expected_height = map(int, preset['resolution'].split('x'))
+    if (info.get('width'), info.get('height')) != (expected_width, expected_height):
+        return False
+    # Обрезанный вывод (ffmpeg упал на середине) короче исходника
+    if source_duration and info.get('duration', 0) < source_duration * 0.98 - 1:
+        return False
+    return True
+
+def encode_renditions(video_file_path, renditions, source_duration=0, progress_callback=None, threads=None):
+    """
+    Encodes every rendition in a single ffmpeg pass
+    
+    Each output is checked on its own afterwards; renditions that are
+    missing, truncated or of the wrong size are re-encoded separately, so
+    one bad output does not lose the others.
+    
+    Args:
+        renditions: list of (quality, preset, output_path)
+        source_duration: seconds, for progress and truncation checks
+        progress_callback: progress_callback(done, total, step) as in create_quality_variants
+        threads: CPU threads ffmpeg may use (None - ffmpeg decides)
+    
+    Returns:
+        dict: {quality: output_path} of the renditions that were produced
+    """
+    ffmpeg_path = get_ffmpeg_path()
+    step = ','.join(quality for quality, _, _ in renditions)
+    reported = {'percent': -1}
+    
+    def on_progress(done, total):
+        percent = int(done * 100 / total)
+        # Не чаще раза в процент: callback пишет прогресс в БД
+        if progress_callback and percent != reported['percent']:
+            reported['percent'] = percent
+            progress_callback(done, total, step)
+    
+    cmd = build_multi_rendition_command(ffmpeg_path, video_file_path, renditions, threads)
+    logger.info(f"Running FFmpeg command: {' '.join(cmd)}")
+    returncode, stderr = _run_with_progress(cmd, source_duration, on_progress)
+    if returncode != 0:
+        logger.error(f"FFmpeg single-pass encoding exited with code {returncode}: {stderr}")
+    
+    produced = {}
+    for quality, preset, output_path in renditions:
+        if _rendition_ok(output_path, preset, source_duration):
+            produced[quality] = output_path
+            continue
+        
+        logger.warning(f"{quality} rendition failed in the single pass, encoding it separately")
+        cmd = build_single_rendition_command(ffmpeg_path, video_file_path, preset, output_path, threads)
+        process = subprocess.run(cmd, capture_output=True, text=True, check=False)
+        if process.returncode == 0 and _rendition_ok(output_path, preset, source_duration):
+            produced[quality] = output_path
+        else:
+            logger.error(f"FFmpeg error for {quality}: {process.stderr}")
+    
+    return produced
+
+def _has_audio(media_path):
+    cmd = [
+        get_ffprobe_path(), '-v', 'error', '-select_streams', 'a',
+        '-show_entries', 'stream=codec_type', '-of', 'json', media_path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=False)
+    if result.returncode != 0:
+        return False
+    try:
+        return bool(json.loads(result.stdout).get('streams'))
+    except ValueError:
+        return False
+
+def _codecs(preset):
+    """RFC 6381 codec string of the H.264 High profile output of _encoder_args"""
+    return f"avc1.6400{int(round(float(preset['level']) * 10)):02x}"
+
+def _read_media_playlist(stream_dir):
+    """Segments [(seconds, file name)] of a packaged stream and its bit rates"""
+    segments = []
+    duration = 0
+    with open(os.path.join(stream_dir, 'index.m3u8')) as playlist:
+        for line in playlist:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                duration = float(line[len('#EXTINF:'):].split(',', 1)[0])
+            elif line and not line.startswith('#'):
+                segments.append((duration, line))
+    
+    sizes = [os.path.getsize(os.path.join(stream_dir, name)) for _, name in segments]
+    total = sum(seconds for seconds, _ in segments)
+    return {
+        'segments': segments,
+        'duration': total,
+        # BANDWIDTH в HLS - пиковый битрейт сегмента, AVERAGE-BANDWIDTH - средний
+        'bandwidth': int(max((size * 8 / seconds for (seconds, _), size in zip(segments, sizes) if seconds), default=0)),
+        'average_bandwidth': int(sum(sizes) * 8 / total) if total else 0,
+    }
+
+def _package_stream(ffmpeg_path, input_path, stream, stream_dir):
+    """Cuts one stream (e.g. 0:v:0) of an encoded rendition into fMP4 segments, without re-encoding"""
+    os.makedirs(stream_dir, exist_ok=True)
+    cmd = [
+        ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-y', '-i', input_path,
+        '-map', stream, '-c', 'copy', '-f', 'hls',
+        '-hls_time', str(SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+        '-hls_segment_type', 'fmp4', '-hls_fmp4_init_filename', 'init.mp4',
+        '-hls_segment_filename', os.path.join(stream_dir, 'seg_%05d.m4s'),
+        os.path.join(stream_dir, 'index.m3u8')
+    ]
+    process = subprocess.run(cmd, capture_output=True, text=True, check=False)
+    if process.returncode != 0:
+        logger.error(f"FFmpeg packaging error for {input_path} ({stream}): {process.stderr}")
+        return None
+    return _read_media_playlist(stream_dir)
+
+def _hls_master_playlist(streams, audio):
+    lines = ['#EXTM3U', '#EXT-X-VERSION:7', '#EXT-X-INDEPENDENT-SEGMENTS']
+    if audio:
+        lines.append('#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="default",DEFAULT=YES,AUTOSELECT=YES,URI="audio/index.m3u8"')
+    
+    for quality, stream in streams.items():
+        attributes = [
+            f"BANDWIDTH={stream['bandwidth'] + (audio['bandwidth'] if audio else 0)}",
+            f"AVERAGE-BANDWIDTH={stream['average_bandwidth'] + (audio['average_bandwidth'] if audio else 0)}",
+            f"RESOLUTION={stream['resolution']}",
+            f'CODECS="{stream["codecs"]},{AUDIO_CODECS}"' if audio else f'CODECS="{stream["codecs"]}"',
+        ]
+        if audio:
+            attributes.append('AUDIO="audio"')
+        lines += ['#EXT-X-STREAM-INF:' + ','.join(attributes), f"{quality}/index.m3u8"]
+    return '\n'.join(lines) + '\n'
+
+def _dash_manifest(streams, audio):
+    """MPD over the same segments as the HLS playlists (explicit SegmentList, so URLs can be signed)"""
+    def segment_list(stream_dir, stream):
+        lines = [f'        <SegmentList timescale="1000" duration="{SEGMENT_SECONDS * 1000}">',
+                 f'          <Initialization sourceURL="{stream_dir}/init.mp4"/>']
+        lines += [f'          <SegmentURL media="{stream_dir}/{name}"/>' for _, name in stream['segments']]
+        return lines + ['        </SegmentList>']
+    
+    duration = max(stream['duration'] for stream in streams.values())
+    lines = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" profiles="urn:mpeg:dash:profile:isoff-main:2011" '
+        f'type="static" mediaPresentationDuration="PT{duration:.3f}S" minBufferTime="PT{SEGMENT_SECONDS}S">',
+        '  <Period id="0" start="PT0S">',
+        '    <AdaptationSet id="0" contentType="video" mimeType="video/mp4" segmentAlignment="true" startWithSAP="1">',
+    ]
+    for quality, stream in streams.items():
+        width, height = stream['resolution'].split('x')
+        lines.append(f'      <Representation id="{quality}" codecs="{stream["codecs"]}" width="{width}" height="{height}" bandwidth="{stream["bandwidth"]}">')
+        lines += segment_list(quality, stream) + ['      </Representation>']
+    lines.append('    </AdaptationSet>')
+    
+    if audio:
+        lines += [
+            '    <AdaptationSet id="1" contentType="audio" mimeType="audio/mp4" segmentAlignment="true" startWithSAP="1">',
+            f'      <Representation id="audio" codecs="{AUDIO_CODECS}" bandwidth="{audio["bandwidth"]}">',
+        ]
+        lines += segment_list('audio', audio) + ['      </Representation>', '    </AdaptationSet>']
+    return '\n'.join(lines + ['  </Period>', '</MPD>']) + '\n'
+
+def package_streaming(renditions, output_dir, dash=False, has_audio=None):
+    """
+    Packages encoded renditions for adaptive streaming
+    
+    The video of every rendition and the audio of the highest one are cut
+    into SEGMENT_SECONDS fMP4 (CMAF) segments without re-encoding. Keyframes
+    are forced on the segment boundaries (_encoder_args), so the segments of
+    all renditions start at the same times and a player can switch bitrate
+    at any boundary. master.m3u8 (and manifest.mpd with dash=True) reference
+    the same segment files.
+    
+    Args:
+        renditions: list of (quality, preset, encoded mp4 path), lowest first
+        output_dir: local directory to write the package to
+        has_audio: whether the source has audio (probed from the renditions if None)
+    
+    Returns:
+        dict: streaming info for the video metadata, None on failure
+    """
+    ffmpeg_path = get_ffmpeg_path()
+    
+    streams = {}
+    for quality, preset, encoded_path in renditions:
+        stream = _package_stream(ffmpeg_path, encoded_path, '0:v:0', os.path.join(output_dir, quality))
+        if stream:
+            stream.update(resolution=preset['resolution'], codecs=_codecs(preset))
+            streams[quality] = stream
+    if not streams:
+        return None
+    
+    audio = None
+    audio_source = [encoded_path for quality, _, encoded_path in renditions if quality in streams][-1]
+    if has_audio is None:
+        has_audio = _has_audio(audio_source)
+    if has_audio:
+        audio = _package_stream(ffmpeg_path, audio_source, '0:a:0', os.path.join(output_dir, 'audio'))
+        if not audio:
+            # Без звука вариант потока хуже прогрессивного MP4 - не публикуем пакет
+            return None
+    
+    with open(os.path.join(output_dir, 'master.m3u8'), 'w') as master:
+        master.write(_hls_master_playlist(streams, audio))
+    if dash:
+        with open(os.path.join(output_dir, 'manifest.mpd'), 'w') as manifest:
+            manifest.write(_dash_manifest(streams, audio))
+    
+    return {
+        'hls': 'master.m3u8',
+        'dash': 'manifest.mpd' if dash else None,
+        'audio': 'audio/index.m3u8' if audio else None,
+        'segment_duration': SEGMENT_SECONDS,
+        'variants': {
+            quality: {
+                'playlist': f"{quality}/index.m3u8",
+                'resolution': stream['resolution'],
+                'bandwidth': stream['bandwidth'],
+                'average_bandwidth': stream['average_bandwidth'],
+                'codecs': stream['codecs'],
+            }
+            for quality, stream in streams.items()
+        },
+    }
+
+def upload_streaming_package(bucket, package_dir, prefix):
+    """
+    Uploads a package under prefix, replacing a previous one
+    
+    Segments go first and manifests last, so a manifest never references a
+    segment that is not uploaded yet; leftovers of the previous package are
+    deleted afterwards. Also used for scrub previews (sheets, then the VTT).
+    """
+    import concurrent.futures
+    
+    previous = [blob.name for blob in bucket.list_blobs(prefix=prefix)]
+    files = [
+        os.path.relpath(os.path.join(root, name), package_dir).replace(os.sep, '/')
+        for root, _, names in os.walk(package_dir) for name in names
+    ]
+    manifests = [path for path in files if path.endswith(('.m3u8', '.mpd', '.vtt'))]
+    
+    def upload(relative_path):
+        blob = bucket.blob(prefix + relative_path)
+        blob.upload_from_filename(
+            os.path.join(package_dir, relative_path),
+            content_type=STREAMING_CONTENT_TYPES.get(os.path.splitext(relative_path)[1], 'application/octet-stream')
+        )
+        return blob.name
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=STREAMING_UPLOAD_WORKERS) as executor:
+        uploaded = set(executor.map(upload, [path for path in files if path not in manifests]))
+        uploaded.update(executor.map(upload, manifests))
+    
+    for name in previous:
+        if name not in uploaded:
+            bucket.blob(name).delete()
+    logger.info(f"Uploaded streaming package ({len(files)} files) to {prefix}")
+
+def _vtt_timestamp(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:06.3f}"
+
+def build_sprite_command(ffmpeg_path, input_path, output_pattern, interval, tile_size, threads=None):
+    width, height = tile_size
+    input_args = ['-threads', str(threads)] if threads else []
+    return [ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-y'] + input_args + [
+        '-i', input_path, '-an',
+        '-vf', f"fps=1/{interval},scale={width}:{height},tile={SPRITE_COLUMNS}x{SPRITE_ROWS}",
+        '-q:v', '5', '-start_number', '0', output_pattern
+    ]
+
+def thumbnails_vtt(sheets, tile_size, interval, duration):
+    """WebVTT thumbnails track: one cue per tile, pointing into its sheet with #xywh"""
+    width, height = tile_size
+    per_sheet = SPRITE_COLUMNS * SPRITE_ROWS
+    tiles = min(math.ceil(duration / interval), len(sheets) * per_sheet)
+    
+    lines = ['WEBVTT', '']
+    for index in range(tiles):
+        start = index * interval
+        position = index % per_sheet
+        x, y = position % SPRITE_COLUMNS * width, position // SPRITE_COLUMNS * height
+        lines += [
+            f"{_vtt_timestamp(start)} --> {_vtt_timestamp(min(duration, start + interval))}",
+            f"{sheets[index // per_sheet]}#xywh={x},{y},{width},{height}",
+            ''
+        ]
+    return '\n'.join(lines)
+
+def generate_scrub_previews(video_path, output_dir, duration, resolution, threads=None):
+    """
+    Renders seek bar previews: sprite sheets plus a WebVTT thumbnails track
+    
+    The player loads the few sheets once and shows hover previews by
+    cropping them, instead of fetching byte ranges of the video.
+    video_path can be any rendition; the lowest one decodes fastest.
+    
+    Args:
+        duration: seconds of the video
+        resolution: 'WxH' frame size of video_path; tiles keep its aspect ratio
+    
+    Returns:
+        dict: previews info for the video metadata, None on failure
+    """
+    width, height = (int(value) for value in resolution.split('x'))
+    if not duration or duration <= 0:
+        return None
+    
+    interval = max(SPRITE_INTERVAL, math.ceil(duration / SPRITE_MAX_TILES))
+    tile_size = (SPRITE_TILE_WIDTH, max(2, round(SPRITE_TILE_WIDTH * height / width / 2) * 2))
+    os.makedirs(output_dir, exist_ok=True)
+    
+    cmd = build_sprite_command(
+        get_ffmpeg_path(), video_path, os.path.join(output_dir, 'sprite_%03d.jpg'), interval, tile_size, threads
+    )
+    process = subprocess.run(cmd, capture_output=True, text=True, check=False)
+    sheets = sorted(name for name in os.listdir(output_dir) if name.startswith('sprite_'))
+    if process.returncode != 0 or not sheets:
+        logger.error(f"FFmpeg sprite error for {video_path}: {process.stderr}")
+        return None
+    
+    with open(os.path.join(output_dir, SPRITE_VTT), 'w', encoding='utf-8') as track:
+        track.write(thumbnails_vtt(sheets, tile_size, interval, duration))
+    
+    return {
+        'vtt': SPRITE_VTT,
+        'sheets': sheets,
+        'interval': interval,
+        'tile_width': tile_size[0],
+        'tile_height': tile_size[1],
+        'columns': SPRITE_COLUMNS,
+        'rows': SPRITE_ROWS,
+    }
+
+def create_quality_variants(video_file_path, user_id, video_id, progress_callback=None, threads=None, media_info=None,
+                            bucket=None):
+    """
+    Create quality variants for a video and update its metadata
+    
+    All variants are encoded from a single decode of the source (see
+    encode_renditions) and also packaged for HLS (and DASH with
+    settings.STREAMING_DASH) under {user_id}/videos/{video_id}/hls/.
+    Seek bar previews are stored under {user_id}/videos/{video_id}/previews/.
+    progress_callback(done, total, step) receives the
+    encoded and total seconds, and is called once more when finished.
+    media_info: probe_media fields recorded at ingest (e.g. the video
+    metadata); the file is probed only if they are missing.
+    bucket: an open bucket to reuse (batch processing); opened here if None.
+    
+    Returns an empty dict only if no preset applies to the source; encode
+    and storage failures raise QualityProcessingError, so queued jobs are
+    retried.
+    """
     from .gcs_storage import get_bucket, get_video_metadata, BUCKET_NAME
     import json
     import os
@@ -195,116 +844,152 @@ def create_quality_variants(video_file_path, user_id, video_id):
     
     logger.info(f"Processing quality variants for video {video_id}")
     
+    temp_dir = None
     try:
-        # Get video info to determine which qualities to process
-        video_info = get_video_info(video_file_path)
-        video_height = video_info.get('height', 0)
+        # Properties recorded at ingest; older videos are probed here once
+        media = None
+        video_info = video_info_from_media(media_info)
+        if not video_info:
+            media = probe_media(video_file_path)
+            video_info = video_info_from_media(media)
+            if not video_info:
+                raise QualityProcessingError(f"Could not probe {video_file_path}")
+        video_height = video_info.get('height') or 0
         video_width = video_info.get('width', 0)
         
         logger.info(f"Original video dimensions: {video_width}x{video_height}")
         
-        # Filter quality presets based on input video resolution
-        applicable_qualities = {
-            q: p for q, p in QUALITY_PRESETS.items()
-            if int(p['resolution'].split('x')[1]) <= video_height
-        }
+        # Per-title ladder: rungs and bitrates this content needs (no upscaling)
+        applicable_qualities, ladder_info = build_encoding_ladder(video_file_path, video_info)
         
         if not applicable_qualities:
             logger.warning(f"No applicable quality presets for video resolution {video_height}p")
             return {}
             
         # Get GCS bucket
-        bucket = get_bucket(BUCKET_NAME)
+        bucket = bucket or get_bucket(BUCKET_NAME)
         if not bucket:
             logger.error(f"Could not get bucket {BUCKET_NAME}")
-            raise RuntimeError(f"Could not get bucket {BUCKET_NAME}")
+            raise QualityProcessingError(f"Could not get bucket {BUCKET_NAME}")
             
         # Create temporary directory for processed videos
         temp_dir = tempfile.mkdtemp()
         
-        # Process each quality variant
+        # Decode once, encode every applicable rendition in the same ffmpeg run
+        renditions = [
+            (quality, preset, os.path.join(temp_dir, f"{video_id}_{quality}.mp4"))
+            for quality, preset in applicable_qualities.items()
+        ]
+        encoded = encode_renditions(
+            video_file_path, renditions,
+            source_duration=video_info.get('duration') or 0,
+            progress_callback=progress_callback,
+            threads=threads
+        )
+        
+        # Пакет для адаптивного стриминга собирается из тех же MP4 до их удаления
+        streaming = None
+        if encoded:
+            package_dir = os.path.join(temp_dir, 'stream')
+            try:
+                streaming = package_streaming(
+                    [rendition for rendition in renditions if rendition[0] in encoded],
+                    package_dir,
+                    dash=getattr(settings, 'STREAMING_DASH', False),
+                    has_audio=video_info.get('has_audio')
+                )
+                if streaming:
+                    prefix = f"{user_id}/videos/{video_id}/hls/"
+                    upload_streaming_package(bucket, package_dir, prefix)
+                    streaming.update(prefix=prefix, packaged_at=datetime.now().isoformat())
+            except Exception as e:
+                logger.error(f"Error packaging streaming renditions for video {video_id}: {str(e)}")
+                streaming = None
+            finally:
+                shutil.rmtree(package_dir, ignore_errors=True)
+        
+        # Превью для перемотки режутся из самой легкой рендиции - ее декодирование дешевле оригинала
+        scrub_previews = None
+        if encoded:
+            preview_dir = os.path.join(temp_dir, 'previews')
+            # Рендиции вписаны в кадр пресета, поэтому размер плиток берется из него
+            _, lowest_preset, lowest_path = [rendition for rendition in renditions if rendition[0] in encoded][0]
+            try:
+                scrub_previews = generate_scrub_previews(
+                    lowest_path, preview_dir, video_info.get('duration'), lowest_preset['resolution'], threads
+                )
+                if scrub_previews:
+                    prefix = f"{user_id}/videos/{video_id}/previews/"
+                    upload_streaming_package(bucket, preview_dir, prefix)
+                    scrub_previews.update(prefix=prefix, generated_at=datetime.now().isoformat())
+            except Exception as e:
+                logger.error(f"Error generating scrub previews for video {video_id}: {str(e)}")
+                scrub_previews = None
+            finally:
+                shutil.rmtree(preview_dir, ignore_errors=True)
+        
         quality_variants = {}
-        for quality, preset in applicable_qualities.items():
-            logger.info(f"Processing {quality} variant for video {video_id}")
-            
+        for quality, preset, output_path in renditions:
             try:
-                # Set output path for processed video
-                output_path = os.path.join(temp_dir, f"{video_id}_{quality}.mp4")
-                
-                # Calculate aspect ratio to maintain proportions
-                target_width, target_height = map(int, preset['resolution'].split('x'))
-                
-                # Use a simplified scale filter that maintains aspect ratio
-                scale_filter = f"scale={target_width}:{target_height}:force_original_aspect_ratio=decrease,pad={target_width}:{target_height}:(ow-iw)/2:(oh-ih)/2:color=black"
-                
-                # Process video to target quality
-                ffmpeg_path = get_ffmpeg_path()
-                cmd = [
-                    ffmpeg_path, '-i', video_file_path,
-                    '-vf', scale_filter,
-                    '-c:v', 'libx264', '-b:v', preset['bitrate'],
-                    '-c:a', 'aac', '-b:a', preset['audio_bitrate'],
-                    '-preset', 'medium', '-y', output_path
-                ]
-                
-                logger.info(f"Running FFmpeg command: {' '.join(cmd)}")
-                
-                process = subprocess.run(cmd, capture_output=True, text=True, check=False)
-                
-                if process.returncode != 0:
-                    logger.error(f"FFmpeg error for {quality}: {process.stderr}")
-                    continue
+                if quality in encoded:
+                    # Upload processed video to GCS
+                    target_path = f"{user_id}/videos/{video_id}_{quality}.mp4"
+                    blob = bucket.blob(target_path)
+                    blob.upload_from_filename(output_path, content_type='video/mp4')
                     
-                # Check if the output file exists and has size
-                if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-                    logger.error(f"Output file for {quality} was not created or is empty")
-                    continue
-                
-                # Upload processed video to GCS
-                target_path = f"{user_id}/videos/{video_id}_{quality}.mp4"
-                blob = bucket.blob(target_path)
-                blob.upload_from_filename(output_path, content_type='video/mp4')
-                
-                # Add to quality variants
-                quality_variants[quality] = {
-                    'path': target_path,
-                    'resolution': preset['resolution'],
-                    'bitrate': preset['bitrate']
-                }
-                
-                logger.info(f"Successfully created and uploaded {quality} variant for video {video_id}")
-                
+                    # Add to quality variants
+                    quality_variants[quality] = {
+                        'path': target_path,
+                        'resolution': preset['resolution'],
+                        'bitrate': preset['bitrate']
+                    }
+                    
+                    logger.info(f"Successfully created and uploaded {quality} variant for video {video_id}")
+            except Exception as e:
+                logger.error(f"Error uploading {quality} variant: {str(e)}")
+            finally:
                 # Clean up temporary file
                 try:
                     if os.path.exists(output_path):
                         os.remove(output_path)
                 except Exception as e:
                     logger.warning(f"Could not remove temporary file {output_path}: {e}")
-                
-            except Exception as e:
-                logger.error(f"Error processing {quality} variant: {str(e)}")
-        
-        # Clean up temp directory
-        try:
-            os.rmdir(temp_dir)
-        except Exception as e:
-            logger.warning(f"Could not remove temp directory {temp_dir}: {e}")
         
         if not quality_variants:
-            logger.warning(f"No quality variants were successfully created for video {video_id}")
-            return {}
+            raise QualityProcessingError(
+                f"None of {', '.join(applicable_qualities)} could be encoded and stored for video {video_id}"
+            )
+        
+        if progress_callback:
+            progress_callback(len(applicable_qualities), len(applicable_qualities), None)
             
         # Get existing metadata
-        metadata = get_video_metadata(user_id, video_id)
+        metadata = get_video_metadata(user_id, video_id, bucket=bucket)
         if not metadata:
             logger.error(f"Could not get metadata for video {video_id}")
-            raise RuntimeError(f"Could not get metadata for video {video_id}")
+            raise QualityProcessingError(f"Could not get metadata for video {video_id}")
+        
+        # Варианты, которых больше нет в лестнице (после перекодирования), удаляются
+        for quality, variant in (metadata.get('quality_variants') or {}).items():
+            if quality not in quality_variants and variant.get('path'):
+                stale_blob = bucket.blob(variant['path'])
+                if stale_blob.exists():
+                    stale_blob.delete()
         
         # Update metadata
         metadata['quality_variants'] = quality_variants
         metadata['available_qualities'] = list(quality_variants.keys())
         if quality_variants:
             metadata['highest_quality'] = max(quality_variants.keys(), key=lambda q: int(q.rstrip('p')))
+        if streaming:
+            metadata['streaming'] = streaming
+        if scrub_previews:
+            metadata['scrub_previews'] = scrub_previews
+        if ladder_info:
+            metadata['encoding_ladder'] = ladder_info
+        if media:
+            # Видео, загруженные до появления probe_media, получают поля здесь
+            metadata.update(media)
         
         # Upload updated metadata
         metadata_path = f"{user_id}/metadata/{video_id}.json"
@@ -316,4 +1001,9 @@ def create_quality_variants(video_file_path, user_id, video_id):
     
     except Exception as e:
         logger.error(f"Error creating quality variants for video {video_id}: {str(e)}")
-        return {}
\ No newline at end of file
+        if isinstance(e, QualityProcessingError):
+            raise
+        raise QualityProcessingError(str(e)) from e
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
\ No newline at end of file
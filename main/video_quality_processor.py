@@ -10,7 +10,12 @@ logger = logging.getLogger(__name__)
 
 def process_video_quality_async(video_file_path, user_id, video_id):
     """
-    Start a background thread to process video quality without blocking the main thread
+    Queue quality processing without blocking the main thread
+    
+    The job is stored in the transcode queue (main.transcode_queue), so it
+    survives restarts and is processed by `manage.py transcode_worker`.
+    The worker reads the original from storage, video_file_path is only
+    used when the metadata has no stored file path.
     
     Args:
         video_file_path (str): Path to the original video file (local or gs:// path)
@@ -18,15 +23,14 @@ def process_video_quality_async(video_file_path, user_id, video_id):
         video_id (str): Video ID
     """
     try:
-        # Create a thread to process the video quality
-        worker_thread = threading.Thread(
-            target=run_quality_processing,
-            args=(video_file_path, user_id, video_id)
-        )
-        worker_thread.daemon = True
-        worker_thread.start()
+        from .gcs_storage import get_video_metadata, BUCKET_NAME
+        from .transcode_queue import enqueue_transcode
+        
+        metadata = get_video_metadata(user_id, video_id) or {}
+        source_path = metadata.get('file_path') or video_file_path.replace(f"gs://{BUCKET_NAME}/", '')
+        job = enqueue_transcode(user_id, video_id, source_path)
         
-        logger.info(f"Started background quality processing for video {video_id}")
+        logger.info(f"Queued quality processing for video {video_id} as job {job.pk}")
         
         return True
     except Exception as e:
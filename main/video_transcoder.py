@@ -0,0 +1,229 @@
+"""
+Streaming transcoder for videos that are already stored in GCS
+
+transcode_to_quality never puts a whole file on local disk:
+
+- the original is read with ranged GCS reads (BlobReader) and piped into
+  ffmpeg's stdin. An MP4 whose index (moov) is at the end cannot be
+  decoded from a pipe; ffmpeg then reads it from a signed URL, which it
+  also fetches with HTTP range requests.
+- ffmpeg writes a fragmented MP4 to stdout (a regular MP4 needs a seekable
+  output to write its index), and stdout is written into a GCS resumable
+  upload (BlobWriter) chunk by chunk.
+
+Memory use is one read chunk plus one upload chunk, whatever the file size.
+If ffmpeg fails, or the output is shorter than the original (e.g. a read
+ended early), the resumable upload is cancelled, so no partial object is
+ever created.
+"""
+import collections
+import logging
+import os
+import struct
+import subprocess
+import threading
+
+from .video_quality import (
+    QUALITY_PRESETS, get_ffmpeg_path, probe_media, video_info_from_media, _scale_filter, _encoder_args
+)
+
+logger = logging.getLogger(__name__)
+
+# Ranged read size; ffmpeg blocks on stdin while a chunk is being fetched
+READ_CHUNK_SIZE = 8 * 1024 * 1024
+# Size of a resumable upload request; must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+SIGNED_URL_TTL = 6 * 3600
+
+# Qualities transcode_videos offers in addition to QUALITY_PRESETS
+TRANSCODE_PRESETS = dict(QUALITY_PRESETS, **{
+    '240p': {
+        'resolution': '426x240',
+        'bitrate': '400k',
+        'audio_bitrate': '64k',
+        'level': '2.1'
+    },
+    '480p': {
+        'resolution': '854x480',
+        'bitrate': '1200k',
+        'audio_bitrate': '96k',
+        'level': '3.0'
+    },
+})
+
+MP4_EXTENSIONS = ('.mp4', '.m4v', '.mov')
+
+
+class TranscodeError(Exception):
+    pass
+
+
+def _moov_before_mdat(blob):
+    """
+    Walks the top-level MP4 boxes with small ranged reads: True if the index
+    (moov) comes before the media data, i.e. the file decodes from a pipe
+    """
+    offset = 0
+    while offset + 8 <= blob.size:
+        header = blob.download_as_bytes(start=offset, end=min(offset + 15, blob.size - 1))
+        size, kind = struct.unpack('>I4s', header[:8])
+        if size == 1 and len(header) >= 16:
+            size = struct.unpack('>Q', header[8:16])[0]
+        elif size == 0:
+            size = blob.size - offset
+        if kind == b'moov':
+            return True
+        if kind == b'mdat' or size < 8:
+            return False
+        offset += size
+    return False
+
+
+def _pipe_input(blob):
+    if os.path.splitext(blob.name)[1].lower() not in MP4_EXTENSIONS:
+        # Matroska/WebM читаются последовательно
+        return True
+    return _moov_before_mdat(blob)
+
+
+def _signed_url(blob):
+    return blob.generate_signed_url(version="v4", expiration=SIGNED_URL_TTL, method="GET")
+
+
+def get_video_info(source_blob, metadata=None):
+    """
+    Video info for transcoding (see video_quality.video_info_from_media)
+
+    Uses the probe fields stored in the metadata at ingest; older videos are
+    probed over a signed URL, which reads only the headers.
+
+    Returns:
+        dict or None if the video could not be probed
+    """
+    video_info = video_info_from_media(metadata)
+    if video_info:
+        return video_info
+    return video_info_from_media(probe_media(_signed_url(source_blob)))
+
+
+def build_transcode_command(ffmpeg_path, input_arg, preset, threads=None):
+    input_args = ['-threads', str(threads)] if threads else []
+    # -progress в stderr: stdout занят видеопотоком
+    return [ffmpeg_path, '-hide_banner', '-nostats', '-loglevel', 'error', '-progress', 'pipe:2'] + input_args + \
+        ['-i', input_arg, '-vf', _scale_filter(preset), '-map', '0:v:0', '-map', '0:a?'] + \
+        _encoder_args(preset, threads) + \
+        ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof', 'pipe:1']
+
+
+def _feed_stdin(source_blob, stdin, errors):
+    """Copies the original into ffmpeg's stdin with ranged reads"""
+    try:
+        with source_blob.open('rb', chunk_size=READ_CHUNK_SIZE) as reader:
+            while True:
+                chunk = reader.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                stdin.write(chunk)
+    except BrokenPipeError:
+        # ffmpeg перестал читать: ошибку покажет его код возврата
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def _drain_stderr(stderr, tail, progress):
+    for line in stderr:
+        line = line.decode(errors='replace').rstrip()
+        key, _, value = line.partition('=')
+        if key == 'out_time_us':
+            try:
+                progress['seconds'] = int(value) / 1000000
+            except ValueError:
+                pass
+        elif key not in ('frame', 'fps', 'bitrate', 'total_size', 'out_time_ms', 'out_time', 'dup_frames',
+                         'drop_frames', 'speed', 'progress') and not key.startswith('stream_'):
+            tail.append(line)
+
+
+def transcode_to_quality(source_blob, target_blob, quality, threads=None, expected_duration=None):
+    """
+    Transcodes a stored video into one quality and stores the result
+
+    Args:
+        source_blob: the original (google.cloud.storage.Blob with size loaded)
+        target_blob: where the transcoded MP4 is written
+        quality: key of TRANSCODE_PRESETS
+        expected_duration: seconds of the original; a shorter output is discarded
+
+    Returns:
+        bool: True if target_blob was written
+    """
+    preset = TRANSCODE_PRESETS.get(quality)
+    if not preset:
+        logger.error(f"Unknown quality {quality}")
+        return False
+
+    if source_blob.size is None:
+        source_blob.reload()
+    pipe_input = _pipe_input(source_blob)
+    cmd = build_transcode_command(get_ffmpeg_path(), 'pipe:0' if pipe_input else _signed_url(source_blob), preset, threads)
+    logger.info(f"Transcoding {source_blob.name} to {quality} ({'pipe' if pipe_input else 'signed URL'} input)")
+
+    process = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE if pipe_input else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    errors = []
+    stderr_tail = collections.deque(maxlen=20)
+    progress = {'seconds': 0}
+    threads_started = [threading.Thread(
+        target=_drain_stderr, args=(process.stderr, stderr_tail, progress), daemon=True
+    )]
+    if pipe_input:
+        threads_started.append(threading.Thread(
+            target=_feed_stdin, args=(source_blob, process.stdin, errors), daemon=True
+        ))
+    for thread in threads_started:
+        thread.start()
+
+    try:
+        # Исключение внутри with отменяет resumable-сессию: частичный объект не создается
+        with target_blob.open('wb', chunk_size=UPLOAD_CHUNK_SIZE, content_type='video/mp4') as writer:
+            written = 0
+            while True:
+                chunk = process.stdout.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                written += len(chunk)
+
+            returncode = process.wait()
+            for thread in threads_started:
+                thread.join()
+            if errors:
+                raise TranscodeError(f"Could not read {source_blob.name}: {errors[0]}")
+            if returncode != 0 or not written:
+                raise TranscodeError(f"ffmpeg exited with code {returncode}: {' | '.join(stderr_tail)}")
+            # Обрезанный вход (оборванное чтение) ffmpeg считает обычным концом файла
+            if expected_duration and progress['seconds'] < expected_duration * 0.98 - 1:
+                raise TranscodeError(f"Output is {progress['seconds']:.1f}s, expected {expected_duration:.1f}s")
+
+        logger.info(f"Stored {quality} version of {source_blob.name} at {target_blob.name} ({written} bytes)")
+        return True
+
+    except Exception as e:
+        logger.error(f"Error transcoding {source_blob.name} to {quality}: {e}")
+        return False
+
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
@@ -1,9 +1,12 @@
 
 from django.shortcuts import render, redirect
-from .models import VideoLike, Category, Subscription
+from .models import VideoLike, Category, Subscription, ChannelStats
 import random
 from .gcs_storage import get_video_metadata, get_bucket
+from .realtime import publish_video_event
 from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.contrib.auth import authenticate, login, logout
 from django.shortcuts import redirect
 from django.contrib import messages
@@ -161,8 +164,11 @@ def video_detail(request, video_id):
         user_profile = get_user_profile_from_gcs(user_id)
         display_name = user_profile.get('display_name', user_id.replace('@', '')) if user_profile else user_id.replace('@', '')
         
-        # Get comments
+        # Get comments - only the first page is rendered inline, the rest is loaded via /api/comments/
+        # (the merged set comes from the same cache as the API, see get_video_comments)
+        from .comments import get_comments_page, COMMENTS_INITIAL_PAGE_SIZE
         comments_data = get_video_comments(user_id, gcs_video_id)
+        comments_page = get_comments_page(comments_data, limit=COMMENTS_INITIAL_PAGE_SIZE)
         
         # Prepare video data without the actual video URL (will be fetched client-side)
         video_data = {
@@ -184,22 +190,19 @@ def video_detail(request, video_id):
             'age': metadata.get('age_text', 'Recently')
         }
         
-        # Check if a thumbnail exists and add its path to the data
-        if "thumbnail_path" in metadata:
-            from .gcs_storage import generate_video_url
-            video_data['thumbnail_url'] = generate_video_url(
-                user_id, 
-                gcs_video_id, 
-                file_path=metadata["thumbnail_path"], 
-                expiration_time=3600
-            )
+        # Poster for the player: the largest thumbnail derivative (or the original)
+        from .gcs_storage import get_thumbnail_urls
+        from .image_derivatives import THUMBNAIL_WIDTHS
+        video_data.update(get_thumbnail_urls(user_id, gcs_video_id, metadata, width=max(THUMBNAIL_WIDTHS)))
         
         # Get recommended videos using optimized function - can be loaded in background
         recommended_videos = get_recommended_videos(user_id, gcs_video_id)
         
         return render(request, 'main/video.html', {
             'video': video_data,
-            'comments': comments_data.get('comments', []),
+            'comments': comments_page['comments'],
+            'comments_next_cursor': comments_page['next_cursor'],
+            'comments_total': comments_page['total'],
             'recommended_videos': recommended_videos
         })
     except Exception as e:
@@ -242,7 +245,7 @@ def get_recommended_videos(current_user_id, current_video_id, limit=10):
         list: Список рекомендованных видео
     """
     try:
-        from .gcs_storage import list_user_videos, get_bucket, BUCKET_NAME, generate_video_url, get_user_profile_from_gcs
+        from .gcs_storage import list_user_videos, get_bucket, BUCKET_NAME, get_thumbnail_urls, get_user_profile_from_gcs
         import random
         import concurrent.futures
         
@@ -323,13 +326,7 @@ def get_recommended_videos(current_user_id, current_video_id, limit=10):
                 video['url'] = f"/video/{user_id}__{video_id}/"
                 
                 # URL для миниатюры
-                if 'thumbnail_path' in video:
-                    video['thumbnail_url'] = generate_video_url(
-                        user_id, 
-                        video_id, 
-                        file_path=video['thumbnail_path'], 
-                        expiration_time=3600
-                    )
+                video.update(get_thumbnail_urls(user_id, video_id, video, bucket=bucket))
                 
                 # Форматируем данные для шаблона
                 # Используем display_name из метаданных или user_id
@@ -415,25 +412,14 @@ def search_results(request):
                 metadata_prefix = f"{user_id}/metadata/"
                 metadata_blobs = list(bucket.list_blobs(prefix=metadata_prefix, max_results=50))
                 
-                # Get user profile for display name and avatar
-                user_profile = None
+                # Get user profile for display name and avatar (served from the profile cache)
+                from .gcs_storage import get_user_profile_from_gcs
+                user_profile = get_user_profile_from_gcs(user_id)
                 avatar_url = None
-                try:
-                    user_meta_blob = bucket.blob(f"{user_id}/bio/user_meta.json")
-                    if user_meta_blob.exists():
-                        user_profile = json.loads(user_meta_blob.download_as_text())
-                        
-                        # Check if user has a custom avatar and generate URL
-                        if user_profile.get('avatar_path') and not user_profile.get('is_default_avatar', True):
-                            avatar_blob = bucket.blob(user_profile.get('avatar_path'))
-                            if avatar_blob.exists():
-                                avatar_url = avatar_blob.generate_signed_url(
-                                    version="v4",
-                                    expiration=3600,
-                                    method="GET"
-                                )
-                except Exception as profile_error:
-                    logger.error(f"Error loading profile for {user_id}: {profile_error}")
+                
+                # Only custom avatars are shown in search results
+                if user_profile and not user_profile.get('is_default_avatar', True):
+                    avatar_url = user_profile.get('avatar_url')
                 
                 # Get display name from profile or fallback to username
                 display_name = user_profile.get('display_name', user_id.replace('@', '')) if user_profile else user_id.replace('@', '')
@@ -468,6 +454,10 @@ def search_results(request):
                                 # Add thumbnail path if available
                                 if 'thumbnail_path' in video_data:
                                     minimal_data['thumbnail_path'] = video_data['thumbnail_path']
+                                if 'thumbnail_derivatives' in video_data:
+                                    minimal_data['thumbnail_derivatives'] = video_data['thumbnail_derivatives']
+                                if 'thumbnail_lqip' in video_data:
+                                    minimal_data['thumbnail_lqip'] = video_data['thumbnail_lqip']
                                 
                                 # Format views
                                 views = video_data.get('views', 0)
@@ -546,19 +536,12 @@ def search_results(request):
         paginated_results = search_results[offset:offset + limit]
         
         # Generate thumbnail URLs for paginated results only
-        from .gcs_storage import generate_video_url
+        from .gcs_storage import get_thumbnail_urls
         for video in paginated_results:
-            # Only generate URLs if thumbnail_path exists
-            if video.get('thumbnail_path'):
-                try:
-                    video['thumbnail_url'] = generate_video_url(
-                        video['user_id'], 
-                        video['video_id'], 
-                        file_path=video['thumbnail_path'], 
-                        expiration_time=3600
-                    )
-                except Exception as url_error:
-                    logger.error(f"Error generating thumbnail URL: {url_error}")
+            try:
+                video.update(get_thumbnail_urls(video['user_id'], video['video_id'], video))
+            except Exception as url_error:
+                logger.error(f"Error generating thumbnail URL: {url_error}")
         
         # Return JSON response for AJAX
         return JsonResponse({
@@ -1083,48 +1066,38 @@ def toggle_subscription(request):
         if not channel_id:
             return JsonResponse({'success': False, 'error': 'Missing channel_id'}, status=400)
 
-        # Check if subscription exists
-        subscription_exists = Subscription.objects.filter(
-            subscriber=request.user,
-            channel_id=channel_id
-        ).exists()
+        with transaction.atomic():
+            # Check if subscription exists
+            subscription_exists = Subscription.objects.filter(
+                subscriber=request.user,
+                channel_id=channel_id
+            ).exists()
+
+            # Determine action based on current state and requested action
+            if action == 'toggle':
+                action = 'unsubscribe' if subscription_exists else 'subscribe'
 
-        # Determine action based on current state and requested action
-        if action == 'toggle':
-            if subscription_exists:
-                # Unsubscribe
+            if action == 'subscribe' and not subscription_exists:
+                # Subscribe only if not already subscribed
+                # ChannelStats is updated by the post_save signal in the same transaction
+                Subscription.objects.get_or_create(
+                    subscriber=request.user,
+                    channel_id=channel_id
+                )
+                is_subscribed = True
+            elif action == 'unsubscribe' and subscription_exists:
+                # Unsubscribe only if currently subscribed
                 Subscription.objects.filter(
                     subscriber=request.user,
                     channel_id=channel_id
                 ).delete()
                 is_subscribed = False
             else:
-                # Subscribe
-                Subscription.objects.create(
-                    subscriber=request.user,
-                    channel_id=channel_id
-                )
-                is_subscribed = True
-        elif action == 'subscribe' and not subscription_exists:
-            # Subscribe only if not already subscribed
-            Subscription.objects.create(
-                subscriber=request.user,
-                channel_id=channel_id
-            )
-            is_subscribed = True
-        elif action == 'unsubscribe' and subscription_exists:
-            # Unsubscribe only if currently subscribed
-            Subscription.objects.filter(
-                subscriber=request.user,
-                channel_id=channel_id
-            ).delete()
-            is_subscribed = False
-        else:
-            # No change needed
-            is_subscribed = subscription_exists
+                # No change needed
+                is_subscribed = subscription_exists
 
-        # Get subscriber count for this channel
-        subscriber_count = Subscription.objects.filter(channel_id=channel_id).count()
+            # Get maintained subscriber count for this channel
+            subscriber_count = ChannelStats.get_subscriber_count(channel_id)
 
         return JsonResponse({
             'success': True,
@@ -1147,8 +1120,8 @@ def check_subscription(request, channel_id):
             channel_id=channel_id
         ).exists()
         
-        # Get subscriber count for this channel
-        subscriber_count = Subscription.objects.filter(channel_id=channel_id).count()
+        # Get maintained subscriber count for this channel
+        subscriber_count = ChannelStats.get_subscriber_count(channel_id)
         
         return JsonResponse({
             'success': True,
@@ -1165,44 +1138,31 @@ def get_subscriptions(request):
     API endpoint to get user's subscriptions
     """
     try:
-        subscriptions = Subscription.objects.filter(subscriber=request.user).order_by('-subscribed_at')
-        
-        # Collect channel_ids to fetch profiles from GCS
-        channel_ids = [sub.channel_id for sub in subscriptions]
+        # One query: subscriptions joined with the maintained subscriber counters
+        subscriber_count = ChannelStats.objects.filter(
+            channel_id=OuterRef('channel_id')
+        ).values('subscriber_count')[:1]
+        subscriptions = list(
+            Subscription.objects.filter(subscriber=request.user)
+            .annotate(subscriber_count=Coalesce(Subquery(subscriber_count), 0))
+            .order_by('-subscribed_at')
+            .values('channel_id', 'subscriber_count')
+        )
+        
+        # One batched pass over GCS for all channel profiles
+        from .gcs_storage import get_user_profiles_from_gcs
+        channel_profiles = get_user_profiles_from_gcs([sub['channel_id'] for sub in subscriptions])
         
-        # Prepare subscription data with available info
         subscription_data = []
-        from .gcs_storage import get_user_profile_from_gcs
-        
-        for channel_id in channel_ids:
-            try:
-                # Try to get channel profile from GCS
-                channel_profile = get_user_profile_from_gcs(channel_id)
-                
-                if channel_profile:
-                    subscription_data.append({
-                        'channel_id': channel_id,
-                        'display_name': channel_profile.get('display_name', channel_id.replace('@', '')),
-                        'avatar_url': channel_profile.get('avatar_url', ''),
-                        'subscriber_count': Subscription.objects.filter(channel_id=channel_id).count()
-                    })
-                else:
-                    # Fallback if profile not found
-                    subscription_data.append({
-                        'channel_id': channel_id,
-                        'display_name': channel_id.replace('@', ''),
-                        'avatar_url': '',
-                        'subscriber_count': Subscription.objects.filter(channel_id=channel_id).count()
-                    })
-            except Exception as profile_error:
-                logger.error(f"Error fetching profile for {channel_id}: {profile_error}")
-                # Add with minimal information
-                subscription_data.append({
-                    'channel_id': channel_id,
-                    'display_name': channel_id.replace('@', ''),
-                    'avatar_url': '',
-                    'subscriber_count': Subscription.objects.filter(channel_id=channel_id).count()
-                })
+        for sub in subscriptions:
+            channel_id = sub['channel_id']
+            channel_profile = channel_profiles.get(channel_id) or {}
+            subscription_data.append({
+                'channel_id': channel_id,
+                'display_name': channel_profile.get('display_name') or channel_id.replace('@', ''),
+                'avatar_url': channel_profile.get('avatar_url', ''),
+                'subscriber_count': sub['subscriber_count']
+            })
         
         return JsonResponse({
             'success': True,
@@ -1303,6 +1263,11 @@ def toggle_video_like(request):
 
             metadata_blob.upload_from_string(json.dumps(metadata, indent=2), content_type='application/json')
 
+        publish_video_event(user_id, video_id, 'likes', {
+            'likes': metadata['likes'],
+            'dislikes': metadata.get('dislikes', 0)
+        })
+
         return JsonResponse({
             'success': True,
             'likes': metadata['likes'],
@@ -1379,6 +1344,11 @@ def toggle_video_dislike(request):
 
             metadata_blob.upload_from_string(json.dumps(metadata, indent=2), content_type='application/json')
 
+        publish_video_event(user_id, video_id, 'likes', {
+            'likes': metadata.get('likes', 0),
+            'dislikes': metadata['dislikes']
+        })
+
         return JsonResponse({
             'success': True,
             'likes': metadata.get('likes', 0),
@@ -1427,7 +1397,182 @@ def get_video_like_status(request, video_id):
     except Exception as e:
         logger.error(f"Error getting like status: {str(e)}")
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+# Upper bound for ids accepted by the batch status endpoint
+MAX_BATCH_STATUS_IDS = 100
+
+def _split_ids(value):
+    """Splits a comma separated query parameter into a list of unique ids"""
+    if not value:
+        return []
+    ids = [item.strip() for item in value.split(',') if item.strip()]
+    return list(dict.fromkeys(ids))[:MAX_BATCH_STATUS_IDS]
+
+@require_http_methods(["GET"])
+def get_batch_status(request):
+    """
+    API endpoint returning like/dislike and subscription state for many items at once
+
+    Parameters:
+    - videos: comma separated composite video IDs (user_id__video_id)
+    - channels: comma separated channel IDs (with @ prefix)
+
+    Returns:
+    - JSON with per-video and per-channel state, resolved with two IN queries
+      (plus one for subscriber counts)
+    """
+    try:
+        video_ids = [video_id for video_id in _split_ids(request.GET.get('videos')) if '__' in video_id]
+        channel_ids = _split_ids(request.GET.get('channels'))
+        authenticated = request.user.is_authenticated
+
+        videos = {video_id: {'is_liked': False, 'is_disliked': False} for video_id in video_ids}
+        channels = {channel_id: {'is_subscribed': False} for channel_id in channel_ids}
+
+        if authenticated and video_ids:
+            pairs = [video_id.split('__', 1) for video_id in video_ids]
+            likes = VideoLike.objects.filter(
+                user=request.user,
+                video_owner__in={owner for owner, _ in pairs},
+                video_id__in={gcs_id for _, gcs_id in pairs}
+            ).values_list('video_owner', 'video_id', 'is_like')
+
+            for owner, gcs_id, is_like in likes:
+                composite_id = f"{owner}__{gcs_id}"
+                if composite_id in videos:
+                    videos[composite_id] = {'is_liked': is_like, 'is_disliked': not is_like}
+
+        if channel_ids:
+            if authenticated:
+                subscribed = set(Subscription.objects.filter(
+                    subscriber=request.user,
+                    channel_id__in=channel_ids
+                ).values_list('channel_id', flat=True))
+            else:
+                subscribed = set()
+
+            subscriber_counts = ChannelStats.get_subscriber_counts(channel_ids)
+            for channel_id in channel_ids:
+                channels[channel_id] = {
+                    'is_subscribed': channel_id in subscribed,
+                    'subscriber_count': subscriber_counts.get(channel_id, 0)
+                }
+
+        return JsonResponse({
+            'success': True,
+            'authenticated': authenticated,
+            'videos': videos,
+            'channels': channels
+        })
+    except Exception as e:
+        logger.error(f"Error getting batch status: {str(e)}")
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+@require_http_methods(["GET"])
+def get_comments(request, video_id):
+    """
+    API endpoint for cursor-paginated comments of a video
+    
+    Parameters:
+    - video_id: composite video ID (user_id__video_id)
+    - order: newest (default) or top
+    - cursor: opaque cursor from the previous page
+    - limit: page size
+    - comment_id: if set, returns replies of this comment instead
+    
+    Returns:
+    - JSON with the page and next_cursor (null on the last page)
+    """
+    from .comments import (
+        get_comments_page, get_replies_page, InvalidCursor,
+        COMMENT_ORDERS, COMMENTS_PAGE_SIZE, MAX_COMMENTS_PAGE_SIZE
+    )
+    from .gcs_storage import get_video_comments
     
+    try:
+        if '__' not in video_id:
+            return JsonResponse({'success': False, 'error': 'Invalid video ID format'}, status=400)
+        user_id, gcs_video_id = video_id.split('__', 1)
+        
+        order = request.GET.get('order', 'newest')
+        if order not in COMMENT_ORDERS:
+            return JsonResponse({'success': False, 'error': 'Unknown order'}, status=400)
+        
+        try:
+            limit = int(request.GET.get('limit', COMMENTS_PAGE_SIZE))
+        except ValueError:
+            limit = COMMENTS_PAGE_SIZE
+        limit = max(1, min(limit, MAX_COMMENTS_PAGE_SIZE))
+        
+        cursor = request.GET.get('cursor') or None
+        comment_id = request.GET.get('comment_id')
+        comments_data = get_video_comments(user_id, gcs_video_id)
+        
+        try:
+            if comment_id:
+                page = get_replies_page(comments_data, comment_id, cursor=cursor, limit=limit)
+                if page is None:
+                    return JsonResponse({'success': False, 'error': 'Comment not found'}, status=404)
+            else:
+                page = get_comments_page(comments_data, order=order, cursor=cursor, limit=limit)
+        except InvalidCursor as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
+        
+        return JsonResponse({'success': True, 'order': order, **page})
+    except Exception as e:
+        logger.error(f"Error getting comments page: {str(e)}")
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+@require_http_methods(["GET"])
+async def video_event_stream(request, video_id):
+    """
+    Server-Sent Events stream of Q&A events for a video
+    
+    Events:
+    - comment: new top-level comment
+    - reply: new reply ({comment_id, reply})
+    - likes: video like/dislike counters
+    - resync: the client fell behind and should reload the first page
+    
+    Requires the ASGI server (eduvideo.asgi:application); under WSGI the
+    stream would occupy a worker, so 204 is returned and EventSource stops.
+    """
+    import asyncio
+    from django.core.handlers.asgi import ASGIRequest
+    from django.http import HttpResponse, StreamingHttpResponse
+    from .realtime import get_broker, video_channel, HEARTBEAT_INTERVAL, RETRY_MS, RESYNC
+    
+    if '__' not in video_id:
+        return JsonResponse({'success': False, 'error': 'Invalid video ID format'}, status=400)
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    
+    video_owner, gcs_video_id = video_id.split('__', 1)
+    subscription = get_broker().subscribe(video_channel(video_owner, gcs_video_id))
+    
+    async def stream():
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            while True:
+                try:
+                    message = await subscription.get(HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                
+                if message is RESYNC:
+                    yield "event: resync\ndata: {}\n\n"
+                    break
+                yield message
+        finally:
+            # Runs on client disconnect too (the generator is cancelled)
+            subscription.close()
+    
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 def channel_view(request, username):
     """
     View for displaying a channel/author page
@@ -1467,7 +1612,7 @@ def channel_view(request, username):
         total_videos = 0
         
         # Get the GCS bucket
-        from .gcs_storage import get_bucket, BUCKET_NAME, generate_video_url
+        from .gcs_storage import get_bucket, BUCKET_NAME, get_thumbnail_urls
         bucket = get_bucket(BUCKET_NAME)
         
         if bucket:
@@ -1509,13 +1654,7 @@ def channel_view(request, username):
                             metadata['upload_date_formatted'] = "Недавно"
                         
                         # Add thumbnail URL
-                        if 'thumbnail_path' in metadata:
-                            metadata['thumbnail_url'] = generate_video_url(
-                                username, 
-                                metadata['video_id'], 
-                                file_path=metadata['thumbnail_path'], 
-                                expiration_time=3600
-                            )
+                        metadata.update(get_thumbnail_urls(username, metadata['video_id'], metadata, bucket=bucket))
                         
                         videos.append(metadata)
                     except Exception as e:
@@ -1530,13 +1669,9 @@ def channel_view(request, username):
         
         # Add channel statistics if not present
         if 'stats' not in channel:
-            channel['stats'] = {
-                'videos_count': total_videos,
-                'subscribers': 0  # Placeholder since we don't have real subscriber data
-            }
-        else:
-            # Update videos count
-            channel['stats']['videos_count'] = total_videos
+            channel['stats'] = {}
+        channel['stats']['videos_count'] = total_videos
+        channel['stats']['subscribers'] = ChannelStats.get_subscriber_count(username)
         
         return render(request, 'main/channel.html', {
             'channel': channel,
@@ -1581,4 +1716,44 @@ def get_user_profile(request):
         })
     except Exception as e:
         logger.error(f"Error getting user profile: {str(e)}")
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+@require_http_methods(["GET"])
+def get_user_profiles(request):
+    """
+    API endpoint returning short profiles for many users in one request
+    
+    Parameters:
+    - ids: comma separated user IDs (with @ prefix), at most MAX_BATCH_STATUS_IDS
+    
+    Returns:
+    - JSON with {user_id: {display_name, avatar_url, subscriber_count}} or null
+      for unknown users. Profiles come from the profile cache, misses are
+      loaded concurrently with bounded parallelism.
+    """
+    try:
+        user_ids = _split_ids(request.GET.get('ids'))
+        if not user_ids:
+            return JsonResponse({'success': False, 'error': 'Missing ids parameter'}, status=400)
+        
+        from .gcs_storage import get_user_profiles_from_gcs
+        profiles = get_user_profiles_from_gcs(user_ids)
+        subscriber_counts = ChannelStats.get_subscriber_counts(user_ids)
+        
+        result = {}
+        for user_id in user_ids:
+            profile = profiles.get(user_id)
+            if not profile:
+                result[user_id] = None
+                continue
+            result[user_id] = {
+                'user_id': user_id,
+                'display_name': profile.get('display_name') or user_id.replace('@', ''),
+                'avatar_url': profile.get('avatar_url'),
+                'subscriber_count': subscriber_counts.get(user_id, 0)
+            }
+        
+        return JsonResponse({'success': True, 'profiles': result})
+    except Exception as e:
+        logger.error(f"Error getting user profiles: {str(e)}")
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
\ No newline at end of file
@@ -38,6 +38,10 @@ document.addEventListener('DOMContentLoaded', function() {
     let availableQualities = [];
     let currentQualitySelection = 'auto';
     
+    // Adaptive streaming (HLS): hls.js over MediaSource, or native playback in Safari
+    const hlsJsSupported = typeof Hls !== 'undefined' && Hls.isSupported();
+    const nativeHlsSupported = videoPlayer.canPlayType('application/vnd.apple.mpegurl') !== '';
+    
     // Show loading spinner
     loadingSpinner.classList.add('visible');
     
@@ -145,8 +149,112 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    // Attach an HLS master playlist; the player then switches bitrate between segments
+    function attachStream(manifestUrl) {
+        if (!hlsJsSupported) {
+            videoPlayer.src = manifestUrl;
+            videoPlayer.load();
+            return;
+        }
+        
+        const hls = new Hls({ capLevelToPlayerSize: true });
+        window.kronikStream = hls;  // used by quality-change.js for manual selection
+        
+        hls.on(Hls.Events.LEVEL_SWITCHED, function(event, info) {
+            const level = hls.levels[info.level];
+            if (level && currentQuality && hls.autoLevelEnabled) {
+                currentQuality.textContent = `авто (${level.height}p)`;
+            }
+        });
+        hls.on(Hls.Events.ERROR, function(event, info) {
+            if (!info.fatal) return;
+            console.error('Fatal streaming error, falling back to progressive video:', info.details);
+            hls.destroy();
+            window.kronikStream = null;
+            fetchVideoUrl(videoId, userId, 'auto', false);
+        });
+        
+        hls.loadSource(manifestUrl);
+        hls.attachMedia(videoPlayer);
+    }
+    
+    // ===== Seek bar previews =====
+    // Cues of the WebVTT thumbnails track: {start, end, url, x, y, w, h} regions of sprite sheets
+    let scrubCues = [];
+    let scrubPreviewsUrl = null;
+    const scrubPreview = document.createElement('div');
+    scrubPreview.className = 'scrub-preview';
+    scrubPreview.innerHTML = '<div class="scrub-preview-image"></div><span class="scrub-preview-time"></span>';
+    progressContainer.parentNode.insertBefore(scrubPreview, progressContainer);
+    const scrubPreviewImage = scrubPreview.querySelector('.scrub-preview-image');
+    const scrubPreviewTime = scrubPreview.querySelector('.scrub-preview-time');
+    
+    function parseVttTime(text) {
+        return text.trim().split(':').reduce((total, part) => total * 60 + parseFloat(part), 0);
+    }
+    
+    function parseThumbnailsTrack(text) {
+        const cues = [];
+        text.replace(/\r/g, '').split('\n\n').forEach(block => {
+            const lines = block.trim().split('\n');
+            const timing = lines.findIndex(line => line.includes('-->'));
+            if (timing === -1 || !lines[timing + 1]) return;
+            
+            const [start, end] = lines[timing].split('-->').map(parseVttTime);
+            const [url, region] = lines[timing + 1].split('#xywh=');
+            const [x, y, w, h] = (region || '').split(',').map(Number);
+            cues.push({ start, end, url, x, y, w, h });
+        });
+        return cues;
+    }
+    
+    function loadScrubPreviews(url) {
+        if (!url || url === scrubPreviewsUrl) return;
+        scrubPreviewsUrl = url;
+        
+        fetch(url)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`Server returned ${response.status}`);
+                }
+                return response.text();
+            })
+            .then(text => {
+                scrubCues = parseThumbnailsTrack(text);
+                // A few sprite sheets cover the whole video: load them once, hover only crops them
+                new Set(scrubCues.map(cue => cue.url)).forEach(sheetUrl => {
+                    new Image().src = sheetUrl;
+                });
+            })
+            .catch(error => {
+                console.error('Error loading seek bar previews:', error);
+                scrubPreviewsUrl = null;
+            });
+    }
+    
+    function showScrubPreview(e) {
+        if (!scrubCues.length || !videoPlayer.duration) return;
+        
+        const rect = progressContainer.getBoundingClientRect();
+        const position = Math.max(0, Math.min(1, (e.clientX - rect.left) / rect.width));
+        const time = position * videoPlayer.duration;
+        const cue = scrubCues.find(item => time >= item.start && time < item.end) || scrubCues[scrubCues.length - 1];
+        
+        scrubPreviewImage.style.width = `${cue.w}px`;
+        scrubPreviewImage.style.height = `${cue.h}px`;
+        scrubPreviewImage.style.backgroundImage = `url("${cue.url}")`;
+        scrubPreviewImage.style.backgroundPosition = `-${cue.x}px -${cue.y}px`;
+        scrubPreviewTime.textContent = formatTime(time);
+        
+        // Keep the preview inside the player
+        const parentRect = scrubPreview.parentNode.getBoundingClientRect();
+        const left = e.clientX - parentRect.left - cue.w / 2;
+        scrubPreview.style.left = `${Math.max(0, Math.min(parentRect.width - cue.w, left))}px`;
+        scrubPreview.classList.add('visible');
+    }
+    
     // Fetch video URL asynchronously with quality selection
-    function fetchVideoUrl(videoId, userId, quality = 'auto') {
+    function fetchVideoUrl(videoId, userId, quality = 'auto', allowStreaming = true) {
         // Error handling to make sure videoId and userId are valid
         if (!videoId || !userId) {
             console.error('Missing videoId or userId');
@@ -155,7 +263,10 @@ document.addEventListener('DOMContentLoaded', function() {
         }
         
         // Construct API URL with user_id parameter and quality
-        const apiUrl = `/api/get-video-url/${videoId}/?user_id=${encodeURIComponent(userId)}&quality=${quality}`;
+        let apiUrl = `/api/get-video-url/${videoId}/?user_id=${encodeURIComponent(userId)}&quality=${quality}`;
+        if (allowStreaming && quality === 'auto' && (hlsJsSupported || nativeHlsSupported)) {
+            apiUrl += '&manifest=hls';
+        }
         
         fetch(apiUrl)
             .then(response => {
@@ -172,10 +283,18 @@ document.addEventListener('DOMContentLoaded', function() {
                     
                     // Initialize quality selector
                     initializeQualityOptions(availableQualities);
+                    loadScrubPreviews(data.previews_url);
                     
                     // Update current quality display
                     if (currentQuality) {
-                        currentQuality.textContent = currentQualitySelection;
+                        currentQuality.textContent = currentQualitySelection === 'auto' ? 'авто' : currentQualitySelection;
+                    }
+                    
+                    // Videos packaged for streaming come as a manifest (older ones as MP4)
+                    if (data.manifest === 'hls') {
+                        attachStream(data.url);
+                        videoPlayer.setAttribute('preload', 'metadata');
+                        return;
                     }
                     
                     // Set video source and start loading
@@ -295,6 +414,12 @@ document.addEventListener('DOMContentLoaded', function() {
         videoPlayer.currentTime = position * videoPlayer.duration;
     });
     
+    // Seek bar hover previews
+    progressContainer.addEventListener('mousemove', showScrubPreview);
+    progressContainer.addEventListener('mouseleave', function() {
+        scrubPreview.classList.remove('visible');
+    });
+    
     // Volume bar click handler
     volumeBar.addEventListener('click', function(e) {
         const rect = volumeBar.getBoundingClientRect();
@@ -457,58 +582,119 @@ document.addEventListener('DOMContentLoaded', function() {
         showErrorMessage('Ошибка: Не найден идентификатор видео');
     }
     
-    // Track view after 5 seconds of playback
-    let viewTracked = false;
-    videoPlayer.addEventListener('timeupdate', function() {
-        if (!viewTracked && videoPlayer.currentTime > 5) {
-            viewTracked = true;
-            console.log('View tracked');
-            // In a real app, you would make an AJAX request to track the view
+    // ===== Batched player events =====
+    // Events are queued locally and flushed to /api/events/batch/ in one request
+    // (via navigator.sendBeacon when available) instead of one request per event.
+    const EVENTS_ENDPOINT = '/api/events/batch/';
+    const HEARTBEAT_INTERVAL = 15;      // seconds of playback between heartbeats
+    const FLUSH_INTERVAL = 60000;       // ms between periodic flushes
+    const MAX_QUEUED_EVENTS = 50;       // flush early when the queue grows this large
+    const VIEW_THRESHOLD = 3;           // seconds of playback before a view is counted
+    
+    let eventQueue = [];
+    let viewStarted = false;
+    let watchedSeconds = 0;
+    let lastHeartbeatAt = 0;
+    let lastTimeUpdate = null;
+    
+    // Reuse the session id shared with the rest of the video page
+    let playerSessionId = localStorage.getItem('session_id');
+    if (!playerSessionId) {
+        playerSessionId = 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, function(c) {
+            const r = Math.random() * 16 | 0, v = c === 'x' ? r : (r & 0x3 | 0x8);
+            return v.toString(16);
+        });
+        localStorage.setItem('session_id', playerSessionId);
+    }
+    
+    function queueEvent(type, payload = {}) {
+        eventQueue.push({
+            type: type,
+            position: Math.round((videoPlayer.currentTime || 0) * 10) / 10,
+            ts: Date.now(),
+            payload: payload
+        });
+        
+        if (eventQueue.length >= MAX_QUEUED_EVENTS) {
+            flushEvents();
         }
-    });
-
-    /**
-     * Функция для отслеживания просмотра видео
-     * Отправляет запрос на сервер для учёта просмотра
-     */
-    function trackVideoView(videoId, userId) {
-        console.log('Tracking view for video:', videoId, 'owner:', userId);
+    }
+    
+    function flushEvents() {
+        if (eventQueue.length === 0) return;
+        
+        const events = eventQueue;
+        eventQueue = [];
         
-        // Создаем форму для отправки данных
         const formData = new FormData();
-        formData.append('video_id', videoId);
-        if (userId) {
-            formData.append('user_id', userId);
-        }
+        formData.append('events', JSON.stringify(events));
+        formData.append('video_id', `${userId}__${videoId}`);
+        formData.append('session_id', playerSessionId);
         
-        // Получаем CSRF-токен для защиты от CSRF-атак
+        // sendBeacon cannot set headers, so the CSRF token travels in the body
         const csrfToken = document.querySelector('[name=csrfmiddlewaretoken]')?.value;
+        if (csrfToken) {
+            formData.append('csrfmiddlewaretoken', csrfToken);
+        }
         
-        // Отправляем запрос на сервер
-        fetch('/api/track-view/', {
+        if (navigator.sendBeacon && navigator.sendBeacon(EVENTS_ENDPOINT, formData)) {
+            return;
+        }
+        
+        // Fallback for browsers without sendBeacon or when the beacon queue is full
+        fetch(EVENTS_ENDPOINT, {
             method: 'POST',
-            headers: {
-                'X-CSRFToken': csrfToken
-            },
-            body: formData
-        })
-        .then(response => response.json())
-        .then(data => {
-            if (data.success) {
-                console.log('View tracked successfully, new count:', data.views);
-                
-                // Обновляем отображение просмотров на странице
-                const viewsInfo = document.querySelector('.views-info');
-                if (viewsInfo) {
-                    viewsInfo.textContent = data.views_formatted + ' • ' + 
-                        viewsInfo.textContent.split('•')[1].trim();
-                }
-            } else {
-                console.log('View not tracked:', data.reason || data.error);
-            }
-        })
-        .catch(error => {
-            console.error('Error tracking view:', error);
+            body: formData,
+            keepalive: true
+        }).catch(error => {
+            console.error('Error sending player events:', error);
         });
     }
+    
+    // Count watched time and emit view start / heartbeat events
+    videoPlayer.addEventListener('timeupdate', function() {
+        const now = videoPlayer.currentTime;
+        if (lastTimeUpdate !== null && !videoPlayer.paused && !videoPlayer.seeking) {
+            const delta = now - lastTimeUpdate;
+            // Ignore jumps caused by seeking
+            if (delta > 0 && delta < 2) {
+                watchedSeconds += delta;
+            }
+        }
+        lastTimeUpdate = now;
+        
+        if (!viewStarted && watchedSeconds >= VIEW_THRESHOLD) {
+            viewStarted = true;
+            queueEvent('view_start');
+            // View start is the most important event - send it right away
+            flushEvents();
+            lastHeartbeatAt = watchedSeconds;
+        }
+        
+        if (viewStarted && watchedSeconds - lastHeartbeatAt >= HEARTBEAT_INTERVAL) {
+            lastHeartbeatAt = watchedSeconds;
+            queueEvent('heartbeat');
+        }
+    });
+    
+    videoPlayer.addEventListener('seeking', function() {
+        queueEvent('seek', { from: lastTimeUpdate || 0, to: videoPlayer.currentTime });
+        lastTimeUpdate = videoPlayer.currentTime;
+    });
+    
+    // Dispatched by quality-change.js after a quality switch
+    videoPlayer.addEventListener('kronik:qualitychange', function(e) {
+        queueEvent('quality_change', e.detail || {});
+    });
+    
+    // Periodic flush while the page is open
+    setInterval(flushEvents, FLUSH_INTERVAL);
+    
+    // Flush when the page is hidden or unloaded
+    document.addEventListener('visibilitychange', function() {
+        if (document.visibilityState === 'hidden') {
+            flushEvents();
+        }
+    });
+    window.addEventListener('pagehide', flushEvents);
 });
\ No newline at end of file
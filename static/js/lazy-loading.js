@@ -16,8 +16,9 @@ function setupLazyLoadingObserver() {
                 const img = entry.target;
                 const src = img.getAttribute('data-src');
                 if (src) {
-                    img.src = src;
+                    applyThumbnailSource(img, src, img.getAttribute('data-srcset'));
                     img.removeAttribute('data-src');
+                    img.removeAttribute('data-srcset');
                     observer.unobserve(img);
                 }
             }
@@ -51,8 +52,9 @@ function throttledLazyLoad() {
             if (rect.top <= windowHeight + 300) {
                 const src = img.getAttribute('data-src');
                 if (src) {
-                    img.src = src;
+                    applyThumbnailSource(img, src, img.getAttribute('data-srcset'));
                     img.removeAttribute('data-src');
+                    img.removeAttribute('data-srcset');
                     img.classList.remove('lazy-load-thumbnail');
                 }
             }
@@ -68,7 +70,7 @@ function loadThumbnailUrl(cardElement, userId, videoId) {
     // Проверяем, есть ли уже URL в кэше браузера
     const cachedUrl = sessionStorage.getItem(`thumbnail_${requestId}`);
     if (cachedUrl) {
-        updateThumbnail(cardElement, cachedUrl);
+        updateThumbnail(cardElement, cachedUrl, sessionStorage.getItem(`thumbnail_srcset_${requestId}`));
         return;
     }
     
@@ -79,9 +81,10 @@ function loadThumbnailUrl(cardElement, userId, videoId) {
             if (data.success && data.url) {
                 // Сохраняем URL в кэше браузера
                 sessionStorage.setItem(`thumbnail_${requestId}`, data.url);
+                sessionStorage.setItem(`thumbnail_srcset_${requestId}`, data.srcset || '');
                 
                 // Обновляем изображение
-                updateThumbnail(cardElement, data.url);
+                updateThumbnail(cardElement, data.url, data.srcset);
             }
         })
         .catch(error => {
@@ -90,17 +93,29 @@ function loadThumbnailUrl(cardElement, userId, videoId) {
 }
 
 // Обновление изображения миниатюры
-function updateThumbnail(cardElement, url) {
+function updateThumbnail(cardElement, url, srcset) {
     const img = cardElement.querySelector('img');
     if (img) {
         if (img.classList.contains('lazy-load-thumbnail')) {
             img.setAttribute('data-src', url);
+            if (srcset) {
+                img.setAttribute('data-srcset', srcset);
+            }
         } else {
-            img.src = url;
+            applyThumbnailSource(img, url, srcset);
         }
     }
 }
 
+// JPEG как src и WebP-версии разной ширины, если у миниатюры есть производные
+function applyThumbnailSource(img, url, srcset) {
+    if (srcset) {
+        img.sizes = '(max-width: 600px) 100vw, 360px';
+        img.srcset = srcset;
+    }
+    img.src = url;
+}
+
 // Очистка кэша миниатюр при закрытии вкладки (опционально)
 window.addEventListener('beforeunload', () => {
     // Очищаем кэш миниатюр из sessionStorage
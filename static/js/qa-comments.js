@@ -20,6 +20,10 @@ document.addEventListener('DOMContentLoaded', function() {
     // Check if user is authenticated
     const isAuthenticated = qaSubmit ? !qaSubmit.disabled : false;
     
+    // Composite ID (user_id__video_id) used by the comments API
+    const apiVideoId = videoUserId ? `${videoUserId}__${videoId}` : videoId;
+    const loadMoreBtn = document.getElementById('qa-load-more');
+    
     // Initialize the comment system
     initQASystem();
     
@@ -36,91 +40,182 @@ document.addEventListener('DOMContentLoaded', function() {
         } else {
             // Set up comment submission
             setupCommentSubmission();
-            // Set up like buttons
-            setupLikeButtons();
         }
         
         // Set up event delegation for reply buttons
         setupReplyButtonDelegation();
-        // Apply event handlers to existing comments
+        // Apply event handlers (replies, likes) to existing comments
         setupExistingComments();
         // Set up show/hide replies functionality
         setupShowHideReplies();
+        // Load further pages of comments on scroll
+        setupCommentPagination();
+        // Receive new comments, replies and like counts from the server
+        setupLiveUpdates();
     }
 
     /**
      * Set up show/hide replies functionality
+     * Reply threads are loaded from the API the first time they are expanded
      */
     function setupShowHideReplies() {
-        console.log("Setting up show/hide replies functionality");
+        qaList.addEventListener('click', function(e) {
+            const loadMoreRepliesBtn = e.target.closest('.load-more-replies');
+            if (loadMoreRepliesBtn) {
+                const commentElement = loadMoreRepliesBtn.closest('.qa-item');
+                loadReplies(commentElement.getAttribute('data-comment-id'), loadMoreRepliesBtn.parentElement, loadMoreRepliesBtn.getAttribute('data-cursor'));
+                return;
+            }
+            
+            const btn = e.target.closest('.show-replies-btn');
+            if (!btn) return;
+            
+            // Replies container is the next element after the button
+            const repliesContainer = btn.nextElementSibling;
+            if (!repliesContainer || !repliesContainer.classList.contains('qa-replies')) {
+                console.error("Could not find replies container after button");
+                return;
+            }
+            
+            if (btn.getAttribute('data-shown') === 'true') {
+                // Hide replies
+                repliesContainer.style.display = 'none';
+                btn.innerHTML = `Показать ответы (${getReplyCount(btn, repliesContainer)})`;
+                btn.setAttribute('data-shown', 'false');
+            } else {
+                // Show replies
+                repliesContainer.style.display = 'block';
+                btn.innerHTML = 'Скрыть ответы';
+                btn.setAttribute('data-shown', 'true');
+                
+                if (repliesContainer.getAttribute('data-loaded') === 'false') {
+                    const commentId = btn.closest('.qa-item').getAttribute('data-comment-id');
+                    loadReplies(commentId, repliesContainer);
+                }
+            }
+        });
+    }
+    
+    /**
+     * Number of replies in a thread, including ones that are not loaded yet
+     */
+    function getReplyCount(btn, repliesContainer) {
+        const loaded = repliesContainer.querySelectorAll('.qa-reply').length;
+        return Math.max(parseInt(btn.getAttribute('data-reply-count')) || 0, loaded);
+    }
+    
+    /**
+     * Load a page of replies for a comment into its replies container
+     */
+    function loadReplies(commentId, repliesContainer, cursor = null) {
+        if (repliesContainer.getAttribute('data-loaded') === 'loading') return;
+        repliesContainer.setAttribute('data-loaded', 'loading');
         
-        // Find all show replies buttons
-        const showRepliesBtns = document.querySelectorAll('.show-replies-btn');
-        console.log(`Found ${showRepliesBtns.length} show/hide buttons`);
+        let url = `/api/comments/${encodeURIComponent(apiVideoId)}/?comment_id=${encodeURIComponent(commentId)}`;
+        if (cursor) {
+            url += `&cursor=${encodeURIComponent(cursor)}`;
+        }
         
-        // Add click handlers to each button
-        showRepliesBtns.forEach(btn => {
-            btn.addEventListener('click', function() {
-                // Get the current state
-                const isShown = this.getAttribute('data-shown') === 'true';
+        fetch(url)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.error || 'Failed to load replies');
+                }
                 
-                // Find the related replies container
-                // It's the next element if it has the qa-replies class
-                const repliesContainer = this.nextElementSibling;
+                // The first page replaces replies added locally - they are part of the stored thread
+                if (!cursor) {
+                    repliesContainer.innerHTML = '';
+                }
+                const loadMoreRepliesBtn = repliesContainer.querySelector('.load-more-replies');
+                if (loadMoreRepliesBtn) {
+                    loadMoreRepliesBtn.remove();
+                }
                 
-                if (repliesContainer && repliesContainer.classList.contains('qa-replies')) {
-                    const replyCount = repliesContainer.querySelectorAll('.qa-reply').length;
-                    
-                    if (isShown) {
-                        // Hide replies
-                        repliesContainer.style.display = 'none';
-                        this.innerHTML = `Показать ответы (${replyCount})`;
-                        this.setAttribute('data-shown', 'false');
-                    } else {
-                        // Show replies
-                        repliesContainer.style.display = 'block';
-                        this.innerHTML = 'Скрыть ответы';
-                        this.setAttribute('data-shown', 'true');
-                    }
-                } else {
-                    console.error("Could not find replies container after button");
+                data.replies.forEach(reply => {
+                    if (repliesContainer.querySelector(`.qa-reply[data-reply-id="${reply.id}"]`)) return;
+                    reply.parentCommentId = commentId;
+                    const replyElement = createReplyElement(reply);
+                    repliesContainer.appendChild(replyElement);
+                    setupCommentLikes(replyElement);
+                });
+                
+                if (data.next_cursor) {
+                    const moreBtn = document.createElement('button');
+                    moreBtn.className = 'load-more-replies';
+                    moreBtn.setAttribute('data-cursor', data.next_cursor);
+                    moreBtn.textContent = 'Показать ещё ответы';
+                    repliesContainer.appendChild(moreBtn);
                 }
+                
+                repliesContainer.setAttribute('data-loaded', 'true');
+            })
+            .catch(error => {
+                console.error('Error loading replies:', error);
+                // Allow another attempt on the next click
+                repliesContainer.setAttribute('data-loaded', cursor ? 'true' : 'false');
             });
+    }
+    
+    /**
+     * Set up loading of further comment pages when the end of the list is reached
+     */
+    function setupCommentPagination() {
+        if (!loadMoreBtn || !qaList) return;
+        
+        loadMoreBtn.addEventListener('click', function(e) {
+            e.preventDefault();
+            loadMoreComments();
         });
         
-        // Also set up event delegation for dynamically added buttons
-        document.addEventListener('click', function(e) {
-            const btn = e.target.closest('.show-replies-btn');
-            if (!btn) return; // Not a show replies button
-            
-            // Prevent handling if the button already has a direct event handler
-            if (btn.getAttribute('data-has-handler') === 'true') return;
-            
-            // Mark this button as handled via delegation
-            btn.setAttribute('data-has-handler', 'true');
-            
-            // Get current state
-            const isShown = btn.getAttribute('data-shown') === 'true';
-            
-            // Find replies container (should be the next element)
-            const repliesContainer = btn.nextElementSibling;
-            
-            if (repliesContainer && repliesContainer.classList.contains('qa-replies')) {
-                const replyCount = repliesContainer.querySelectorAll('.qa-reply').length;
-                
-                if (isShown) {
-                    // Hide replies
-                    repliesContainer.style.display = 'none';
-                    btn.innerHTML = `Показать ответы (${replyCount})`;
-                    btn.setAttribute('data-shown', 'false');
-                } else {
-                    // Show replies
-                    repliesContainer.style.display = 'block';
-                    btn.innerHTML = 'Скрыть ответы';
-                    btn.setAttribute('data-shown', 'true');
+        if ('IntersectionObserver' in window) {
+            const observer = new IntersectionObserver(entries => {
+                if (entries.some(entry => entry.isIntersecting)) {
+                    loadMoreComments();
                 }
-            }
-        });
+            }, { rootMargin: '400px 0px' });
+            observer.observe(loadMoreBtn);
+        }
+    }
+    
+    let commentsLoading = false;
+    
+    /**
+     * Fetch the next page of comments using the cursor stored on the list
+     */
+    function loadMoreComments() {
+        const cursor = qaList.getAttribute('data-next-cursor');
+        if (!cursor || commentsLoading) return;
+        commentsLoading = true;
+        
+        const order = qaList.getAttribute('data-order') || 'newest';
+        loadMoreBtn.textContent = 'Загрузка...';
+        
+        fetch(`/api/comments/${encodeURIComponent(apiVideoId)}/?order=${order}&cursor=${encodeURIComponent(cursor)}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.error || 'Failed to load comments');
+                }
+                
+                data.comments.forEach(comment => {
+                    // Skip comments that were added locally after the page was rendered
+                    if (qaList.querySelector(`.qa-item[data-comment-id="${comment.id}"]`)) return;
+                    const commentElement = createCommentElement(comment);
+                    qaList.appendChild(commentElement);
+                    setupCommentElement(commentElement);
+                });
+                
+                qaList.setAttribute('data-next-cursor', data.next_cursor || '');
+                loadMoreBtn.style.display = data.next_cursor ? '' : 'none';
+            })
+            .catch(error => {
+                console.error('Error loading comments:', error);
+            })
+            .finally(() => {
+                commentsLoading = false;
+                loadMoreBtn.textContent = 'Показать ещё';
+            });
     }
 
     function setupReplyButtonDelegation() {
@@ -157,29 +252,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     replyInput.selectionStart = replyInput.selectionEnd = replyInput.value.length;
                 }
             }
-            
-            // Handle show/hide replies buttons created dynamically
-            const showRepliesBtn = e.target.closest('.show-replies-btn');
-            if (showRepliesBtn) {
-                const isShown = showRepliesBtn.getAttribute('data-shown') === 'true';
-                const repliesSection = showRepliesBtn.nextElementSibling;
-                
-                if (repliesSection && repliesSection.classList.contains('qa-replies')) {
-                    const replyCount = repliesSection.querySelectorAll('.qa-reply').length;
-                    
-                    if (isShown) {
-                        // Hide replies
-                        repliesSection.style.display = 'none';
-                        showRepliesBtn.innerHTML = `Показать ответы (${replyCount})`;
-                        showRepliesBtn.setAttribute('data-shown', 'false');
-                    } else {
-                        // Show replies
-                        repliesSection.style.display = 'block';
-                        showRepliesBtn.innerHTML = 'Скрыть ответы';
-                        showRepliesBtn.setAttribute('data-shown', 'true');
-                    }
-                }
-            }
+
         });
     }
     
@@ -192,46 +265,53 @@ document.addEventListener('DOMContentLoaded', function() {
         console.log(`Found ${existingComments.length} existing comments`);
         
         existingComments.forEach(comment => {
-            const commentId = comment.getAttribute('data-comment-id');
-            console.log(`Setting up comment ID: ${commentId}`);
-            
-            // Set up cancel buttons
-            const cancelBtn = comment.querySelector('.cancel-reply');
-            if (cancelBtn) {
-                cancelBtn.addEventListener('click', function(e) {
-                    e.preventDefault();
-                    hideReplyForm(commentId);
-                });
-            }
+            setupCommentElement(comment);
+        });
+    }
+    
+    /**
+     * Setup event handlers for a single comment element
+     * Reply and show/hide buttons are handled by delegation on the list
+     */
+    function setupCommentElement(comment) {
+        const commentId = comment.getAttribute('data-comment-id');
+        
+        // Set up cancel buttons
+        const cancelBtn = comment.querySelector('.cancel-reply');
+        if (cancelBtn) {
+            cancelBtn.addEventListener('click', function(e) {
+                e.preventDefault();
+                hideReplyForm(commentId);
+            });
+        }
+        
+        // Set up reply submission
+        const replySubmitBtn = comment.querySelector('.reply-submit');
+        if (replySubmitBtn && isAuthenticated) {
+            replySubmitBtn.addEventListener('click', function(e) {
+                e.preventDefault();
+                submitReply(commentId);
+            });
             
-            // Set up reply submission
-            const replySubmitBtn = comment.querySelector('.reply-submit');
-            if (replySubmitBtn && isAuthenticated) {
-                replySubmitBtn.addEventListener('click', function(e) {
-                    e.preventDefault();
-                    submitReply(commentId);
+            // Also allow submit on Enter key
+            const replyInput = comment.querySelector(`#reply-input-${commentId}`);
+            if (replyInput) {
+                replyInput.addEventListener('keypress', function(e) {
+                    if (e.key === 'Enter') {
+                        e.preventDefault();
+                        submitReply(commentId);
+                    }
                 });
-                
-                // Also allow submit on Enter key
-                const replyInput = comment.querySelector(`#reply-input-${commentId}`);
-                if (replyInput) {
-                    replyInput.addEventListener('keypress', function(e) {
-                        if (e.key === 'Enter') {
-                            e.preventDefault();
-                            submitReply(commentId);
-                        }
-                    });
-                }
             }
-            
-            // Set up like buttons
-            setupCommentLikes(comment);
-            
-            // Set up reply-to-reply buttons for existing replies
-            const replies = comment.querySelectorAll('.qa-reply');
-            replies.forEach(reply => {
-                setupReplyToReplyButtons(reply);
-            });
+        }
+        
+        // Set up like buttons
+        setupCommentLikes(comment);
+        
+        // Set up reply-to-reply buttons for existing replies
+        const replies = comment.querySelectorAll('.qa-reply');
+        replies.forEach(reply => {
+            setupReplyToReplyButtons(reply);
         });
     }
     
@@ -403,10 +483,65 @@ document.addEventListener('DOMContentLoaded', function() {
         addNewComment(mockComment);
     }
     
+    /**
+     * Subscribe to the Server-Sent Events stream of this video
+     */
+    function setupLiveUpdates() {
+        if (!window.EventSource || !videoId) return;
+        
+        const source = new EventSource(`/api/comments/${encodeURIComponent(apiVideoId)}/stream/`);
+        
+        source.addEventListener('comment', function(e) {
+            addNewComment(JSON.parse(e.data));
+        });
+        
+        source.addEventListener('reply', function(e) {
+            const data = JSON.parse(e.data);
+            const commentElement = qaList.querySelector(`.qa-item[data-comment-id="${data.comment_id}"]`);
+            if (!commentElement) return;
+            
+            const repliesContainer = commentElement.querySelector('.qa-replies');
+            if (repliesContainer && repliesContainer.getAttribute('data-loaded') === 'false') {
+                // Thread is not loaded yet - only bump the counter, the reply comes with the thread
+                const showRepliesBtn = commentElement.querySelector('.show-replies-btn');
+                const count = getReplyCount(showRepliesBtn, repliesContainer) + 1;
+                showRepliesBtn.setAttribute('data-reply-count', count);
+                if (showRepliesBtn.getAttribute('data-shown') !== 'true') {
+                    showRepliesBtn.innerHTML = `Показать ответы (${count})`;
+                }
+                return;
+            }
+            addReplyToComment(data.comment_id, data.reply);
+        });
+        
+        source.addEventListener('likes', function(e) {
+            const data = JSON.parse(e.data);
+            const likeCount = document.getElementById('likeCount');
+            const dislikeCount = document.getElementById('dislikeCount');
+            if (likeCount) likeCount.textContent = data.likes;
+            if (dislikeCount) dislikeCount.textContent = data.dislikes;
+        });
+        
+        // The server dropped events for this client - reload the newest comments
+        source.addEventListener('resync', function() {
+            fetch(`/api/comments/${encodeURIComponent(apiVideoId)}/`)
+                .then(response => response.json())
+                .then(data => {
+                    if (data.success) {
+                        data.comments.slice().reverse().forEach(comment => addNewComment(comment));
+                    }
+                })
+                .catch(error => console.error('Error resyncing comments:', error));
+        });
+    }
+    
     /**
      * Add a new comment to the DOM
      */
     function addNewComment(comment) {
+        // The same comment may arrive both from the POST response and the live stream
+        if (qaList.querySelector(`.qa-item[data-comment-id="${comment.id}"]`)) return;
+        
         // Create the comment element
         const commentElement = createCommentElement(comment);
         
@@ -420,11 +555,11 @@ document.addEventListener('DOMContentLoaded', function() {
         qaList.prepend(commentElement);
         
         // Set up event handlers for the new comment
-        setupCommentHandlers(commentElement, comment.id);
+        setupCommentElement(commentElement);
     }
     
     /**
-     * Create a DOM element for a comment
+     * Create a DOM element for a comment (same markup as the server-rendered list)
      */
     function createCommentElement(comment) {
         const isAuthor = comment.user_id === videoUserId;
@@ -432,66 +567,54 @@ document.addEventListener('DOMContentLoaded', function() {
         const div = document.createElement('div');
         div.className = 'qa-item';
         div.setAttribute('data-comment-id', comment.id);
+        div.setAttribute('data-user-id', comment.user_id);
         
-        const displayName = comment.display_name || 'User';
-        const firstLetter = displayName.charAt(0);
-        
-        // Format date in a user-friendly way
-        const date = new Date(comment.date);
-        const formattedDate = formatDate(date);
+        const displayName = escapeHtml(comment.display_name || comment.user_id || 'User');
+        const username = escapeHtml(comment.user_id || '');
+        const formattedDate = formatDate(new Date(comment.date));
+        const replyCount = comment.reply_count || 0;
         
         // Determine avatar content - either image or first letter
         let avatarContent = '';
         if (comment.avatar_url) {
-            avatarContent = `<img src="${comment.avatar_url}" alt="${displayName}">`;
+            avatarContent = `<img src="${escapeHtml(comment.avatar_url)}" alt="${displayName}" loading="lazy">`;
         } else {
-            avatarContent = firstLetter;
+            avatarContent = `<span class="avatar-text">${escapeHtml((comment.display_name || comment.user_id || 'U').charAt(0))}</span>`;
         }
         
-        // Get current user initial for reply form
-        const currentUserInitial = getCurrentUserInitial();
-        // Get current user avatar for reply form
-        const currentUserAvatar = getCurrentUserAvatar();
+        // Current user avatar for the reply form
+        const formAvatar = qaForm ? qaForm.querySelector('.avatar') : null;
+        const currentUserAvatar = formAvatar ? formAvatar.innerHTML : '';
+        const disabled = isAuthenticated ? '' : 'disabled';
         
         div.innerHTML = `
-            <div class="user-avatar ${isAuthor ? 'author-avatar' : ''}">
-                ${avatarContent}
-            </div>
-            <div class="qa-content">
-                <div class="qa-author ${isAuthor ? 'is-author' : ''}">
-                    ${displayName}
-                    ${isAuthor ? '<span class="author-badge">Автор</span>' : ''}
-                </div>
-                <div class="qa-text">${replyText}</div>
-                <div class="qa-meta">${formattedDate}</div>
-                <div class="qa-actions">
-                    <button class="qa-like" data-liked="false">👍 <span>${reply.likes || 0}</span></button>
-                    <button class="qa-reply-to-reply-btn" data-username="${displayName}">Ответить</button>
-                </div>
-            </div>
+            <div class="avatar ${isAuthor ? 'author-avatar' : ''}">
                 ${avatarContent}
             </div>
             <div class="qa-content">
-                <div class="qa-author ${isAuthor ? 'is-author' : ''}">
+                <div class="qa-author ${isAuthor ? 'is-author' : ''}" data-username="${username}">
                     ${displayName}
                     ${isAuthor ? '<span class="author-badge">Автор</span>' : ''}
                 </div>
-                <div class="qa-text">${comment.text}</div>
+                <div class="qa-text">${escapeHtml(comment.text || '')}</div>
                 <div class="qa-meta">${formattedDate}</div>
                 <div class="qa-actions">
-                    <button class="qa-like" data-liked="false">👍 <span>${comment.likes || 0}</span></button>
+                    <button class="qa-like" data-liked="false"><img src="/static/icons/like.svg" alt="Like" width="20" height="20"> <span>${comment.likes || 0}</span></button>
                     <button class="qa-reply-btn" data-comment-id="${comment.id}">Ответить</button>
                 </div>
                 
                 <!-- Reply form (initially hidden) -->
                 <div class="reply-form" id="reply-form-${comment.id}" style="display: none;">
-                    <div class="user-avatar">${currentUserAvatar}</div>
-                    <input type="text" id="reply-input-${comment.id}" placeholder="Ответить на вопрос...">
-                    <button class="reply-submit" data-comment-id="${comment.id}">Ответить</button>
+                    <div class="avatar">${currentUserAvatar}</div>
+                    <input type="text" id="reply-input-${comment.id}" placeholder="${isAuthenticated ? 'Ответить на вопрос...' : 'Войдите, чтобы ответить'}" ${disabled}>
+                    <button class="reply-submit" data-comment-id="${comment.id}" ${disabled}>Ответить</button>
                     <button class="cancel-reply" data-comment-id="${comment.id}">Отмена</button>
                 </div>
                 
-                <div class="qa-replies"></div>
+                ${replyCount ? `
+                <button class="show-replies-btn" data-shown="false" data-reply-count="${replyCount}">Показать ответы (${replyCount})</button>
+                <div class="qa-replies" data-loaded="false" style="display: none;"></div>
+                ` : '<div class="qa-replies"></div>'}
             </div>
         `;
         
@@ -499,50 +622,22 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     /**
-     * Set up event handlers for a comment element
+     * Escape user supplied text before inserting it into HTML
      */
-    function setupCommentHandlers(commentElement, commentId) {
-        // Set up reply button
-        const replyBtn = commentElement.querySelector('.qa-reply-btn');
-        if (replyBtn) {
-            replyBtn.addEventListener('click', function(e) {
-                e.preventDefault();
-                console.log(`Reply button clicked for comment ${commentId}`);
-                toggleReplyForm(commentId);
-            });
-        }
-        
-        // Set up cancel button
-        const cancelBtn = commentElement.querySelector('.cancel-reply');
-        if (cancelBtn) {
-            cancelBtn.addEventListener('click', function(e) {
-                e.preventDefault();
-                hideReplyForm(commentId);
-            });
-        }
-        
-        // Set up reply submission
-        const replySubmitBtn = commentElement.querySelector('.reply-submit');
-        if (replySubmitBtn) {
-            replySubmitBtn.addEventListener('click', function(e) {
-                e.preventDefault();
-                submitReply(commentId);
-            });
-            
-            // Also allow submit on Enter key
-            const replyInput = commentElement.querySelector(`#reply-input-${commentId}`);
-            if (replyInput) {
-                replyInput.addEventListener('keypress', function(e) {
-                    if (e.key === 'Enter') {
-                        e.preventDefault();
-                        submitReply(commentId);
-                    }
-                });
-            }
-        }
-        
-        // Set up like button
-        setupCommentLikes(commentElement);
+    function escapeHtml(text) {
+        const div = document.createElement('div');
+        div.textContent = text;
+        return div.innerHTML.replace(/"/g, '&quot;');
+    }
+    
+    /**
+     * Format a date as dd.mm.yyyy (same as the server-rendered list)
+     */
+    function formatDate(date) {
+        if (isNaN(date.getTime())) return '';
+        const day = String(date.getDate()).padStart(2, '0');
+        const month = String(date.getMonth() + 1).padStart(2, '0');
+        return `${day}.${month}.${date.getFullYear()}`;
     }
     
     /**
@@ -775,6 +870,9 @@ document.addEventListener('DOMContentLoaded', function() {
         const commentElement = document.querySelector(`.qa-item[data-comment-id="${commentId}"]`);
         if (!commentElement) return;
         
+        // The same reply may arrive both from the POST response and the live stream
+        if (commentElement.querySelector(`.qa-reply[data-reply-id="${reply.id}"]`)) return;
+        
         // Find or create the replies container
         let repliesContainer = commentElement.querySelector('.qa-replies');
         if (!repliesContainer) {
@@ -794,6 +892,8 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // If replies were previously hidden, show them now for the new reply
         if (showRepliesBtn) {
+            showRepliesBtn.setAttribute('data-reply-count', getReplyCount(showRepliesBtn, repliesContainer) + 1);
+            
             // Show replies container
             repliesContainer.style.display = 'block';
             
@@ -907,9 +1007,9 @@ document.addEventListener('DOMContentLoaded', function() {
         div.setAttribute('data-reply-id', reply.id);
         div.setAttribute('data-user-id', reply.user_id);
         
-        const displayName = reply.display_name || reply.user_id || 'User';
-        const username = reply.user_id || 'user';
-        const firstLetter = displayName.charAt(0).toUpperCase();
+        const displayName = escapeHtml(reply.display_name || reply.user_id || 'User');
+        const username = escapeHtml(reply.user_id || 'user');
+        const firstLetter = escapeHtml((reply.display_name || reply.user_id || 'User').charAt(0).toUpperCase());
         
         // Format date
         const date = new Date(reply.date);
@@ -918,13 +1018,13 @@ document.addEventListener('DOMContentLoaded', function() {
         // Determine avatar content - either image or first letter
         let avatarContent = '';
         if (reply.avatar_url) {
-            avatarContent = `<img src="${reply.avatar_url}" alt="${displayName}" loading="lazy">`;
+            avatarContent = `<img src="${escapeHtml(reply.avatar_url)}" alt="${displayName}" loading="lazy">`;
         } else {
             avatarContent = `<span class="avatar-text">${firstLetter}</span>`;
         }
         
         // Process text to handle @username replies
-        let replyText = reply.text;
+        let replyText = escapeHtml(reply.text || '');
         if (replyText.startsWith('@')) {
             const parts = replyText.split(' ');
             if (parts.length > 0 && parts[0].startsWith('@')) {
@@ -953,23 +1053,6 @@ document.addEventListener('DOMContentLoaded', function() {
             </div>
         `;
         
-        // Try to load avatar dynamically if not provided
-        if (!reply.avatar_url && reply.user_id) {
-            setTimeout(() => {
-                fetch(`/api/get-user-profile/?user_id=${encodeURIComponent(reply.user_id)}`)
-                    .then(response => response.json())
-                    .then(data => {
-                        if (data.success && data.profile && data.profile.avatar_url) {
-                            const avatarContainer = div.querySelector('.avatar');
-                            if (avatarContainer) {
-                                avatarContainer.innerHTML = `<img src="${data.profile.avatar_url}" alt="${displayName}" loading="lazy">`;
-                            }
-                        }
-                    })
-                    .catch(err => console.error('Error loading avatar for reply:', err));
-            }, 200);
-        }
-        
         return div;
     }
 });
\ No newline at end of file
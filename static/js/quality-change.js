@@ -29,6 +29,29 @@ function hideQualityChangeOverlay() {
     }
 }
 
+// Function to switch the level of an adaptive (hls.js) stream in place
+function switchStreamLevel(hls, quality) {
+    const videoPlayer = document.getElementById('video-player');
+    const levelIndex = quality === 'auto' ? -1 : hls.levels.findIndex(level => `${level.height}p` === quality);
+    if (quality !== 'auto' && levelIndex === -1) return;
+    
+    const currentQualityDisplay = document.getElementById('current-quality');
+    const previousQuality = currentQualityDisplay ? currentQualityDisplay.textContent : null;
+    
+    // nextLevel переключает со следующего сегмента: без паузы и перезагрузки источника
+    hls.nextLevel = levelIndex;
+    
+    if (currentQualityDisplay) {
+        currentQualityDisplay.textContent = quality === 'auto' ? 'авто' : quality;
+    }
+    document.querySelectorAll('.quality-option').forEach(option => {
+        option.classList.toggle('active', option.getAttribute('data-quality') === quality);
+    });
+    videoPlayer.dispatchEvent(new CustomEvent('kronik:qualitychange', {
+        detail: { from: previousQuality, to: quality }
+    }));
+}
+
 // Function to change video quality
 function changeVideoQuality(quality) {
     const videoPlayer = document.getElementById('video-player');
@@ -36,6 +59,12 @@ function changeVideoQuality(quality) {
     
     if (!videoPlayer || !videoContainer) return;
     
+    // Adaptive stream: no source swap, playback continues from the buffer
+    if (window.kronikStream) {
+        switchStreamLevel(window.kronikStream, quality);
+        return;
+    }
+    
     // Get video ID and user ID
     const videoId = videoContainer.getAttribute('data-video-id');
     const userId = videoContainer.getAttribute('data-user-id');
@@ -59,9 +88,15 @@ function changeVideoQuality(quality) {
             if (data.success && data.url) {
                 // Update current quality display
                 const currentQualityDisplay = document.getElementById('current-quality');
+                const previousQuality = currentQualityDisplay ? currentQualityDisplay.textContent : null;
                 if (currentQualityDisplay) {
                     currentQualityDisplay.textContent = data.quality;
                 }
+
+                // Let the player queue a quality_change event for the batched beacon
+                videoPlayer.dispatchEvent(new CustomEvent('kronik:qualitychange', {
+                    detail: { from: previousQuality, to: data.quality }
+                }));
                 
                 // Update active class on quality options
                 const qualityOptions = document.querySelectorAll('.quality-option');
@@ -150,6 +185,9 @@ async function initializeQualityOptions(availableQualities) {
     
     // Добавляем опцию auto обратно
     qualityOptions.appendChild(autoQualityOption);
+    autoQualityOption.onclick = function() {
+        changeVideoQuality('auto');
+    };
     
     // Сортируем качества в порядке уменьшения (вначале самое высокое качество)
     const sortedQualities = [...availableQualities].sort((a, b) => {
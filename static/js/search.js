@@ -491,6 +491,15 @@ function appendSearchResults(videos) {
 /**
  * Инициализация отложенной загрузки миниатюр
  */
+// JPEG как src и WebP-версии разной ширины, если у миниатюры есть производные
+function setThumbnailSource(img, url, srcset) {
+    if (srcset) {
+        img.sizes = '(max-width: 768px) 100vw, 246px';
+        img.srcset = srcset;
+    }
+    img.src = url;
+}
+
 function initializeLazyLoading() {
     if ('IntersectionObserver' in window) {
         const imageObserver = new IntersectionObserver((entries) => {
@@ -505,7 +514,7 @@ function initializeLazyLoading() {
                         const cachedUrl = sessionStorage.getItem(`thumbnail_${userId}__${videoId}`);
                         
                         if (cachedUrl) {
-                            img.src = cachedUrl;
+                            setThumbnailSource(img, cachedUrl, sessionStorage.getItem(`thumbnail_srcset_${userId}__${videoId}`));
                             img.classList.remove('lazy-thumbnail', 'loading');
                             imageObserver.unobserve(img);
                         } else {
@@ -519,9 +528,10 @@ function initializeLazyLoading() {
                                     if (data.success && data.url) {
                                         // Кэшируем URL
                                         sessionStorage.setItem(`thumbnail_${userId}__${videoId}`, data.url);
+                                        sessionStorage.setItem(`thumbnail_srcset_${userId}__${videoId}`, data.srcset || '');
                                         
                                         // Устанавливаем источник изображения
-                                        img.src = data.url;
+                                        setThumbnailSource(img, data.url, data.srcset);
                                         img.classList.remove('lazy-thumbnail', 'loading');
                                         
                                         // Прекращаем наблюдение
@@ -0,0 +1,61 @@
+/**
+ * Batched user profile loading
+ *
+ * loadUserProfile(userId) resolves to {user_id, display_name, avatar_url,
+ * subscriber_count} or null. Calls made during the same tick are merged into
+ * one /api/user-profiles/ request, and results are kept for the page lifetime,
+ * so a grid of avatars costs a single round trip.
+ */
+(function() {
+    const MAX_IDS_PER_REQUEST = 100;
+    const profileCache = new Map();   // userId -> Promise
+    let pending = new Map();          // userId -> {resolve}
+    let flushScheduled = false;
+
+    function flushProfileRequests() {
+        const batch = pending;
+        pending = new Map();
+        flushScheduled = false;
+
+        const userIds = Array.from(batch.keys());
+        for (let i = 0; i < userIds.length; i += MAX_IDS_PER_REQUEST) {
+            const chunk = userIds.slice(i, i + MAX_IDS_PER_REQUEST);
+            const ids = chunk.map(encodeURIComponent).join(',');
+
+            fetch(`/api/user-profiles/?ids=${ids}`)
+                .then(response => response.json())
+                .then(data => {
+                    const profiles = (data.success && data.profiles) || {};
+                    chunk.forEach(userId => batch.get(userId).resolve(profiles[userId] || null));
+                })
+                .catch(error => {
+                    console.error('Error loading user profiles:', error);
+                    chunk.forEach(userId => {
+                        // Allow a retry on the next call
+                        profileCache.delete(userId);
+                        batch.get(userId).resolve(null);
+                    });
+                });
+        }
+    }
+
+    window.loadUserProfile = function(userId) {
+        if (!userId) {
+            return Promise.resolve(null);
+        }
+        if (profileCache.has(userId)) {
+            return profileCache.get(userId);
+        }
+
+        const promise = new Promise(resolve => {
+            pending.set(userId, { resolve });
+        });
+        profileCache.set(userId, promise);
+
+        if (!flushScheduled) {
+            flushScheduled = true;
+            setTimeout(flushProfileRequests, 0);
+        }
+        return promise;
+    };
+})();